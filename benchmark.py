@@ -0,0 +1,660 @@
+"""
+Benchmarks for the editor's parsing and rendering paths. Run with the names
+of the benchmarks to execute, or without arguments to run all of them:
+
+    python benchmark.py render_depth
+"""
+import gc
+import sys
+from time import perf_counter
+
+from languages.structures import Block
+from languages.lua_structures import (DoBlock, Assignment, ExpressionList,
+                                      Identifier, Constant)
+
+def timed(function, repeat=5):
+    """ Returns the best time, in seconds, of a few calls to 'function'. """
+    best = float('inf')
+    gc.disable()
+    try:
+        for i in range(repeat):
+            start = perf_counter()
+            function()
+            best = min(best, perf_counter() - start)
+    finally:
+        gc.enable()
+    return best
+
+def nested_lua_block(depth, width):
+    """
+    Builds a Lua program with 'depth' nested do-blocks, each one containing
+    'width' assignments.
+    """
+    def statements():
+        return [Assignment([ExpressionList([Identifier(['variable'])]),
+                            ExpressionList([Constant([str(i)])])])
+                for i in range(width)]
+
+    block = Block(statements())
+    for level in range(depth - 1):
+        block = Block(statements() + [DoBlock([block])])
+    return block
+
+def render_depth():
+    """
+    Cold rendering of synthetic Lua files with the same number of lines and
+    increasing nesting depth. Linear rendering keeps the throughput flat.
+    Then a flat JSON document, a long array of small records, whose blocks
+    are all shallow.
+    """
+    from languages import json_parser
+
+    lines = 20000
+    print('Rendering {} lines with increasing depth:'.format(lines))
+    for depth in (1, 10, 50, 100, 200):
+        width = lines // depth
+        # Fresh trees for every run, so the renderings are not memoized.
+        trees = iter([nested_lua_block(depth, width) for i in range(4)])
+        size = len(next(trees).render())
+        seconds = timed(lambda: next(trees).render(), repeat=3)
+        print('depth {:4}: {:8.1f} ms, {:7.3f} MB/s'.format(
+            depth, seconds * 1000, size / seconds / 1e6))
+
+    items = 50000
+    text = flat_json(items)
+    trees = iter([load_tree(json_parser.parse_string(text)) for i in range(4)])
+    size = len(next(trees).render())
+    seconds = timed(lambda: next(trees).render(), repeat=3)
+    print('flat JSON, {} records: {:8.1f} ms, {:7.3f} MB/s'.format(
+        items, seconds * 1000, size / seconds / 1e6))
+
+def synthetic_json(items):
+    """ Returns the text of a JSON document with 'items' nested records. """
+    import json
+    records = [{'id': i, 'name': 'item {}'.format(i), 'tags': ['a', 'b'],
+                'position': {'x': i, 'y': -i}} for i in range(items)]
+    return json.dumps({'records': records})
+
+def flat_json(items):
+    """ Returns the text of a JSON array of 'items' records without nesting. """
+    import json
+    return json.dumps([{'id': i, 'name': 'item {}'.format(i), 'active': True}
+                       for i in range(items)])
+
+def load_tree(root):
+    """ Loads the lazy nodes of a tree, so they are not built while timing. """
+    nodes = [root]
+    for node in nodes:
+        nodes.extend(item for item in node.contents
+                     if hasattr(item, 'contents'))
+    return root
+
+def save_memory():
+    """
+    Peak memory allocated while saving a large JSON document, and memory
+    still held after saving, compared to the size of its text, which was
+    previously built as a single string. The tree is fully loaded before
+    measuring, so only the rendering is counted.
+    """
+    import os
+    import tempfile
+    import tracemalloc
+    from core.editor import Editor
+
+    editor = Editor.from_string(synthetic_json(20000), 'json')
+    load_tree(editor.root)
+    handle, editor.selected_file = tempfile.mkstemp('.json')
+    os.close(handle)
+    try:
+        for name in ('first', 'second'):
+            gc.collect()
+            tracemalloc.start()
+            editor.save()
+            gc.collect()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            size = os.path.getsize(editor.selected_file)
+            print('{} save of {:.1f} MB of JSON: {:.2f} MB peak allocation, '
+                  '{:.2f} MB kept'.format(name.capitalize(), size / 1e6,
+                                          peak / 1e6, current / 1e6))
+    finally:
+        os.remove(editor.selected_file)
+
+def json_open():
+    """
+    Time and peak memory to open a large JSON file like the editor does: the
+    tree is read, the first screen of the page is rendered and the Navigation
+    dock checks for unfilled placeholders. Then the first records of the top
+    level array are rendered. Memory is measured in a separate run, as
+    tracing slows down allocations.
+    """
+    import os
+    import tempfile
+    import tracemalloc
+    from core.actions import NextUnfilled
+    from core.editor import Editor
+    from core.html_renderer import VirtualRendering
+
+    def steps():
+        editor = Editor.from_file(path)
+        yield
+        VirtualRendering(editor.root, editor.selected, 300).html
+        NextUnfilled(editor.unfilled).is_available(editor.selected)
+        yield
+        records = editor.root[0][1]
+        ''.join(records[i].render() for i in range(10))
+        yield
+
+    handle, path = tempfile.mkstemp('.json')
+    with os.fdopen(handle, 'w') as target_file:
+        target_file.write(synthetic_json(50000))
+    try:
+        size = os.path.getsize(path)
+        seconds = []
+        start = perf_counter()
+        for step in steps():
+            seconds.append(perf_counter() - start)
+
+        peaks = []
+        tracemalloc.start()
+        for step in steps():
+            peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    finally:
+        os.remove(path)
+
+    print('{:.1f} MB of JSON'.format(size / 1e6))
+    for label, time, peak in zip(('opening', 'first paint', 'rendering'),
+                                 seconds, peaks):
+        print('{:>11}: {:8.1f} ms, {:6.2f} MB peak allocation'.format(
+            label, time * 1000, peak / 1e6))
+
+def navigation():
+    """
+    Walks through every statement of a long block, checking the availability
+    of the movement actions at each step like the command docks do.
+    """
+    from core.actions import (SelectNextSibling, SelectPrevSibling,
+                              MoveUp, MoveDown)
+    for lines in (1000, 10000, 50000):
+        block = nested_lua_block(1, lines)
+        actions = [SelectNextSibling(), SelectPrevSibling(), MoveUp(), MoveDown()]
+
+        def walk():
+            selected = block[0]
+            for i in range(lines - 1):
+                for action in actions:
+                    action.is_available(selected)
+                selected = actions[0].execute(selected)
+
+        seconds = timed(walk, repeat=3)
+        print('{:6} statements: {:8.2f} us per step'.format(
+            lines, seconds / lines * 1e6))
+
+def node_size(node):
+    """
+    Bytes used by a node object, its attribute dictionary and its list of
+    contents, if it has them. Strings are shared and not counted.
+    """
+    size = sys.getsizeof(node)
+    if hasattr(node, '__dict__'):
+        size += sys.getsizeof(node.__dict__)
+    if isinstance(node.__class__.__dict__.get('contents'), property):
+        return size
+    if isinstance(node.contents, list):
+        size += sys.getsizeof(node.contents)
+    return size
+
+def node_memory(scale=1000):
+    """
+    Bytes per node, by class, for the Lua test files copied 'scale' times
+    into a single document.
+    """
+    import glob
+    from copy import deepcopy
+    from collections import Counter
+    from core.editor import parsers
+
+    statements = []
+    for path in sorted(glob.glob('test_files/*.lua')):
+        try:
+            statements.extend(parsers['lua'].parse_string(open(path).read()))
+        except Exception as e:
+            print('Skipping {}: {}'.format(path, type(e).__name__))
+    root = Block([deepcopy(statement)
+                  for i in range(scale) for statement in statements])
+
+    counts = Counter()
+    sizes = Counter()
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        counts[type(node).__name__] += 1
+        sizes[type(node).__name__] += node_size(node)
+        stack.extend(child for child in node if hasattr(child, 'contents'))
+
+    print('{:>16} {:>9} {:>6} {:>7}'.format('class', 'nodes', 'bytes', 'MB'))
+    for name, count in counts.most_common():
+        print('{:>16} {:9} {:6.0f} {:7.1f}'.format(
+            name, count, sizes[name] / count, sizes[name] / 1e6))
+    total = sum(counts.values())
+    print('{:>16} {:9} {:6.0f} {:7.1f}'.format(
+        'total', total, sum(sizes.values()) / total, sum(sizes.values()) / 1e6))
+
+def columnar_memory(scale=300):
+    """
+    Memory, garbage collection and rendering time of the Lua test files
+    copied 'scale' times into a single document, with one object per node
+    and in the columnar store.
+    """
+    import glob
+    import tracemalloc
+    from copy import deepcopy
+    from core.editor import parsers
+    from languages import columnar
+
+    statements = []
+    for path in sorted(glob.glob('test_files/*.lua')):
+        try:
+            statements.extend(parsers['lua'].parse_string(open(path).read()))
+        except Exception as e:
+            print('Skipping {}: {}'.format(path, type(e).__name__))
+
+    def objects():
+        return Block([deepcopy(statement)
+                      for i in range(scale) for statement in statements])
+
+    def columns():
+        return columnar.convert(objects())
+
+    for label, build in (('objects', objects), ('columnar', columns)):
+        tracemalloc.start()
+        root = build()
+        # Parent pointers make cycles, so the copies are only freed here.
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        collect = timed(gc.collect, repeat=3)
+        # A new wrapper every time, so the memoized renderings are not used.
+        render = timed(lambda: root.render(lambda node: node.template),
+                       repeat=3)
+        rerender = timed(root.render, repeat=3)
+        print('{:>9}: {:7.1f} MB, gc {:6.1f} ms, cold render {:7.1f} ms, '
+              'cached render {:6.1f} ms'.format(label, size / 1e6,
+              collect * 1000, render * 1000, rerender * 1000))
+        del root
+
+def parse_speed():
+    """
+    Throughput of the pyparsing Lua grammar and of the hand-written parser,
+    on the test files and on a long chain of binary operations.
+    """
+    from languages import lua_parser, lua_pratt_parser
+
+    paths = ['test_files/1.lua', 'test_files/4.lua', 'test_files/5.lua',
+             'test_files/full.lua']
+    sources = [('test files', '\n'.join(open(path).read()
+                                        for path in paths) * 3),
+               ('operator chain', 'x = ' + ' + '.join(['a.b[1]'] * 500))]
+    for label, source in sources:
+        for module in (lua_parser, lua_pratt_parser):
+            seconds = timed(lambda: module.parse_string(source), repeat=3)
+            print('{:>14}, {:>16}: {:8.1f} ms, {:7.3f} MB/s'.format(
+                label, module.__name__.split('.')[-1], seconds * 1000,
+                len(source) / seconds / 1e6))
+
+def synthetic_lisp(expressions, depth):
+    """
+    Returns the text of a Lisp program with 'expressions' top level
+    expressions, each nested 'depth' levels deep.
+    """
+    expression = '(define (f x) (+ x 1.5 "text"))'
+    for level in range(depth - 1):
+        expression = '(let ((y {})) {} -2)'.format(level, expression)
+    return '\n'.join([expression] * expressions)
+
+def lisp_speed():
+    """
+    Throughput of the Lisp reader on multi-megabyte programs, from flat to
+    deeply nested.
+    """
+    from languages import lisp_parser
+
+    for expressions, depth in ((100000, 1), (5000, 20), (1, 100000)):
+        source = synthetic_lisp(expressions, depth)
+        seconds = timed(lambda: lisp_parser.parse_string(source), repeat=3)
+        print('depth {:6}: {:8.1f} ms, {:7.3f} MB/s ({:.1f} MB)'.format(
+            depth, seconds * 1000, len(source) / seconds / 1e6,
+            len(source) / 1e6))
+
+def parse_cache():
+    """
+    Time to open files through the persistent parse cache, on a miss
+    (parsing and storing) and on a hit.
+    """
+    import tempfile
+    from core import parse_cache
+    from core.editor import parsers
+    from languages import python_parser
+
+    python_parser.verification = 'off'
+    sources = [('lua', '\n'.join(open(path).read() for path in
+                                  ('test_files/1.lua', 'test_files/4.lua'))),
+               ('python', open('gui/window.py').read())]
+    with tempfile.TemporaryDirectory() as directory:
+        parse_cache.directory = directory
+        for language, source in sources:
+            parser = parsers[language]
+            for i in range(3):
+                # A different text every time, so each call misses.
+                text = source + '\n' * (i + 1)
+                miss = timed(lambda: parse_cache.parse(language, parser, text),
+                             repeat=1)
+            parse_cache.parse(language, parser, source)
+            hit = timed(lambda: parse_cache.parse(language, parser, source))
+            print('{:>8}: {:8.1f} ms miss, {:6.1f} ms hit'.format(
+                language, miss * 1000, hit * 1000))
+    print(parse_cache.stats)
+
+def python_verification():
+    """
+    Latency of opening a large Python module with each parse drift
+    verification mode.
+    """
+    from languages import python_parser
+
+    source = open('gui/window.py').read() * 10
+    python_parser.report_drift = lambda diff: None
+    for mode in ('off', 'sampled', 'always', 'background'):
+        python_parser.verification = mode
+        seconds = timed(lambda: python_parser.parse_string(source), repeat=3)
+        print('{:>10}: {:8.1f} ms'.format(mode, seconds * 1000))
+    print(python_parser.timings)
+
+def python_convert():
+    """
+    Time to convert Python ASTs to structures, for statements dominated by
+    different node types.
+    """
+    import ast
+    from languages import python_parser
+
+    snippets = [('Name', 'a'),
+                ('Constant', "'text'"),
+                ('Attribute', 'a.b.c'),
+                ('BinOp', 'a + b * c'),
+                ('Call', 'f(a, b=c)'),
+                ('Assign', 'a = b'),
+                ('If', 'if a:\n    pass\nelse:\n    pass'),
+                ('FunctionDef', 'def f(a, b=1):\n    return a'),
+                ('Raise', 'raise a'),
+                ('AugAssign', 'a += 1')]
+    count = 2000
+    for label, snippet in snippets:
+        tree = ast.parse('\n'.join([snippet] * count))
+        seconds = timed(lambda: python_parser.convert(tree), repeat=3)
+        print('{:>12}: {:6.2f} us per statement'.format(
+            label, seconds / count * 1e6))
+
+def startup():
+    """
+    Cold start time, in fresh interpreters: importing the editor core, and
+    from the first import of main.pyw until its window is shown with a JSON
+    file open. The second one needs PyQt5 and a display.
+    """
+    import subprocess
+
+    def best(command, repeat=5):
+        times = []
+        for i in range(repeat):
+            output = subprocess.check_output([sys.executable] + command,
+                                             stderr=subprocess.DEVNULL,
+                                             universal_newlines=True)
+            times.append(float(output.strip().splitlines()[-1]))
+        return min(times)
+
+    seconds = best(['-c', 'from time import perf_counter as t; s = t(); '
+                          'import core.editor; print(t() - s)'])
+    print('{:>12}: {:8.1f} ms'.format('core.editor', seconds * 1000))
+
+    try:
+        seconds = best(['main.pyw', '--startup-time', 'test_files/1.json'])
+    except (subprocess.CalledProcessError, ValueError) as e:
+        print('{:>12}: skipped ({})'.format('main.pyw', type(e).__name__))
+    else:
+        print('{:>12}: {:8.1f} ms'.format('main.pyw', seconds * 1000))
+
+def tree_format():
+    """
+    Time to parse files compared to loading their trees from the binary
+    format, and the size of both.
+    """
+    import io
+    from languages import structures, lua_parser, lua_pratt_parser
+    from languages import python_parser, lisp_parser
+
+    python_parser.verification = 'off'
+    lua_source = open('test_files/1.lua').read()
+    sources = [('lua grammar', lua_parser, lua_source),
+               ('lua', lua_pratt_parser, lua_source * 20),
+               ('python', python_parser, open('gui/window.py').read() * 5),
+               ('lisp', lisp_parser, synthetic_lisp(5000, 5))]
+    for label, parser, source in sources:
+        root = parser.parse_string(source)
+        data = io.BytesIO()
+        structures.dump(root, data)
+        parse = timed(lambda: parser.parse_string(source), repeat=3)
+        dump = timed(lambda: structures.dump(root, io.BytesIO()), repeat=3)
+        load = timed(lambda: structures.load(io.BytesIO(data.getvalue())),
+                     repeat=3)
+        # Mapped from memory, and reading only the first top level item.
+        view = timed(lambda: structures.TreeReader(data.getvalue()).root()[0],
+                     repeat=3)
+        print('{:>12}: parse {:7.1f} ms, dump {:6.1f} ms, load {:6.1f} ms '
+              '({:.0f}x), map {:5.2f} ms, {:6.0f} kB text, {:6.0f} kB tree'
+              .format(label, parse * 1000, dump * 1000, load * 1000,
+                      parse / load, view * 1000, len(source) / 1e3,
+                      len(data.getvalue()) / 1e3))
+
+def background_open(files=64):
+    """
+    Throughput of opening many Lua files in the editor's process, and in
+    worker processes with pools of increasing size.
+    """
+    import os
+    import tempfile
+    import time
+    from concurrent.futures import ProcessPoolExecutor
+    from core import background, parse_cache
+    from core.editor import Editor
+
+    parse_cache.directory = ''
+    source = '\n'.join(open(path).read() for path in
+                       ('test_files/1.lua', 'test_files/4.lua')) * 5
+    with tempfile.TemporaryDirectory() as directory:
+        paths = [os.path.join(directory, '{}.lua'.format(i))
+                 for i in range(files)]
+        for path in paths:
+            with open(path, 'w') as source_file:
+                source_file.write(source)
+
+        def open_all():
+            batch = background.Batch(paths)
+            while not batch.done:
+                # Polled like the editor does, leaving the cores to workers.
+                time.sleep(0.005)
+                batch.poll()
+
+        seconds = timed(lambda: [Editor.from_file(path) for path in paths],
+                        repeat=1)
+        print('{:>10}: {:6.0f} files/s'.format('in process', files / seconds))
+        sizes = sorted(set([1, 2, 4, os.cpu_count()]))
+        for size in sizes:
+            background._executor = ProcessPoolExecutor(size)
+            # Starts the workers before timing.
+            background._executor.submit(int).result()
+            seconds = timed(open_all, repeat=1)
+            print('{:>2} workers: {:6.0f} files/s'.format(size, files / seconds))
+            background._executor.shutdown()
+        background._executor = None
+
+def incremental_reparse():
+    """
+    Time to apply a one statement text edit to a large Lua program, parsing
+    only the statements around it, compared to parsing the whole program.
+    """
+    from languages import lua_pratt_parser, incremental
+
+    source = '\n'.join(open(path).read() for path in
+                       ('test_files/1.lua', 'test_files/4.lua')) * 20
+    root = lua_pratt_parser.parse_string(source)
+    text = root.render()
+    start = text.index('=', len(text) // 2) + 2
+    end = start + 1
+    old = text[start:end]
+
+    def edit():
+        incremental.reparse(lua_pratt_parser, root, text, start, end, old)
+    full = timed(lambda: lua_pratt_parser.parse_string(text), repeat=3)
+    partial = timed(edit, repeat=3)
+    print('{:6.0f} kB: full {:7.1f} ms, incremental {:7.1f} ms ({:.1f}x)'.format(
+        len(text) / 1e3, full * 1000, partial * 1000, full / partial))
+
+def html_patches():
+    """
+    Time to update the editor's page after renaming a variable in a large Lua
+    program, with patches for the changed nodes compared to rendering the
+    whole page again.
+    """
+    import json
+    from core.editor import Editor
+    from core.html_renderer import LinkedRendering
+    from core.actions import Rename
+
+    source = '\n'.join(open(path).read() for path in
+                       ('test_files/1.lua', 'test_files/4.lua')) * 20
+    editor = Editor.from_string(source, 'lua')
+    rendering = LinkedRendering(editor.root)
+    editor.selected = editor.root[len(editor.root) // 2]
+    while not isinstance(editor.selected[0], str):
+        editor.selected = editor.selected[0]
+
+    def rename():
+        editor.execute(Rename())
+        return rendering.patches()
+    patches = rename()
+    full = timed(lambda: LinkedRendering(editor.root), repeat=3)
+    # The full renderings discarded the memoized HTML, so it is rendered once
+    # before timing.
+    rendering.patches()
+    patched = timed(rename, repeat=3)
+    print('{:6.0f} kB: full {:7.1f} ms, patches {:7.2f} ms, {} bytes sent'.format(
+        len(rendering.html) / 1e3, full * 1000, patched * 1000,
+        len(json.dumps(patches))))
+
+def virtual_page():
+    """
+    Size and time to build the page of a large Lua program with every node
+    in it, and with only the first screens rendered and placeholders for
+    the rest.
+    """
+    from core.editor import Editor
+    from core.html_renderer import LinkedRendering, VirtualRendering
+
+    source = '\n'.join(open(path).read() for path in
+                       ('test_files/1.lua', 'test_files/4.lua')) * 20
+    root = Editor.from_string(source, 'lua').root
+    for name, make in [('full', lambda: LinkedRendering(root)),
+                       ('virtual', lambda: VirtualRendering(root))]:
+        rendering = make()
+        # Renderings with a different wrapper discard the memoized HTML.
+        seconds = timed(make, repeat=3)
+        print('{:>8}: {:7.1f} ms, {:6.0f} kB, {:6} spans'.format(
+            name, seconds * 1000, len(rendering.html) / 1e3,
+            rendering.html.count('<span')))
+
+def page_size():
+    """
+    Bytes and elements per node in the editor's page for the sample files,
+    compared to wrapping each node's text in links to itself and closing and
+    reopening the parent's link around it, as the page used to.
+    """
+    import glob
+    import re
+    from core.editor import Editor
+    from core.html_renderer import LinkedRendering
+
+    for path in sorted(glob.glob('test_files/*.*')):
+        editor = Editor.from_file(path)
+        rendering = LinkedRendering(editor.root)
+        nodes = len(rendering.node_dict)
+
+        def linked(node):
+            open_span, template, close_span = rendering._make_parts(node)
+            link = '<a href="{}">'.format(node.node_id)
+            parent = '<a href="{}">'.format(node.parent.node_id) if node.parent else ''
+            return ''.join(('</a>' if parent else '', open_span, link, template,
+                            '</a>', close_span, parent))
+
+        for name, html in [('links', editor.root.render(linked)),
+                           ('compact', editor.root.render(rendering._process_node))]:
+            elements = len(re.findall('<[a-z]', html))
+            print('{:>20} {:>8}: {:5.1f} bytes/node, {:4.2f} elements/node'.format(
+                path, name, len(html) / nodes, elements / nodes))
+
+def template_lookup():
+    """
+    Time to render a large Lua program with the 'Output Templates', looking
+    up each node's template in the config parser compared to the table
+    built by config.wrapper. Nothing is memoized.
+    """
+    from core import config
+    from core.editor import Editor
+    from languages.structures import uncached
+
+    source = '\n'.join(open(path).read() for path in
+                       ('test_files/1.lua', 'test_files/4.lua')) * 20
+    root = Editor.from_string(source, 'lua').root
+    table = config.wrapper('Output Templates')
+
+    @uncached
+    def parser_wrapper(node):
+        section = 'Output Templates'
+        template = config.get(section, config.template_key(type(node)), None)
+        if template is None:
+            template = config.get(section, type(node).__name__.lower(),
+                                  node.template)
+        return template
+
+    @uncached
+    def table_wrapper(node):
+        return table(node)
+
+    for name, wrapper in [('parser', parser_wrapper), ('table', table_wrapper)]:
+        seconds = timed(lambda: root.render(wrapper), repeat=3)
+        print('{:>7}: {:7.1f} ms'.format(name, seconds * 1000))
+
+benchmarks = {'background_open': background_open,
+              'columnar_memory': columnar_memory,
+              'incremental_reparse': incremental_reparse,
+              'html_patches': html_patches,
+              'json_open': json_open,
+              'lisp_speed': lisp_speed,
+              'navigation': navigation,
+              'node_memory': node_memory,
+              'page_size': page_size,
+              'parse_cache': parse_cache,
+              'parse_speed': parse_speed,
+              'python_convert': python_convert,
+              'python_verification': python_verification,
+              'render_depth': render_depth,
+              'save_memory': save_memory,
+              'startup': startup,
+              'template_lookup': template_lookup,
+              'tree_format': tree_format,
+              'virtual_page': virtual_page}
+
+if __name__ == '__main__':
+    sys.setrecursionlimit(10000)
+    for name in sys.argv[1:] or sorted(benchmarks):
+        benchmarks[name]()
@@ -14,7 +14,7 @@ class Action(object):
         those properties from a simple selected node.
         """
         parent = selected.parent
-        return (selected, parent, parent.index(selected) if parent else -1)
+        return (selected, parent, parent.index_of(selected) if parent else -1)
 
     def is_available(self, selected):
         """
@@ -81,13 +81,18 @@ class SelectChild(Action):
 
 
 class NextUnfilled(Action):
+    def __init__(self, unfilled):
+        self.unfilled = unfilled
+
+    def __deepcopy__(self, memo):
+        # The index belongs to the editor, copies must share it.
+        return NextUnfilled(self.unfilled)
+
     def _is_available(self, selected, parent, index):
-        return len(set(selected.defaulted) - set([selected])) > 0
+        return self.unfilled.next_after(selected) is not None
 
     def _execute(self, selected, parent, index):
-        defaulted = selected.defaulted
-        index = defaulted.index(selected) if selected in defaulted else 0
-        return defaulted.pop((index + 1) % len(defaulted))
+        return self.unfilled.next_after(selected)
 
 
 class MoveUp(SelectPrevSibling):
@@ -246,6 +251,7 @@ class Rename(Action):
 
     def _execute(self, selected, parent, index):
         self.old_name = selected[0]
+        self.was_placeholder = selected.placeholder
 
         if not hasattr(self, 'new_name'):
             self.new_name = self.ask_for_name(self.old_name)
@@ -256,7 +262,9 @@ class Rename(Action):
                     self.new_name = self.old_name
 
         selected[0] = self.new_name
+        selected.placeholder = False
         return selected
 
     def _rollback(self, selected, parent, index):
         selected[0] = self.old_name
+        selected.placeholder = self.was_placeholder
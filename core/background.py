@@ -0,0 +1,95 @@
+"""
+Opens files by parsing them in worker processes, so opening many files at
+once doesn't block the editor and uses all cores.
+
+Workers send the trees back in the binary format of
+languages.structures.dump, which is smaller and faster to load than pickled
+nodes. Languages whose parser reads files lazily (see
+json_parser.parse_file) are opened in the editor's process instead, as
+building their whole tree in a worker would take longer.
+"""
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from languages import structures
+from . import config, editor, parse_cache
+
+# Number of worker processes. Zero starts one per core.
+workers = int(config.get('Parsing', 'workers', 0)) or os.cpu_count()
+
+_executor = None
+def executor():
+    """
+    Returns the pool of worker processes, started on first use with the
+    current parse cache directory.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(workers,
+                                        initializer=parse_cache.set_directory,
+                                        initargs=(parse_cache.directory,))
+    return _executor
+
+def parse(path):
+    """
+    Parses the file at 'path' in a worker process. Returns its tree in the
+    binary format of languages.structures.dump, or None if the file should
+    be opened in the editor's process.
+    """
+    language = editor.Editor.get_language(path.rsplit('.')[-1])
+    if hasattr(editor.parsers[language], 'parse_file'):
+        return None
+
+    data = io.BytesIO()
+    try:
+        structures.dump(editor.parse_file(path), data)
+    except ValueError:
+        # Values the format can't hold.
+        return None
+    return data.getvalue()
+
+class Batch(object):
+    """
+    Files being opened in the worker processes. The editors are created in
+    the calling process by 'poll', as the files finish parsing.
+    """
+    def __init__(self, paths, editor_class=editor.Editor):
+        self.editor_class = editor_class
+        self.total = len(paths)
+        self.finished = 0
+        pool = executor()
+        self.futures = {pool.submit(parse, path): path for path in paths}
+
+    @property
+    def done(self):
+        return not self.futures
+
+    def poll(self):
+        """
+        Returns a list of (path, editor, exception) triples for the files
+        finished since the last call, in the order they were requested.
+        Either 'editor' or 'exception' is None.
+        """
+        results = []
+        for future, path in list(self.futures.items()):
+            if not future.done():
+                continue
+            del self.futures[future]
+            self.finished += 1
+            try:
+                opened = self.editor_class.from_file(path, future.result())
+            except Exception as e:
+                results.append((path, None, e))
+            else:
+                results.append((path, opened, None))
+        return results
+
+    def cancel(self):
+        """
+        Stops opening the files that didn't finish yet. Files already being
+        parsed are finished by the workers, but discarded.
+        """
+        for future in self.futures:
+            future.cancel()
+        self.finished += len(self.futures)
+        self.futures.clear()
@@ -5,12 +5,39 @@ except:
 import os
 import sys
 from collections import defaultdict
+from types import MappingProxyType
 
 folder = os.path.dirname(os.path.realpath(sys.argv[0]))
+if not os.path.isdir(os.path.join(folder, 'config')):
+    # Run as a module, e.g. 'python -m core.format'.
+    folder = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+paths = [os.path.join(folder, 'config/output_format.ini'),
+         os.path.join(folder, 'config/theme.ini')]
+
+def modification_times():
+    return tuple(os.path.getmtime(path) if os.path.exists(path) else None
+                 for path in paths)
 
 config = RawConfigParser()
-config.read(os.path.join(folder, 'config/output_format.ini'))
-config.read(os.path.join(folder, 'config/theme.ini'))
+config.read(paths)
+loaded_times = modification_times()
+
+# Template tables and wrappers by section, built on first use and dropped
+# when the files change.
+tables = {}
+wrappers = {}
+
+def reload_if_changed():
+    """ Reads the config files again if they changed since they were read. """
+    global config, loaded_times
+    times = modification_times()
+    if times != loaded_times:
+        config = RawConfigParser()
+        config.read(paths)
+        loaded_times = times
+        tables.clear()
+        wrappers.clear()
 
 def get(section, item, default=''):
     try:
@@ -23,3 +50,60 @@ def section(section_name):
         return defaultdict(str, config.items(section_name))
     except:
         return defaultdict(str)
+
+def template_key(cls):
+    """
+    Returns the key of the template of a node class, its module and name in
+    lowercase such as 'lua_structures.assignment', so classes with the same
+    name in different languages have their own templates.
+    """
+    module = cls.__module__.rsplit('.', 1)[-1]
+    return '{}.{}'.format(module, cls.__name__).lower()
+
+def lookup_template(table, cls):
+    """
+    Returns the template of a node class in a mapping of templates, by its
+    template_key or else by its bare name in lowercase, as in config files
+    written before the keys had the module. Returns None if neither is there.
+    """
+    template = table.get(template_key(cls))
+    if template is None:
+        template = table.get(cls.__name__.lower())
+    return template
+
+def templates(section_name):
+    """
+    Returns a read-only mapping of the templates in a section such as
+    'Display Templates', by template_key. The mapping is built once and
+    rebuilt only when the files change.
+    """
+    reload_if_changed()
+    try:
+        return tables[section_name]
+    except KeyError:
+        table = tables[section_name] = MappingProxyType(dict(section(section_name)))
+        return table
+
+def wrapper(section_name):
+    """
+    Returns a rendering wrapper giving each node the template of its class
+    in the section, or the node's own template. The same wrapper is returned
+    until the files change, so the renderings memoized with it stay valid.
+    """
+    table = templates(section_name)
+    try:
+        return wrappers[section_name]
+    except KeyError:
+        pass
+
+    # The template of each class, or None for the node's own.
+    by_class = {}
+    def template_wrapper(node):
+        cls = type(node)
+        try:
+            template = by_class[cls]
+        except KeyError:
+            template = by_class[cls] = lookup_template(table, cls)
+        return node.template if template is None else template
+    wrappers[section_name] = template_wrapper
+    return template_wrapper
@@ -2,14 +2,253 @@
 Module for editing a program's source code interactively with a structured
 editor.
 """
-from languages import lua_parser, json_parser, lisp_parser, python_parser
+from languages.structures import Node, LazyNode
+from languages import structures, columnar, incremental
 from os.path import commonprefix
-from . import config
+import os
+import io
+import shutil
+import tempfile
+from bisect import bisect_right
+from operator import itemgetter
+from importlib import import_module
+from . import config, parse_cache
 
-parsers = {'lua': lua_parser,
-           'json': json_parser,
-           'lisp': lisp_parser,
-           'python': python_parser}
+
+class ParserRegistry(object):
+    """
+    Maps language names to their parser modules. Modules are only imported
+    the first time their language is used, so starting the editor doesn't
+    build the grammars of languages that are never opened.
+    """
+    def __init__(self):
+        self.module_names = {}
+        self.setups = {}
+        self.modules = {}
+        self.cached = set()
+
+    def register(self, language, module_name, setup=None, cached=True):
+        """
+        Registers the parser module for 'language'. 'setup' is called with
+        the module right after it is imported. If 'cached' is true, trees
+        parsed from files are kept in the persistent parse cache.
+        """
+        self.module_names[language] = module_name
+        self.setups[language] = setup
+        if cached:
+            self.cached.add(language)
+
+    def __getitem__(self, language):
+        try:
+            return self.modules[language]
+        except KeyError:
+            module = import_module(self.module_names[language])
+            if self.setups[language] is not None:
+                self.setups[language](module)
+            self.modules[language] = module
+            return module
+
+    def __iter__(self):
+        return iter(self.module_names)
+
+    def __contains__(self, language):
+        return language in self.module_names
+
+    def __len__(self):
+        return len(self.module_names)
+
+def setup_lua(module):
+    # The pyparsing grammar is still imported because pasted snippets are
+    # parsed with the grammar symbols it registers in each class.
+    import_module('languages.lua_parser')
+
+def setup_python(module):
+    # Whether opened Python files are checked for parse drift (see
+    # python_parser.verification for the possible values).
+    module.verification = config.get('Parsing', 'python verification',
+                                     module.verification)
+
+# Documents from files larger than this, in bytes, are kept in a columnar
+# store instead of one object per node (see languages.columnar). Zero
+# disables it.
+columnar_size = int(config.get('Parsing', 'columnar size', 0)) * 1024 * 1024
+
+parsers = ParserRegistry()
+parsers.register('lua', 'languages.lua_pratt_parser', setup_lua)
+# JSON trees are built lazily from the file, which is faster than loading
+# them from the cache.
+parsers.register('json', 'languages.json_parser', cached=False)
+parsers.register('lisp', 'languages.lisp_parser')
+parsers.register('python', 'languages.python_parser', setup_python)
+
+def parse_file(path):
+    """
+    Returns the tree of the file at 'path', parsed by the parser of the
+    language matching its extension.
+    """
+    language = Editor.get_language(path.rsplit('.')[-1])
+    parser = parsers[language]
+    if hasattr(parser, 'parse_file'):
+        # Parsers that read the file themselves, e.g. to memory-map it.
+        with open(path, 'rb') as source_file:
+            return parser.parse_file(source_file)
+    elif language in parsers.cached:
+        return parse_cache.parse(language, parser, open(path).read())
+    else:
+        return parser.parse_string(open(path).read())
+
+class UnfilledIndex(object):
+    """
+    Placeholder nodes of a document that were not filled by the user yet,
+    kept in document order.
+
+    Placeholders are discovered by walking the subtrees given to 'add', and
+    the order is recomputed lazily after the document changes. Nodes that
+    were filled, renamed or removed from the document are dropped then.
+    """
+    def __init__(self, root):
+        self.root = root
+        # The whole document is only walked on the first query.
+        self.candidates = None
+        self.entries = []
+        self.positions = []
+        self.stale = True
+
+    def add(self, node):
+        """
+        Registers the placeholders in the subtree of 'node', which was just
+        added or changed, and marks the current order as outdated.
+        """
+        if self.candidates is not None:
+            self.candidates.update(self._placeholders(node))
+        self.stale = True
+
+    def _placeholders(self, node):
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node.placeholder:
+                yield node
+            # Children that were not built yet come from the parsed file,
+            # which has no placeholders.
+            if isinstance(node, LazyNode) and not node.loaded:
+                continue
+            stack.extend(child for child in node.contents
+                         if isinstance(child, Node))
+
+    def _position(self, node):
+        """
+        Returns the path of child indexes from the root to 'node', or None if
+        'node' is not part of the document.
+        """
+        path = []
+        while node is not self.root:
+            parent = node.parent
+            if parent is None:
+                return None
+            index = parent.index_of(node)
+            if index == -1:
+                return None
+            path.append(index)
+            node = parent
+        path.reverse()
+        return tuple(path)
+
+    def _refresh(self):
+        if self.candidates is None:
+            self.candidates = set(self._placeholders(self.root))
+
+        entries = []
+        for node in self.candidates:
+            if node.placeholder:
+                position = self._position(node)
+                if position is not None:
+                    entries.append((position, node))
+        entries.sort(key=itemgetter(0))
+
+        self.candidates = set(node for position, node in entries)
+        self.entries = entries
+        self.positions = [position for position, node in entries]
+        self.stale = False
+
+    def __len__(self):
+        if self.stale:
+            self._refresh()
+        return len(self.entries)
+
+    def next_after(self, node):
+        """
+        Returns the first unfilled node after 'node' in document order,
+        wrapping around to the start, or None if 'node' is the only one.
+        """
+        if self.stale:
+            self._refresh()
+        if not self.entries:
+            return None
+
+        position = self._position(node)
+        if position is None:
+            position = ()
+        i = bisect_right(self.positions, position)
+        next_node = self.entries[i % len(self.entries)][1]
+        return next_node if next_node is not node else None
+
+
+class TextEdit(object):
+    """
+    Action replacing the text between 'start' and 'end' in the document with
+    'text'. Only the statements around the edit are parsed again when
+    possible (see languages.incremental), otherwise the whole document is
+    replaced by a new tree.
+    """
+    alters = True
+
+    def __init__(self, editor, start, end, text):
+        self.editor = editor
+        self.start = start
+        self.end = end
+        self.text = text
+        self.old_root = None
+        self.new_root = None
+        self.splice = None
+        self.applied = False
+
+    def parse(self):
+        """
+        Parses the edited text, changing the tree in place if only part of it
+        was parsed again. Raises the parser's exception if the text is
+        invalid, before the action is executed.
+        """
+        editor = self.editor
+        self.old_root = editor.root
+        self.new_root, self.splice = incremental.reparse(
+            parsers[editor.language], editor.root, editor.root.render(),
+            self.start, self.end, self.text)
+        self.applied = True
+
+    def is_available(self, selected):
+        return True
+
+    def execute(self, selected):
+        if self.splice is not None and not self.applied:
+            # Redone with the same nodes, as later actions refer to them.
+            self.splice.redo()
+        self.applied = False
+
+        if self.splice is None:
+            self.editor.set_root(self.new_root)
+            return self.new_root
+        elif self.editor.contains(selected):
+            return selected
+        else:
+            return self.splice.block
+
+    def rollback(self, selected):
+        if self.splice is None:
+            self.editor.set_root(self.old_root)
+        else:
+            self.splice.undo()
+        return selected
 
 
 class Editor(object):
@@ -24,10 +263,23 @@ class Editor(object):
         return max(parsers, key=lambda l: len(commonprefix([ext, l])))
     
     @classmethod
-    def from_file(cls, path):
+    def from_file(cls, path, data=None):
+        """
+        Creates an editor for the file at 'path'. 'data' is the file's tree
+        in the binary format of languages.structures.dump, if it was already
+        parsed elsewhere (see core.background).
+        """
         ext = path.rsplit('.')[-1]
-        language = Editor.get_language(ext)
-        root = parsers[language].parse_string(open(path).read())
+        large = columnar_size and os.path.getsize(path) > columnar_size
+        if data is not None:
+            if large:
+                root = columnar.load(io.BytesIO(data))
+            else:
+                root = structures.load(io.BytesIO(data))
+        else:
+            root = parse_file(path)
+            if large:
+                root = columnar.convert(root)
         return cls(root, ext, path)
 
     @classmethod
@@ -52,15 +304,45 @@ class Editor(object):
         self.language = Editor.get_language(ext)
         self.structures = parsers[self.language].structures
         self.ext = ext
+        self.unfilled = UnfilledIndex(root)
 
         self.clipboard = None
         self.past_history = []
         self.future_history = []
         self.last_saved_action = None
 
-    def _file_wrapper(self, node):
-        class_name = type(node).__name__.lower()
-        return config.get('Output Templates', class_name, node.template)
+    def set_root(self, root):
+        """
+        Replaces the whole tree being edited, selecting its root.
+        """
+        self.root = root
+        self.selected = root
+        self.unfilled = UnfilledIndex(root)
+
+    def contains(self, node):
+        """
+        Returns true if 'node' is part of the tree being edited.
+        """
+        # Removed nodes are detached from their parents.
+        while node is not None:
+            if node is self.root:
+                return True
+            node = node.parent
+        return False
+
+    def replace_text(self, start, end, text):
+        """
+        Replaces the text between 'start' and 'end' in the rendering of the
+        document with 'text', as an action that can be undone.
+        """
+        action = TextEdit(self, start, end, text)
+        action.parse()
+        self.execute(action)
+
+    @property
+    def _file_wrapper(self):
+        """ Wrapper rendering the nodes with the 'Output Templates'. """
+        return config.wrapper('Output Templates')
 
     def save(self):
         """
@@ -72,8 +354,21 @@ class Editor(object):
         if self.past_history:
             self.last_saved_action = self.past_history[-1]
 
-        with open(self.selected_file, 'w') as target_file:
-            target_file.write(self.root.render(self._file_wrapper))
+        # The chunks are rendered while they are written, so they go to a
+        # temporary file that replaces the original only when complete, and
+        # a failure doesn't truncate it.
+        chunks = self.root.iter_render(self._file_wrapper)
+        directory, name = os.path.split(os.path.abspath(self.selected_file))
+        handle, temporary_path = tempfile.mkstemp(prefix=name, dir=directory)
+        try:
+            with open(handle, 'w') as target_file:
+                target_file.writelines(chunks)
+            if os.path.exists(self.selected_file):
+                shutil.copymode(self.selected_file, temporary_path)
+            os.replace(temporary_path, self.selected_file)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
 
     def save_as(self, new_path):
         """
@@ -98,6 +393,8 @@ class Editor(object):
                 self.past_history = self.past_history[-1000:]
 
         self.selected = action.execute(self.selected)
+        if action.alters:
+            self.unfilled.add(self.selected)
 
     def is_available(self, action):
         """
@@ -113,6 +410,7 @@ class Editor(object):
         self.selected, action = self.future_history.pop()
         self.past_history.append((self.selected, action))
         self.selected = action.execute(self.selected)
+        self.unfilled.add(self.selected)
 
     def undo(self):
         """
@@ -122,6 +420,7 @@ class Editor(object):
         self.selected, action = self.past_history.pop()
         self.future_history.append((self.selected, action))
         self.selected = action.rollback(self.selected)
+        self.unfilled.add(self.selected)
 
     def can_save(self):
         """
@@ -0,0 +1,150 @@
+"""
+Command line formatter, which parses files and writes them back as the
+editor would save them, using the templates in the 'Output Templates'
+config section. Directories are searched for files with the given
+extensions, and the files are formatted in parallel by worker processes.
+
+    python -m core.format [--check] [--diff] [--jobs N] path...
+
+With '--check' or '--diff' no file is written, and the exit status is 1 if
+any file would change. Parse errors are reported and also give status 1, as
+do files whose formatted text doesn't parse back to the same tree, which are
+left unchanged.
+"""
+import os
+import sys
+import difflib
+import argparse
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+from languages.structures import Node
+from . import parse_cache
+from .editor import Editor
+
+def find_files(paths, extensions):
+    """
+    Yields the files in 'paths', and the files with one of 'extensions' in
+    the directories in 'paths', recursively and in a stable order.
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for folder, subfolders, files in os.walk(path):
+            subfolders.sort()
+            for name in sorted(files):
+                if name.rsplit('.', 1)[-1] in extensions:
+                    yield os.path.join(folder, name)
+
+def diff(path, original, formatted):
+    """ Returns the changes from 'original' to 'formatted' as a unified diff. """
+    lines = []
+    for line in difflib.unified_diff(original.splitlines(True),
+                                     formatted.splitlines(True),
+                                     path, path):
+        if not line.endswith('\n'):
+            line += '\n\\ No newline at end of file\n'
+        lines.append(line)
+    return ''.join(lines)
+
+def same_tree(first, second):
+    """
+    Returns whether two trees have nodes of the same classes with equal
+    values in the same places, no matter how they were formatted.
+    """
+    pairs = [(first, second)]
+    while pairs:
+        first, second = pairs.pop()
+        if isinstance(first, Node):
+            # Columnar proxies stand for nodes of their base class.
+            if (not isinstance(second, Node)
+                    or getattr(first, 'base_class', type(first))
+                    is not getattr(second, 'base_class', type(second))
+                    or len(first) != len(second)):
+                return False
+            pairs.extend(zip(first.contents, second.contents))
+        elif type(first) is not type(second) or first != second:
+            return False
+    return True
+
+def format_file(path, write=True, show_diff=False):
+    """
+    Parses and renders the file at 'path', writing the result back if it
+    changed and 'write' is true. Returns a tuple (path, changed, message),
+    where 'message' is the diff if 'show_diff' is true, or the error if the
+    file couldn't be parsed, in which case 'changed' is None. The same
+    happens if the formatted text doesn't parse back to the same tree, so
+    a rendering bug can't corrupt the file. Only the outcome is returned, so
+    workers don't send the whole text back.
+    """
+    try:
+        with open(path) as source_file:
+            original = source_file.read()
+        editor = Editor.from_file(path)
+        formatted = ''.join(editor.root.iter_render(editor._file_wrapper))
+    except Exception as e:
+        return path, None, '{}: {}'.format(type(e).__name__, e)
+
+    if formatted == original:
+        return path, False, ''
+    try:
+        reparsed = Editor.from_string(formatted, editor.ext).root
+    except Exception as e:
+        return path, None, ("formatted text doesn't parse, left unchanged: "
+                            '{}: {}'.format(type(e).__name__, e))
+    if not same_tree(editor.root, reparsed):
+        return path, None, ('formatted text parses to a different tree, '
+                            'left unchanged')
+    if write:
+        editor.save()
+    return path, True, diff(path, original, formatted) if show_diff else ''
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(prog='python -m core.format',
+                                     description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('paths', nargs='+', help='files or directories')
+    parser.add_argument('--check', action='store_true',
+                        help="report files that would change, without writing them")
+    parser.add_argument('--diff', action='store_true',
+                        help="print the changes as a diff, without writing them")
+    parser.add_argument('--extensions', default='lua,json',
+                        help='comma separated extensions of the files searched '
+                             'in directories (default: %(default)s)')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help='number of worker processes (default: %(default)s)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help="don't read or write the parse cache")
+    options = parser.parse_args(arguments)
+
+    start = perf_counter()
+    paths = list(find_files(options.paths, options.extensions.split(',')))
+    write = not (options.check or options.diff)
+    cache_directory = '' if options.no_cache else parse_cache.directory
+
+    changed = errors = 0
+    with ProcessPoolExecutor(options.jobs, initializer=parse_cache.set_directory,
+                             initargs=(cache_directory,)) as pool:
+        chunksize = max(1, len(paths) // (options.jobs * 4))
+        results = pool.map(format_file, paths, [write] * len(paths),
+                           [options.diff] * len(paths), chunksize=chunksize)
+        for path, file_changed, message in results:
+            if file_changed is None:
+                errors += 1
+                print('error: {}: {}'.format(path, message), file=sys.stderr)
+            elif file_changed:
+                changed += 1
+                if options.diff:
+                    sys.stdout.write(message)
+                elif options.check:
+                    print('would reformat {}'.format(path))
+                else:
+                    print('reformatted {}'.format(path))
+
+    seconds = perf_counter() - start
+    print('{} files, {} {}, {} errors in {:.2f} s ({:.0f} files/s)'.format(
+        len(paths), changed, 'reformatted' if write else 'would change',
+        errors, seconds, len(paths) / seconds), file=sys.stderr)
+    return 1 if errors or (changed and not write) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,32 +1,183 @@
 from . import config
+from languages.structures import Node, Block, Layout, flatten, is_multiline
+from difflib import SequenceMatcher
 import re
 from os import path
 from sys import argv
 
+# Functions of the page that apply patches and move the selection, so an
+# update takes a single call into the page.
+script = """
+function node(id) { return document.getElementById(id); }
+
+function fragment(html) {
+    var holder = document.createElement('span');
+    holder.innerHTML = html;
+    return holder;
+}
+
+function patch(patches) {
+    for (var i = 0; i < patches.length; i++) {
+        var p = patches[i];
+        if (p[0] == 'replace') {
+            node(p[1]).outerHTML = p[2];
+        } else {
+            // Replaces the elements of p[1] between p[2] and p[3].
+            var parent = node(p[1]);
+            var end = p[3] === null ? null : node(p[3]);
+            var current = p[2] === null ? parent.firstChild : node(p[2]).nextSibling;
+            while (current !== end) {
+                var next = current.nextSibling;
+                parent.removeChild(current);
+                current = next;
+            }
+            var holder = fragment(p[4]);
+            while (holder.firstChild) {
+                parent.insertBefore(holder.firstChild, end);
+            }
+        }
+    }
+}
+
+function select(id) {
+    var old = document.querySelectorAll('.selected, .sibling');
+    for (var i = 0; i < old.length; i++) {
+        old[i].classList.remove('selected', 'sibling');
+    }
+    var selected = node(id);
+    var parent = selected.parentNode;
+    if (parent.tagName == 'SPAN') {
+        for (var child = parent.firstElementChild; child; child = child.nextElementSibling) {
+            if (child.tagName == 'SPAN') {
+                child.classList.add('sibling');
+            }
+        }
+    }
+    selected.classList.remove('sibling');
+    selected.classList.add('selected');
+    if (selected.scrollIntoViewIfNeeded) {
+        selected.scrollIntoViewIfNeeded();
+    } else {
+        selected.scrollIntoView();
+    }
+}
+
+// Ids of the placeholders within a screen of the viewport. They are in
+// document order, so the first one is found by a binary search.
+function placeholders() {
+    var all = document.getElementsByClassName('placeholder');
+    var top = -window.innerHeight;
+    var bottom = 2 * window.innerHeight;
+    var low = 0;
+    var high = all.length;
+    while (low < high) {
+        var middle = (low + high) >> 1;
+        if (all[middle].getBoundingClientRect().bottom < top) {
+            low = middle + 1;
+        } else {
+            high = middle;
+        }
+    }
+    var ids = [];
+    for (var i = low; i < all.length; i++) {
+        if (all[i].getBoundingClientRect().top > bottom) {
+            break;
+        }
+        ids.push(all[i].id);
+    }
+    return ids;
+}
+
+// Clicks are reported for the innermost node under the pointer, through the
+// object added to the page by the editor.
+document.addEventListener('click', function (event) {
+    var target = event.target;
+    while (target && target.tagName != 'SPAN') {
+        target = target.parentNode;
+    }
+    if (target && window.editor) {
+        window.editor.clicked(parseInt(target.id));
+    }
+});
+
+// Scrolling by any means (wheel, keys, scroll bar) is reported at most once
+// every 50 ms, so the editor fills the placeholders coming into view.
+var scrollReported = false;
+window.addEventListener('scroll', function () {
+    if (scrollReported || !window.editor) {
+        return;
+    }
+    scrollReported = true;
+    window.setTimeout(function () {
+        scrollReported = false;
+        window.editor.scrolled();
+    }, 50);
+});
+
+function update(patches, selected) {
+    patch(patches);
+    select(selected);
+}
+"""
+
+def newlines(layout):
+    """ Returns the number of line breaks in the text of 'layout'. """
+    count = 0
+    stack = [layout]
+    while stack:
+        piece = stack.pop()
+        if isinstance(piece, str):
+            count += piece.count('\n')
+        else:
+            stack.extend(piece.pieces)
+    return count
+
+def depth(node):
+    """ Returns the number of indented blocks that contain 'node'. """
+    count = 0
+    node = node.parent
+    while node is not None:
+        if isinstance(node, Block) and node.indented:
+            count += 1
+        node = node.parent
+    return count
+
 class HtmlRendering(object):
+    """
+    HTML page of a tree, with each node in a span whose id is the node id
+    and whose class is the node's class name.
+    The 'selected' and 'sibling' classes are set by the page's script
+    instead of being rendered, so the HTML of a node depends only on its own
+    subtree and is memoized like the text renderings.
+    """
     def __init__(self, root, selected=None):
-        self.selected = selected
+        self.root = root
+        self.selected = selected or root
+        self.template_wrapper = config.wrapper('Display Templates')
         template = """<html>
         <head>
             <link href="file://{}" type="text/css" rel="stylesheet"/>
+            <script>{}</script>
         </head>
-        <body><pre>{}</pre></body>
+        <body><pre>{}</pre><script>select({});</script></body>
 </html>"""
         css = path.abspath(path.join(path.dirname(argv[0]), 'config', 'style.css'))
-        self.html = template.format(css, root.render(self._process_node))
+        self.html = template.format(css, script, self._body(),
+                                    self.selected.node_id)
+
+    def _body(self):
+        """ Returns the HTML of the tree, placed in the page's body. """
+        return self.root.render(self._process_node)
 
     def _span_tags(self, node):
         """
         Returns the opening and closing span tags containing the background
-        style for the given node.
+        style for the given node. Attributes are left unquoted to keep the
+        page small.
         """
-        classes = [type(node).__name__.lower()]
-        if node == self.selected:
-            classes.append('selected')
-        elif node.parent == self.selected.parent:
-            classes.append('sibling')
-
-        return '<span class="{}">'.format(' '.join(classes)), '</span>'
+        class_name = type(node).__name__.lower()
+        return ('<span id={} class={}>'.format(node.node_id, class_name),
+                '</span>')
 
     def _make_parts(self, node):
         """
@@ -35,8 +186,7 @@ class HtmlRendering(object):
         """
         open_span, close_span = self._span_tags(node)
 
-        class_name = type(node).__name__
-        template = config.get('Display Templates', class_name, node.template)
+        template = self.template_wrapper(node)
 
         # Span tags change the background, but there's no background in empty
         # nodes. So we replace it with a single space.
@@ -52,37 +202,408 @@ class HtmlRendering(object):
         return ''.join(self._make_parts(node))
 
 class LinkedRendering(HtmlRendering):
+    """
+    HTML rendering for selecting nodes by clicking them, where the page
+    reports the id of the clicked span. It keeps the structure of the tree
+    as last rendered, so 'patches' can update the page after the tree
+    changes.
+    """
     def __init__(self, root, selected=None):
+        # Dictionary of all nodes by id, to be used when the user clicks on
+        # any of the nodes.
         self.node_dict = {}
+        # Maps the id of each rendered node to its literals (see
+        # '_literals') and the ids of its children, or the values for
+        # contents that are not nodes.
+        self.structure = {}
+        # Nodes shown as placeholders instead of their HTML, with the
+        # placeholder, by id. Their subtrees are recorded when filled.
+        self.hidden = {}
         super(LinkedRendering, self).__init__(root, selected)
+        self._record(root)
 
-    def _link_tags(self, node):
+    def reveal(self, node):
         """
-        Returns the opening and closing link tags, with user-specified style,
-        for the given node.
+        Returns the patches that put 'node' in the page. All the nodes are
+        in the page of this rendering.
         """
-        template = '<a id="{id}" href="{id}">'
-        return template.format(id=node.node_id), '</a>'
+        return []
 
-    def _make_parts(self, node):
+    def fill(self, node_ids):
         """
-        Returns the node's template with link and span tags added.
+        Returns the patches that fill the placeholders with the given ids.
+        This rendering has no placeholders.
         """
-        parts = super(LinkedRendering, self)._make_parts(node)
-        open_span, template, close_span = parts
+        return []
 
-        # Dictionary of all nodes and their corresponding urls, to be used when
-        # the user clicks on any of the links.
-        self.node_dict[node.node_id] = node
+    def _items(self, node):
+        return tuple(item.node_id if isinstance(item, Node) else (item,)
+                     for item in node.contents)
 
-        if node.parent:
-            parent_open, parent_close = self._link_tags(node.parent)
-        else:
-            parent_open, parent_close = '', ''
+    def _is_layout_of(self, piece, child, text):
+        """
+        Returns true if the layout 'piece' is the HTML of 'child', whose
+        current layout is 'text'.
+        """
+        if piece is text:
+            return True
+        # Children rendered again on every call have a new layout each time,
+        # so they are recognized by their opening tags.
+        return (not child.cacheable and piece.pieces and
+                isinstance(piece.pieces[0], str) and
+                piece.pieces[0].startswith(self._span_tags(child)[0]))
+
+    def _literals(self, node):
+        """
+        Returns the text of the HTML of 'node' before, between and after its
+        child nodes, as a tuple with one more item than there are children.
+        Returns None if the HTML doesn't contain all the children, as in nodes
+        with their own '_render' that leave some out.
+        """
+        wrapper = self._process_node
+        children = [item for item in node.contents if isinstance(item, Node)]
+        texts = [child.layout(wrapper) for child in children]
+        literals = []
+        current = []
+        found = 0
+        stack = [node.layout(wrapper)]
+        while stack:
+            piece = stack.pop()
+            if isinstance(piece, str):
+                # Every child's HTML has its own id, so it can't be mistaken
+                # for other text.
+                position = 0
+                while found < len(texts) and isinstance(texts[found], str):
+                    start = piece.find(texts[found], position)
+                    if start == -1:
+                        break
+                    current.append(piece[position:start])
+                    literals.append(''.join(current))
+                    current = []
+                    position = start + len(texts[found])
+                    found += 1
+                current.append(piece[position:])
+            elif (found < len(texts) and
+                    self._is_layout_of(piece, children[found], texts[found])):
+                literals.append(''.join(current))
+                current = []
+                found += 1
+            else:
+                stack.extend(reversed(piece.pieces))
+
+        if found < len(texts):
+            return None
+        literals.append(''.join(current))
+        return tuple(literals)
 
-        open_a, close_a = self._link_tags(node)
+    def _record(self, node):
+        """ Remembers the structure of the subtree of 'node'. """
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            self.node_dict[node.node_id] = node
+            if node.node_id in self.hidden:
+                self.structure[node.node_id] = (None, ())
+                continue
+            self.structure[node.node_id] = (self._literals(node),
+                                            self._items(node))
+            stack.extend(item for item in node.contents
+                         if isinstance(item, Node))
 
-        # Close parent's href tag to avoid nested links.
-        return (parent_close, open_span, open_a,
-                template,
-                close_a, close_span, parent_open)
+    def _forget(self, node_id):
+        """ Forgets the subtree of the node with id 'node_id'. """
+        stack = [node_id]
+        while stack:
+            node_id = stack.pop()
+            literals, items = self.structure.pop(node_id)
+            del self.node_dict[node_id]
+            stack.extend(item for item in items if not isinstance(item, tuple))
+
+    def _html(self, node):
+        """
+        Returns the HTML of the span of 'node', as it is in the page.
+        """
+        return flatten(node.layout(self._process_node), depth(node))
+
+    def _splice_html(self, node, after, before):
+        """
+        Returns the HTML between the children 'after' and 'before' of
+        'node', or its start or end if they are None.
+        """
+        open_span, close_span = self._span_tags(node)
+        html = self._html(node)
+        start = len(open_span)
+        end = len(html) - len(close_span)
+        if after is not None:
+            start = html.index(self._span_tags(after)[0])
+            start += len(self._html(after))
+        if before is not None:
+            end = html.index(self._span_tags(before)[0], start)
+        return html[start:end]
+
+    def patches(self):
+        """
+        Returns the list of changes to the page since the last call, found
+        by walking only the nodes whose memoized HTML was discarded. Each
+        patch is either ('replace', node_id, html), replacing a node, or
+        ('splice', node_id, after_id, before_id, html), replacing the
+        children of a node between two of them (or the start or end).
+        """
+        wrapper = self._process_node
+        dirty = set()
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if not node.has_layout(wrapper):
+                dirty.add(node)
+                stack.extend(item for item in node.contents
+                             if isinstance(item, Node))
+        self.root.layout(wrapper)
+
+        # Changes found, with nodes instead of HTML. Removed nodes are
+        # forgotten before any is recorded, as they may have been moved.
+        changes = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node not in dirty:
+                continue
+
+            literals, items = self.structure[node.node_id]
+            new_literals = self._literals(node)
+            new_items = self._items(node)
+            values_changed = items != new_items and any(
+                isinstance(item, tuple) for item in items + new_items)
+            if literals is None or new_literals is None or values_changed:
+                self._forget(node.node_id)
+                changes.append(('replace', node.node_id, node))
+                continue
+
+            children = [item for item in node.contents if isinstance(item, Node)]
+            old_ids = [item for item in items if not isinstance(item, tuple)]
+            new_ids = [item for item in new_items if not isinstance(item, tuple)]
+            matcher = SequenceMatcher(None, old_ids, new_ids, autojunk=False)
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+                after = children[j1 - 1] if j1 > 0 else None
+                before = children[j2] if j2 < len(children) else None
+                if tag != 'equal':
+                    for item in old_ids[i1:i2]:
+                        self._forget(item)
+                    changes.append(('splice', node, after, before,
+                                    children[j1:j2]))
+                    continue
+
+                stack.extend(children[j1:j2])
+                # Text between unchanged children, and at the start or end of
+                # the node, is spliced if it changed.
+                first = j1 if j1 == i1 == 0 else j1 + 1
+                last = j2 if (j2, i2) == (len(new_ids), len(old_ids)) else j2 - 1
+                for j in range(first, last + 1):
+                    if literals[i1 + j - j1] != new_literals[j]:
+                        changes.append(('splice', node,
+                                        children[j - 1] if j > 0 else None,
+                                        children[j] if j < len(children) else None,
+                                        []))
+            if not old_ids and not new_ids and literals != new_literals:
+                changes.append(('splice', node, None, None, []))
+            self.structure[node.node_id] = (new_literals, new_items)
+
+        patches = []
+        for change in changes:
+            if change[0] == 'replace':
+                tag, node_id, node = change
+                self._record(node)
+                patches.append(('replace', node_id, self._html(node)))
+            else:
+                tag, node, after, before, inserted = change
+                patches.append(('splice', node.node_id,
+                                after.node_id if after is not None else None,
+                                before.node_id if before is not None else None,
+                                self._splice_html(node, after, before)))
+                for child in inserted:
+                    self._record(child)
+        return patches
+
+class VirtualRendering(LinkedRendering):
+    """
+    Linked rendering for large trees, where only the children of a list
+    around the viewport are in the page. The list is the root, or the first
+    node with several children below it, as in JSON documents made of a
+    single array of records. The other children are empty placeholders, and
+    are filled as they are scrolled into view (see 'fill' and the page's
+    'placeholders' function). Only the first 'lines' lines are rendered at
+    first, and hidden children are neither rendered nor built if they are
+    lazy.
+    """
+    def __init__(self, root, selected=None, lines=300):
+        self.lines = lines
+        # Ids of the children of the list that are in the page.
+        self.shown = set()
+        self.list = root
+        # The last layout of the list and its literals, which are looked at
+        # by '_body' and again when the page is recorded.
+        self.list_literals = (None, None)
+        super(VirtualRendering, self).__init__(root, selected)
+
+    def _list(self):
+        """
+        Returns the node whose children are virtualized: the root, or the
+        first node with several children down the last children of the
+        nodes with a single one and of static structures.
+        """
+        node = self.root
+        while True:
+            children = [item for item in node.contents if isinstance(item, Node)]
+            if not children or (len(children) > 1 and hasattr(node, 'insert')):
+                return node
+            node = children[-1]
+
+    def _top(self, node):
+        """
+        Returns the child of the list containing 'node', or None if 'node'
+        is not inside the list.
+        """
+        while node.parent is not None and node.parent is not self.list:
+            node = node.parent
+        return node if node.parent is self.list else None
+
+    def _above_list(self, node):
+        """ Returns true if 'node' is the list or one of its ancestors. """
+        current = self.list
+        while current is not None:
+            if current is node:
+                return True
+            current = current.parent
+        return False
+
+    def _literals(self, node):
+        if node is not self.list:
+            return super(VirtualRendering, self)._literals(node)
+        layout = node.layout(self._process_node)
+        if self.list_literals[0] is not layout:
+            self.list_literals = (
+                layout, super(VirtualRendering, self)._literals(node))
+        return self.list_literals[1]
+
+    def _placeholder(self, node, lines=None):
+        """
+        Returns the HTML of the placeholder of the child 'node', with as many
+        lines as its HTML unless 'lines' is given.
+        """
+        if lines is None:
+            lines = newlines(node.layout(self._process_node))
+        return '<span id={} class=placeholder>{}</span>'.format(
+            node.node_id, '\n' * lines)
+
+    def _unhide(self, node_id):
+        """
+        Forgets the placeholder of the hidden node with id 'node_id', which
+        was memoized as its HTML.
+        """
+        node, placeholder = self.hidden.pop(node_id)
+        wrapper = self._process_node
+        if node.has_layout(wrapper) and node.layout(wrapper) is placeholder:
+            node.forget_layouts()
+
+    def _body(self):
+        wrapper = self._process_node
+        if self.hidden:
+            for node_id in list(self.hidden):
+                self._unhide(node_id)
+            self.list.mark_dirty()
+        self.list = self._list()
+        top = self._top(self.selected)
+        if top is not None:
+            self.shown.add(top.node_id)
+
+        hidden = []
+        lines = shown = 0
+        for child in self.list.contents:
+            if not isinstance(child, Node):
+                continue
+            if lines < self.lines or child.node_id in self.shown:
+                self.shown.add(child.node_id)
+                lines += newlines(child.layout(wrapper)) + 1
+                shown += 1
+            else:
+                hidden.append(child)
+
+        if hidden:
+            # The placeholders are memoized as the HTML of the hidden children,
+            # so the page is rendered without them. They get the average
+            # height of the shown children.
+            height = max(1, round((lines - shown) / max(shown, 1)))
+            for child in hidden:
+                placeholder = self._placeholder(child, height)
+                self.hidden[child.node_id] = (child, placeholder)
+                child.set_layout(wrapper, placeholder)
+            self.list.mark_dirty()
+            if self._literals(self.list) is None:
+                # The list's own '_render' leaves some children out, so their
+                # placeholders wouldn't be in the page. They are rendered whole.
+                for child in hidden:
+                    self._unhide(child.node_id)
+                    self.shown.add(child.node_id)
+                self.list.mark_dirty()
+        return flatten(self.root.layout(wrapper))
+
+    def reveal(self, node):
+        top = self._top(node)
+        return self.fill([top.node_id]) if top is not None else []
+
+    def fill(self, node_ids):
+        patches = []
+        reshaped = False
+        for node_id in node_ids:
+            node = self.node_dict.get(node_id)
+            if (node_id in self.shown or node is None or
+                    node.parent is not self.list):
+                continue
+            self.shown.add(node_id)
+            if node_id in self.hidden:
+                self._unhide(node_id)
+                self._record(node)
+                # Placeholders span several lines, and the text around a
+                # child may depend on that, as in blocks.
+                reshaped = reshaped or not is_multiline(
+                    node.layout(self._process_node))
+            patches.append(('replace', node_id, self._html(node)))
+        if reshaped:
+            self.list.mark_dirty()
+            patches.extend(self.patches())
+        return patches
+
+    def patches(self):
+        """
+        Returns the patches of LinkedRendering.patches for the nodes in the
+        page. Changes inside placeholders only update their number of lines.
+        """
+        result = []
+        resized = set()
+        for patch in super(VirtualRendering, self).patches():
+            node = self.node_dict[patch[1]]
+            top = self._top(node)
+            if top is None:
+                if patch[0] == 'replace' and self._above_list(node):
+                    self.shown.clear()
+                    html = self._body()
+                    self._forget(self.root.node_id)
+                    self._record(self.root)
+                    patch = ('replace', self.root.node_id, html)
+                elif patch[0] == 'splice' and node is self.list:
+                    # Children inserted by a splice are in its HTML.
+                    tag, node_id, after, before, html = patch
+                    start, end = 0, len(node)
+                    if after is not None:
+                        start = node.index_of(self.node_dict[after]) + 1
+                    if before is not None:
+                        end = node.index_of(self.node_dict[before])
+                    self.shown.update(child.node_id for child in node[start:end]
+                                      if child.node_id not in self.hidden)
+                result.append(patch)
+            elif top.node_id in self.shown:
+                result.append(patch)
+            elif top.node_id not in resized:
+                resized.add(top.node_id)
+                result.append(('replace', top.node_id, self._placeholder(top)))
+        return result
@@ -0,0 +1,175 @@
+"""
+Persistent cache of parsed trees, so reopening an unchanged file (or the same
+file in another place) skips parsing.
+
+Trees are stored in the binary format of languages.structures.dump, in one
+file per (language, parser version, content hash) in the cache directory.
+The parser version is a digest of the sources in the
+'languages' package, so changing any parser or structure invalidates the old
+entries. Reading an entry updates its modification time, and the least
+recently used entries are removed when the directory grows beyond its size
+limit.
+"""
+import os
+import io
+import hashlib
+import tempfile
+from time import perf_counter
+from languages import structures
+from . import config
+
+# Directory of the cache files, or an empty string to disable the cache.
+directory = config.get('Parsing', 'cache directory',
+                       os.path.join(os.path.expanduser('~'),
+                                    '.structured-editor', 'parse-cache'))
+# Maximum total size of the cache files, in bytes.
+max_size = int(config.get('Parsing', 'cache size', 100)) * 1024 * 1024
+# Entries larger than this, in bytes, are memory-mapped and their nodes are
+# only built when accessed (see structures.map_tree), instead of loaded.
+map_size = int(config.get('Parsing', 'cache map size', 1)) * 1024 * 1024
+
+# Counters and accumulated seconds, for benchmarks and diagnostics.
+stats = {'hits': 0, 'misses': 0, 'mapped': 0, 'errors': 0, 'evictions': 0,
+         'load_seconds': 0.0, 'parse_seconds': 0.0, 'store_seconds': 0.0}
+
+# Total size of the cache files when the directory was last scanned, plus the
+# entries stored since, and the directory it belongs to. Entries written by
+# other processes are only counted on the next scan.
+_total_size = None
+_total_directory = None
+
+_parser_version = None
+def parser_version():
+    """ Returns a digest of the source files of the 'languages' package. """
+    global _parser_version
+    if _parser_version is None:
+        folder = os.path.join(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))), 'languages')
+        digest = hashlib.sha1()
+        for name in sorted(os.listdir(folder)):
+            if name.endswith('.py'):
+                digest.update(name.encode('utf-8'))
+                with open(os.path.join(folder, name), 'rb') as source_file:
+                    digest.update(source_file.read())
+        _parser_version = digest.hexdigest()[:16]
+    return _parser_version
+
+def path_for(language, text):
+    """ Returns the path of the cache file for 'text' in 'language'. """
+    digest = hashlib.sha256(text.encode('utf-8', 'surrogatepass'))
+    name = '{}-{}-{}.tree'.format(language, parser_version(),
+                                  digest.hexdigest())
+    return os.path.join(directory, name)
+
+def load(path):
+    """ Returns the tree stored in 'path', or None if there is none. """
+    start = perf_counter()
+    try:
+        if os.path.getsize(path) > map_size:
+            root = structures.map_tree(path)
+            stats['mapped'] += 1
+        else:
+            with open(path, 'rb') as cache_file:
+                root = structures.load(cache_file)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        # Truncated or otherwise unreadable entries are parsed again.
+        stats['errors'] += 1
+        return None
+    stats['load_seconds'] += perf_counter() - start
+
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return root
+
+def store(path, root):
+    """
+    Writes 'root' to 'path', replacing the file atomically so concurrent
+    readers never see a partial entry. Failures are ignored. Old entries are
+    only evicted when the running total of the cache size exceeds the limit.
+    """
+    global _total_size
+    start = perf_counter()
+    data = io.BytesIO()
+    try:
+        structures.dump(root, data)
+    except ValueError:
+        # Values the format can't hold, parsed again next time.
+        stats['errors'] += 1
+        return
+
+    try:
+        os.makedirs(directory, exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(handle, 'wb') as temp_file:
+            size = temp_file.write(data.getbuffer())
+        os.replace(temp_path, path)
+    except OSError:
+        stats['errors'] += 1
+        return
+    stats['store_seconds'] += perf_counter() - start
+    if _total_size is None or _total_directory != directory:
+        evict()
+    else:
+        _total_size += size
+        if _total_size > max_size:
+            evict()
+
+def evict():
+    """
+    Removes the least recently used entries until the total size of the
+    cache is within 'max_size', and updates the running total.
+    """
+    global _total_size, _total_directory
+    entries = []
+    total = 0
+    for entry in os.scandir(directory):
+        if entry.name.endswith('.tree'):
+            info = entry.stat()
+            entries.append((info.st_mtime, info.st_size, entry.path))
+            total += info.st_size
+
+    entries.sort()
+    for mtime, size, path in entries:
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        stats['evictions'] += 1
+    _total_size = total
+    _total_directory = directory
+
+def set_directory(path):
+    """
+    Sets the cache directory. Used as the initializer of worker processes,
+    so they share the cache of the process that started them.
+    """
+    global directory
+    directory = path
+
+def parse(language, parser, text):
+    """
+    Returns the tree of 'text' parsed by the module 'parser', loading it
+    from the cache if it was parsed before and storing it otherwise.
+    """
+    if not directory:
+        return parser.parse_string(text)
+
+    path = path_for(language, text)
+    root = load(path)
+    if root is not None:
+        stats['hits'] += 1
+        return root
+
+    stats['misses'] += 1
+    start = perf_counter()
+    root = parser.parse_string(text)
+    stats['parse_seconds'] += perf_counter() - start
+    store(path, root)
+    return root
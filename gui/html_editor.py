@@ -1,13 +1,19 @@
 from PyQt5 import QtWebKit, QtCore
-from PyQt5.QtWebKitWidgets import QWebView, QWebPage
+from PyQt5.QtWebKitWidgets import QWebView
 from PyQt5.QtWidgets import QMessageBox, QFileDialog
 from time import time
 from os import path
+import json
 from sys import argv
 
+from core import config
 from core.editor import Editor
 from core.actions import Select
-from core.html_renderer import LinkedRendering
+from core.html_renderer import LinkedRendering, VirtualRendering
+
+# Lines rendered when a page is loaded. The rest of the document is filled in
+# as it is scrolled into view. Zero renders whole documents.
+virtual_lines = int(config.get('Display', 'virtual lines', 300))
 
 class GraphicalEditor(Editor):
     """
@@ -76,6 +82,24 @@ class GraphicalEditor(Editor):
             return self.save_as()
 
 
+class PageBridge(QtCore.QObject):
+    """
+    Object added to the editor's page as 'window.editor', through which the
+    page's handlers report the clicked nodes and scrolling.
+    """
+    def __init__(self, editor):
+        super(PageBridge, self).__init__(editor.web)
+        self.editor = editor
+
+    @QtCore.pyqtSlot(int)
+    def clicked(self, node_id):
+        self.editor._selection_handler(node_id)
+
+    @QtCore.pyqtSlot()
+    def scrolled(self):
+        self.editor._fill_view()
+
+
 class HtmlEditor(GraphicalEditor):
     """
     Graphical editor that displays the code in HTML, allowing the user to click
@@ -85,10 +109,11 @@ class HtmlEditor(GraphicalEditor):
         super(HtmlEditor, self).__init__(root, language, selected_file)
 
         self.refresh_handler = refresh_handler
-        self.old_selected = None
+        self.rendering = None
 
-        self.web.page().setLinkDelegationPolicy(QWebPage.DelegateAllLinks)
-        self.web.linkClicked.connect(self._selection_handler)
+        self.bridge = PageBridge(self)
+        frame = self.web.page().mainFrame()
+        frame.javaScriptWindowObjectCleared.connect(self._add_bridge)
 
         self.lastClickTime = time()
         self.lastClickNode = None
@@ -101,20 +126,26 @@ class HtmlEditor(GraphicalEditor):
         self.web.page().settings().setMaximumPagesInCache(0)
         self.web.page().settings().setObjectCacheCapacities(0, 0, 0)
 
-        self.web.page().mainFrame().contentsSizeChanged.connect(self._auto_scroll)
-
-    def _auto_scroll(self, contents_size):
-        self.web.page().mainFrame().scrollToAnchor(str(self.selected.node_id))
+        # Scrolling in the page is also reported through the bridge, as
+        # scrollRequested isn't emitted for every way of scrolling.
+        self.web.loadFinished.connect(self._fill_view)
+        self.web.page().scrollRequested.connect(self._fill_view)
 
     def style_updated(self, path):
-        self.web.setHtml(self.rendering.html)
+        # The page is rendered again, as it was patched since it was loaded.
+        self.rendering = None
+        self.refresh()
         
-    def _selection_handler(self, url):
+    def _add_bridge(self):
+        # Window objects are cleared whenever a page is loaded.
+        frame = self.web.page().mainFrame()
+        frame.addToJavaScriptWindowObject('editor', self.bridge)
+
+    def _selection_handler(self, node_id):
         """
-        Select the node corresponding to the given url, or its parent when
-        clicked multiple times.
+        Select the node with the given id, or its parent when clicked
+        multiple times.
         """
-        node_id = int(path.basename(url.toString()))
         node_clicked = self.rendering.node_dict[node_id]
         node_selected = node_clicked
 
@@ -138,7 +169,10 @@ class HtmlEditor(GraphicalEditor):
 
     def execute(self, action):
         super(HtmlEditor, self).execute(action)
-        self.refresh()
+        if action.alters:
+            self.refresh()
+        else:
+            self.refresh_selection()
 
     def undo(self):
         super(HtmlEditor, self).undo()
@@ -148,11 +182,52 @@ class HtmlEditor(GraphicalEditor):
         super(HtmlEditor, self).redo()
         self.refresh()
 
+    def _fill_view(self, *args):
+        """
+        Fills the placeholders near the viewport, after the page is loaded or
+        scrolled.
+        """
+        if self.rendering is None:
+            return
+        frame = self.web.page().mainFrame()
+        node_ids = frame.evaluateJavaScript('placeholders()') or []
+        patches = self.rendering.fill([int(node_id) for node_id in node_ids])
+        if patches:
+            frame.evaluateJavaScript('patch({})'.format(json.dumps(patches)))
+
+    def _update(self, patches):
+        patches += self.rendering.reveal(self.selected)
+        script = 'update({}, {})'.format(json.dumps(patches),
+                                         self.selected.node_id)
+        self.web.page().mainFrame().evaluateJavaScript(script)
+
     def refresh(self):
         """
-        Renders tree state in HTML.
+        Updates the page with the changes to the tree since the last refresh,
+        in a single script call. The whole page is only rendered when a new
+        tree is shown.
+        """
+        if self.rendering is None or self.rendering.root is not self.root:
+            if virtual_lines:
+                self.rendering = VirtualRendering(self.root, self.selected,
+                                                  virtual_lines)
+            else:
+                self.rendering = LinkedRendering(self.root, self.selected)
+            self.web.setHtml(self.rendering.html)
+        else:
+            self._update(self.rendering.patches())
+            # Patches may have moved other placeholders into view.
+            self._fill_view()
+        self.refresh_handler()
+
+    def refresh_selection(self):
+        """
+        Moves the selection in the page to the selected node, for actions
+        that don't change the tree. Nothing is rendered, unless the node was
+        in a placeholder.
         """
-        html = LinkedRendering(self.selected, self.selected).html
-        print(html)
-        self.web.page().mainFrame().findFirstElement('#{}'.format(self.selected.node_id)).setOuterXml(html)
+        if self.rendering is None:
+            return self.refresh()
+        self._update([])
+        self._fill_view()
         self.refresh_handler()
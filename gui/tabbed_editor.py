@@ -7,6 +7,7 @@ repositioning tabs, close buttons, hotkeys (Ctrl+W and Ctrl+T), etc. "save",
 from PyQt5 import QtCore, QtGui, QtWidgets
 from pyparsing import ParseException
 from gui.html_editor import HtmlEditor
+from core import background
 from os.path import dirname, abspath
 import traceback
 
@@ -178,25 +179,52 @@ class TabbedEditor(QtWidgets.QTabWidget):
         selected by the user.
         """
         filters = 'Python files (*.py);;Lua files (*.lua);;Lisp files (*.lisp);;JSON files (*.json);;All files (*.*)';
-        path, filter = QtWidgets.QFileDialog.getOpenFileName(self,
+        paths, filter = QtWidgets.QFileDialog.getOpenFileNames(self,
                 directory=self.last_dir,
                 filter=filters,
                 initialFilter=self.last_selected_filter)
 
-        if not path:
+        if not paths:
             return
 
         self.last_selected_filter = filter
-        self.last_dir = dirname(path)
+        self.last_dir = dirname(paths[0])
+        self.open_files(paths)
 
-        try:
-            self.add(HtmlEditor.from_file(path))
-        except Exception as e:
-            print(traceback.format_exc())
-
-            title = 'Error opening {}'.format(path)
-            text = 'Exception encountered while opening {}:\n\n{}.\n\nThe full traceback has been printed to stdout.'.format(path, e)
-            QtWidgets.QMessageBox.critical(self, title, text)
+    def open_files(self, paths):
+        """
+        Opens the files in 'paths' in new tabs. They are parsed in worker
+        processes (see core.background), and each tab is added as soon as its
+        file is parsed. A progress dialog allows cancelling the files that
+        were not opened yet.
+        """
+        batch = background.Batch(paths, HtmlEditor)
+        progress = QtWidgets.QProgressDialog('Opening files...', 'Cancel', 0,
+                                             batch.total, self)
+        progress.setMinimumDuration(500)
+        progress.canceled.connect(batch.cancel)
+
+        timer = QtCore.QTimer(self)
+        def poll():
+            for path, editor, error in batch.poll():
+                if error is None:
+                    self.add(editor)
+                else:
+                    self.show_open_error(path, error)
+            progress.setValue(batch.finished)
+            if batch.done:
+                timer.stop()
+                timer.deleteLater()
+        timer.timeout.connect(poll)
+        timer.start(20)
+
+    def show_open_error(self, path, e):
+        """ Reports an exception raised while opening the file at 'path'. """
+        print(''.join(traceback.format_exception(type(e), e, e.__traceback__)))
+
+        title = 'Error opening {}'.format(path)
+        text = 'Exception encountered while opening {}:\n\n{}.\n\nThe full traceback has been printed to stdout.'.format(path, e)
+        QtWidgets.QMessageBox.critical(self, title, text)
 
     def parse(self, event=None):
         """
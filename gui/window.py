@@ -95,11 +95,11 @@ class InsertionWindow(CommandsWindow):
 
         try:
             parent = editor.selected.parent
-            parent.index
+            parent.index_of
         except:
             return
 
-        index = parent.index(editor.selected)
+        index = parent.index_of(editor.selected)
         expected_cls = parent.get_expected_class(index)
         subclasses = (cls for cls in editor.structures
                       if issubclass(cls, expected_cls))
@@ -187,8 +187,8 @@ class MainEditorWindow(QtWidgets.QMainWindow):
             event.ignore()
 
     def dropEvent(self, event):
-        for url in event.mimeData().urls():
-            self.tabbedEditor.add(HtmlEditor.from_file(url.path()))
+        paths = [url.path() for url in event.mimeData().urls()]
+        self.tabbedEditor.open_files(paths)
         event.accept()
 
     def createDocks(self):
@@ -222,7 +222,9 @@ class MainEditorWindow(QtWidgets.QMainWindow):
                                 (actions.SelectChild, 'Child'),
                                 (actions.SelectNextSibling, 'Next'),
                                 (actions.SelectPrevSibling, 'Previous'),
-                                (actions.NextUnfilled, 'Next unfilled')]
+                                (lambda: actions.NextUnfilled(
+                                    self.tabbedEditor.editor().unfilled),
+                                 'Next unfilled')]
         navigationWindow = CommandsWindow('Navigation', self)
         navigationWindow.addCommands(movement_label_pairs,
                                           extractHotkeys('Movement Hotkeys',
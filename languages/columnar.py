@@ -0,0 +1,443 @@
+"""
+Columnar storage for the nodes of large documents.
+
+Instead of one object per node, with its list of contents and parent pointer,
+a ColumnarTree keeps the tree in parallel arrays indexed by row: class id,
+parent row, first child row, next sibling row, number of children, position
+in the parent and value index. Rows are nodes or the plain values (strings,
+numbers) in their contents. Leaves keep their value in their own row.
+Containers that are indexed also get an array of their children's rows, so
+len, indexing and index_of take constant time.
+
+Node objects are only created when a row is accessed, as proxies: instances of
+a subclass of the row's class, with the same name, that read and write the
+arrays. So the renderers and actions keep working unchanged. A proxy lives as
+long as something references it, and accessing a row while its proxy is
+alive returns the same object.
+
+Nodes created by the editor (new structures, pasted code) are not converted.
+They are stored in an 'external' row and keep being regular nodes.
+"""
+import weakref
+import marshal
+from array import array
+from .structures import (Node, Leaf, DynamicNode, node_ids, read_sections,
+                         value_key)
+
+# Class ids of the rows that are not proxied nodes.
+VALUE = -1
+EXTERNAL = -2
+# Row index of missing parents, children and siblings.
+NONE = -1
+
+class ColumnarTree(object):
+    """
+    Tree of nodes stored in arrays. Use 'convert' or 'load' to create one,
+    and 'root' to get the proxy of its root node.
+    """
+    def __init__(self):
+        self.classes = []
+        self.class_indexes = {}
+        self.class_ids = array('h')
+        self.parents = array('i')
+        self.first_children = array('i')
+        self.next_siblings = array('i')
+        self.child_counts = array('i')
+        self.positions = array('i')
+        self.values = array('i')
+        self.placeholders = bytearray()
+        # Values of the leaves and value rows, and the nodes of external
+        # rows, indexed by the 'values' column.
+        self.objects = []
+        self.interned = {}
+
+        self.proxies = weakref.WeakValueDictionary()
+        # Parents of rows that were inserted into regular nodes.
+        self.foreign_parents = {}
+        # State of the proxies that is only needed for some rows.
+        self.node_ids = {}
+        self.renderings = {}
+        self.other_renderings = {}
+        # Rows of the children of the containers that were indexed, built on
+        # first use and dropped when their children change.
+        self.child_arrays = {}
+
+    def add_row(self, class_id, value=NONE, placeholder=False):
+        """ Appends a detached row and returns its index. """
+        self.class_ids.append(class_id)
+        self.parents.append(NONE)
+        self.first_children.append(NONE)
+        self.next_siblings.append(NONE)
+        self.child_counts.append(0)
+        self.positions.append(NONE)
+        self.values.append(value)
+        self.placeholders.append(placeholder)
+        return len(self.class_ids) - 1
+
+    def class_id(self, cls):
+        try:
+            return self.class_indexes[cls]
+        except KeyError:
+            self.classes.append(cls)
+            index = self.class_indexes[cls] = len(self.classes) - 1
+            return index
+
+    def add_object(self, value):
+        """ Returns the index of 'value' in 'objects', reusing equal values. """
+        key = value_key(value)
+        try:
+            return self.interned[key]
+        except KeyError:
+            self.objects.append(value)
+            index = self.interned[key] = len(self.objects) - 1
+            return index
+        except TypeError:
+            # Unhashable values are stored once per use.
+            self.objects.append(value)
+            return len(self.objects) - 1
+
+    def child_rows(self, row):
+        rows = []
+        child = self.first_children[row]
+        while child != NONE:
+            rows.append(child)
+            child = self.next_siblings[child]
+        return rows
+
+    def child_array(self, row):
+        """ Returns the rows of the children of 'row', as an array. """
+        try:
+            return self.child_arrays[row]
+        except KeyError:
+            rows = self.child_arrays[row] = array('i', self.child_rows(row))
+            return rows
+
+    def link(self, row, rows):
+        """ Makes 'rows', which must be detached, the children of 'row'. """
+        previous = NONE
+        for position in range(len(rows) - 1, -1, -1):
+            child = rows[position]
+            self.parents[child] = row
+            self.next_siblings[child] = previous
+            self.positions[child] = position
+            self.foreign_parents.pop(child, None)
+            previous = child
+        self.first_children[row] = previous
+        self.child_counts[row] = len(rows)
+        self.child_arrays.pop(row, None)
+
+    def detach(self, rows):
+        """ Unlinks 'rows', which were just removed from their parent. """
+        for child in rows:
+            self.parents[child] = NONE
+            self.next_siblings[child] = NONE
+            self.positions[child] = NONE
+            if self.class_ids[child] == EXTERNAL:
+                self.objects[self.values[child]].parent = None
+
+    def row_for(self, item):
+        """
+        Returns a detached row for 'item', which may be a proxy of this tree,
+        a regular node or a value.
+        """
+        if isinstance(item, Node):
+            if getattr(item, 'tree', None) is self:
+                parent = self.parents[item.row]
+                if parent != NONE:
+                    # Moved without being removed first.
+                    rows = self.child_rows(parent)
+                    rows.remove(item.row)
+                    self.link(parent, rows)
+                    self.parents[item.row] = NONE
+                return item.row
+            self.objects.append(item)
+            return self.add_row(EXTERNAL, len(self.objects) - 1)
+        return self.add_row(VALUE, self.add_object(item))
+
+    def item(self, row):
+        """ Returns the value, node or proxy stored in 'row'. """
+        class_id = self.class_ids[row]
+        if class_id < 0:
+            return self.objects[self.values[row]]
+        try:
+            return self.proxies[row]
+        except KeyError:
+            proxy = object.__new__(proxy_class(self.classes[class_id]))
+            proxy.tree = self
+            proxy.row = row
+            self.proxies[row] = proxy
+            return proxy
+
+    def root(self):
+        return self.item(0)
+
+    def __len__(self):
+        return len(self.class_ids)
+
+proxy_classes = {}
+def proxy_class(cls):
+    """
+    Returns the class of the proxies for rows of class 'cls'. It derives
+    from 'cls' with the same name, and replaces the node's slots with
+    properties over the tree's arrays.
+    """
+    try:
+        return proxy_classes[cls]
+    except KeyError:
+        pass
+
+    namespace = dict(proxy_attributes)
+    if issubclass(cls, Leaf):
+        namespace.update(leaf_attributes)
+    else:
+        namespace.update(container_attributes)
+        if issubclass(cls, DynamicNode):
+            # Actions check for these to tell lists from static structures.
+            namespace.update({'insert': proxy_insert, 'remove': proxy_remove})
+        else:
+            namespace['add'] = namespace['add_before'] = proxy_setitem
+    namespace.update({'__slots__': ('tree', 'row', '__weakref__'),
+                      '__module__': cls.__module__,
+                      '__qualname__': cls.__qualname__,
+                      'base_class': cls})
+    proxy = proxy_classes[cls] = type(cls)(cls.__name__, (cls,), namespace)
+    return proxy
+
+def get_parent(self):
+    tree = self.tree
+    parent = tree.parents[self.row]
+    if parent == NONE:
+        return tree.foreign_parents.get(self.row)
+    return tree.item(parent)
+
+def set_parent(self, parent):
+    # Links between rows are changed by the container methods. Only regular
+    # parents need to be remembered.
+    if parent is not None and getattr(parent, 'tree', None) is not self.tree:
+        self.tree.foreign_parents[self.row] = parent
+    else:
+        self.tree.foreign_parents.pop(self.row, None)
+
+def get_node_id(self):
+    try:
+        return self.tree.node_ids[self.row]
+    except KeyError:
+        node_id = self.tree.node_ids[self.row] = next(node_ids)
+        return node_id
+
+def get_placeholder(self):
+    return bool(self.tree.placeholders[self.row])
+
+def set_placeholder(self, placeholder):
+    self.tree.placeholders[self.row] = placeholder
+
+def rendering_properties(name):
+    """
+    Returns the properties for the wrapper and text of a memoized rendering,
+    kept as (wrapper, text) pairs in the tree's dictionary 'name'.
+    """
+    def get_wrapper(self):
+        return getattr(self.tree, name).get(self.row, (None, None))[0]
+
+    def set_wrapper(self, wrapper):
+        if wrapper is None:
+            getattr(self.tree, name).pop(self.row, None)
+        else:
+            getattr(self.tree, name)[self.row] = (wrapper, None)
+
+    def get_text(self):
+        return getattr(self.tree, name).get(self.row, (None, None))[1]
+
+    def set_text(self, text):
+        wrapper = get_wrapper(self)
+        if wrapper is not None:
+            getattr(self.tree, name)[self.row] = (wrapper, text)
+
+    return property(get_wrapper, set_wrapper), property(get_text, set_text)
+
+def proxy_rebuild(cls, contents, placeholder=False):
+    # Copies are regular nodes.
+    return cls.base_class.rebuild(contents, placeholder)
+
+def proxy_reduce(self):
+    return self.base_class.rebuild, (list(self.contents), self.placeholder)
+
+proxy_attributes = {
+    'parent': property(get_parent, set_parent),
+    'node_id': property(get_node_id),
+    'placeholder': property(get_placeholder, set_placeholder),
+    'rebuild': classmethod(proxy_rebuild),
+    '__reduce__': proxy_reduce,
+    # Lazy nodes are always loaded, and positions are not remembered.
+    'loader': None,
+    'positions': None,
+}
+(proxy_attributes['cached_wrapper'],
+ proxy_attributes['cached_text']) = rendering_properties('renderings')
+(proxy_attributes['other_wrapper'],
+ proxy_attributes['other_text']) = rendering_properties('other_renderings')
+
+def get_value(self):
+    tree = self.tree
+    return tree.objects[tree.values[self.row]]
+
+def set_value(self, value):
+    self.tree.values[self.row] = self.tree.add_object(value)
+
+leaf_attributes = {'value': property(get_value, set_value)}
+
+def get_contents(self):
+    tree = self.tree
+    return [tree.item(row) for row in tree.child_rows(self.row)]
+
+def set_contents(self, contents):
+    def change(rows):
+        rows[:] = [self.tree.row_for(item) for item in contents]
+    replace_children(self, change)
+    for item in contents:
+        if isinstance(item, Node):
+            item.parent = self
+
+def proxy_getitem(self, index):
+    tree = self.tree
+    try:
+        return tree.item(tree.child_array(self.row)[index])
+    except IndexError:
+        raise IndexError('child index out of range')
+
+def proxy_len(self):
+    return self.tree.child_counts[self.row]
+
+def proxy_index_of(self, item):
+    tree = self.tree
+    if getattr(item, 'tree', None) is tree:
+        if tree.parents[item.row] == self.row:
+            return tree.positions[item.row]
+        return -1
+    # Regular nodes and values are in rows of their own, without proxies.
+    for row in tree.child_array(self.row):
+        if tree.class_ids[row] < 0 and tree.objects[tree.values[row]] is item:
+            return tree.positions[row]
+    return -1
+
+def replace_children(self, change):
+    """
+    Calls 'change' with the list of rows of the children and relinks them
+    afterwards.
+    """
+    tree = self.tree
+    rows = tree.child_rows(self.row)
+    old_rows = set(rows)
+    change(rows)
+    tree.detach(old_rows.difference(rows))
+    tree.link(self.row, rows)
+
+def proxy_setitem(self, index, item):
+    assert self.can_insert(index, item)
+    def change(rows):
+        rows[index] = self.tree.row_for(item)
+    replace_children(self, change)
+    if isinstance(item, Node):
+        item.parent = self
+        item.forget_layouts()
+    self.mark_dirty()
+
+def proxy_insert(self, index, item):
+    assert self.can_insert(index, item)
+    def change(rows):
+        rows.insert(index, self.tree.row_for(item))
+    replace_children(self, change)
+    item.parent = self
+    item.forget_layouts()
+    self.mark_dirty()
+
+def proxy_remove(self, item):
+    index = self.index_of(item)
+    if index == -1:
+        raise ValueError('{} is not a child of {}'.format(item, self))
+    def change(rows):
+        del rows[index]
+    replace_children(self, change)
+    item.parent = None
+    self.mark_dirty()
+
+container_attributes = {
+    'contents': property(get_contents, set_contents),
+    '__getitem__': proxy_getitem,
+    '__len__': proxy_len,
+    'index_of': proxy_index_of,
+    '__setitem__': proxy_setitem,
+}
+
+def convert(root):
+    """
+    Copies the tree of 'root' into a ColumnarTree and returns the proxy of
+    its root.
+    """
+    tree = ColumnarTree()
+    stack = [(root, NONE)]
+    # Rows of the children of each container, linked once all are added.
+    children = {}
+    while stack:
+        item, parent = stack.pop()
+        if isinstance(item, Leaf):
+            row = tree.add_row(tree.class_id(type(item)),
+                               tree.add_object(item.value), item.placeholder)
+        elif isinstance(item, Node):
+            row = tree.add_row(tree.class_id(type(item)),
+                               placeholder=item.placeholder)
+            children[row] = []
+            stack.extend((child, row) for child in reversed(item.contents))
+        else:
+            row = tree.add_row(VALUE, tree.add_object(item))
+        if parent != NONE:
+            children[parent].append(row)
+
+    for row, rows in children.items():
+        tree.link(row, rows)
+    return tree.root()
+
+def load(file):
+    """
+    Reads a tree written by structures.dump from the binary 'file' into a
+    ColumnarTree, without creating its nodes, and returns the proxy of its
+    root.
+    """
+    classes, codes, offsets, blobs = read_sections(file.read)
+    tree = ColumnarTree()
+    values = [tree.add_object(marshal.loads(blobs[offsets[i]:offsets[i + 1]]))
+              for i in range(len(offsets) - 1)]
+    class_ids = [tree.class_id(cls) for cls in classes]
+    leaves = [issubclass(cls, Leaf) for cls in classes]
+
+    # The root takes the first row, so rows are only added when their
+    # parent is read, in reverse order. Until then, the stack holds the
+    # codes of the items (nodes and values) in postorder.
+    tree.add_row(NONE)
+    position = len(codes) - 1
+    pending = [(position, 0)]
+    while pending:
+        end, row = pending.pop()
+        code = codes[end - 2]
+        tree.class_ids[row] = class_ids[code >> 1]
+        tree.placeholders[row] = code & 1
+        start = end - codes[end] + 1
+        position = end - 3
+        if leaves[code >> 1]:
+            tree.values[row] = values[-1 - codes[position]]
+            continue
+
+        rows = []
+        while position >= start:
+            code = codes[position]
+            if code < 0:
+                rows.append(tree.add_row(VALUE, values[-1 - code]))
+                position -= 1
+            else:
+                child = tree.add_row(NONE)
+                rows.append(child)
+                pending.append((position, child))
+                position -= code
+        rows.reverse()
+        tree.link(row, rows)
+    return tree.root()
@@ -0,0 +1,181 @@
+"""
+Applies text edits to a parsed tree by parsing again only the statements
+around the edit, instead of the whole program.
+
+Parser modules opt in by defining 'parse_statements(text, indentation)', which
+returns the list of statements in 'text', whose lines after the first are
+indented by 'indentation'. The edit is mapped to the children of the
+innermost block containing it, and those children are replaced by the
+statements parsed from their edited text. If that text doesn't parse on its
+own, e.g. because the edit opened a block that is closed further down, the
+enclosing blocks are tried in turn, and at last the whole program.
+"""
+from .structures import Node, Block, flatten
+
+def inner_blocks(node):
+    """
+    Yields the blocks in the subtree of 'node' that are not inside another
+    block, in order.
+    """
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Block):
+            yield node
+        else:
+            stack.extend(child for child in reversed(node.contents)
+                         if isinstance(child, Node))
+
+def find_children(block, text, start, end, depth):
+    """
+    Returns the (start, end) ranges of the children of 'block', whose text is
+    text[start:end], or None if they are not found there. Only whitespace is
+    allowed between them.
+    """
+    ranges = []
+    position = start
+    for child in block.contents:
+        child_text = flatten(child.layout(), depth)
+        child_start = text.find(child_text, position, end)
+        if child_start == -1 or text[position:child_start].strip():
+            return None
+        position = child_start + len(child_text)
+        ranges.append((child_start, position))
+    return ranges
+
+def enclosing_blocks(root, text, start, end):
+    """
+    Returns a list of (block, ranges) pairs for the blocks whose text contains
+    the range [start, end], innermost first, where 'ranges' has the (start,
+    end) range of each of the block's children. Returns None if the children
+    are not found in 'text'.
+
+    Positions are found by searching for the memoized renderings of the
+    blocks around the edit and their children, so nothing is rendered again.
+    """
+    blocks = []
+    block = root
+    block_start, block_end = 0, len(text)
+    depth = 0
+    while block is not None:
+        if block.indented:
+            depth += 1
+        ranges = find_children(block, text, block_start, block_end, depth)
+        if ranges is None:
+            return None
+        blocks.append((block, ranges))
+
+        statement = None
+        for child, (child_start, child_end) in zip(block.contents, ranges):
+            if child_start <= start and end <= child_end:
+                statement = child
+                break
+        if statement is None:
+            break
+
+        # The blocks in a statement are searched in order, so one isn't
+        # mistaken for an earlier one with the same text.
+        block = None
+        position = child_start
+        for inner in inner_blocks(statement):
+            inner_text = flatten(inner.layout(), depth)
+            inner_start = text.find(inner_text, position, child_end)
+            if inner_start == -1:
+                return None
+            position = inner_start + len(inner_text)
+            if inner_start <= start and end <= position:
+                block, block_start, block_end = inner, inner_start, position
+                break
+
+    blocks.reverse()
+    return blocks
+
+def indentation_at(text, start):
+    """
+    Returns the whitespace between the start of the line and 'start', or an
+    empty string if there is other text before it.
+    """
+    line_start = text.rfind('\n', 0, start) + 1
+    indentation = text[line_start:start]
+    return '' if indentation.strip() else indentation
+
+class Splice(object):
+    """
+    Children of 'block' replaced by an incremental parse, starting at
+    'index', which can be undone and redone.
+    """
+    def __init__(self, block, index, removed, inserted):
+        self.block = block
+        self.index = index
+        self.removed = removed
+        self.inserted = inserted
+
+    def _replace(self, old, new):
+        for child in old:
+            self.block.remove(child)
+        for i, child in enumerate(new):
+            self.block.insert(self.index + i, child)
+
+    def undo(self):
+        self._replace(self.inserted, self.removed)
+
+    def redo(self):
+        self._replace(self.removed, self.inserted)
+
+def splice(parser, block, ranges, text, start, end, replacement):
+    """
+    Replaces the children of 'block' touched by the edit with the statements
+    parsed from their new text, returning the Splice. Returns None, leaving
+    'block' unchanged, if the text doesn't parse into statements 'block'
+    accepts.
+    """
+    # Children before the edit, and the ones it touches or is next to.
+    before = 0
+    touched = []
+    for i, (child_start, child_end) in enumerate(ranges):
+        if child_end < start:
+            before = i + 1
+        elif child_start <= end:
+            touched.append(i)
+
+    if touched:
+        first, last = touched[0], touched[-1]
+        region_start = min(start, ranges[first][0])
+        region_end = max(end, ranges[last][1])
+    else:
+        # The edit is between two children, so it's inserted after the first.
+        first, last = before, before - 1
+        region_start, region_end = start, end
+    region = text[region_start:start] + replacement + text[end:region_end]
+
+    try:
+        statements = parser.parse_statements(region,
+                                             indentation_at(text, region_start))
+    except Exception:
+        # Each parser raises its own errors for invalid text.
+        return None
+    if not all(block.can_insert(first, statement) for statement in statements):
+        return None
+
+    result = Splice(block, first, block.contents[first:last + 1], statements)
+    result.redo()
+    return result
+
+def reparse(parser, root, text, start, end, replacement):
+    """
+    Replaces the text between 'start' and 'end' in 'text', the rendering of
+    'root', with 'replacement', parsing it with the module 'parser'.
+
+    Returns a pair (root, splice). If part of the tree was parsed again,
+    'root' is the same node, changed in place as described by 'splice'.
+    Otherwise 'root' is the new tree from parsing the whole program, and
+    'splice' is None.
+    """
+    if hasattr(parser, 'parse_statements'):
+        blocks = enclosing_blocks(root, text, start, end) or []
+        for block, ranges in blocks:
+            result = splice(parser, block, ranges, text, start, end,
+                            replacement)
+            if result is not None:
+                return root, result
+    return parser.parse_string(text[:start] + replacement + text[end:]), None
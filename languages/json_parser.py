@@ -1,10 +1,25 @@
+"""
+Parser for JSON documents.
+
+The text is read directly from a bytes buffer, which may be a memory-mapped
+file, and nodes are built in a single pass without an intermediate Python
+object. Arrays and objects spanning more than 'lazy_size' bytes are only
+scanned for their end when read, and their children are built the first time
+they are accessed (see structures.LazyNode). The arrays and objects among
+those children are lazy too, whatever their size, so touching one record of
+a large array builds that record only, and opening a large file takes little
+memory until its parts are looked at.
+"""
 import json
+import mmap
+import re
+from functools import partial
 from .structures import *
 
 class Value(StaticNode):
     pass
 
-class String(Value):
+class String(Leaf, Value):
     template = '"{value}"'
     alphabet = [chr(i) for i in range(256)]
     subparts = [('value', str)]
@@ -12,18 +27,17 @@ class String(Value):
     @staticmethod
     def default(): return String(['value'])
 
-    def render(self, wrapper=empty_wrapper):
-        return wrapper(self).format(value=self.contents[0].replace('"', r'\"'))
+    def _render(self, wrapper):
+        return wrapper(self).format(value=self.value.replace('"', r'\"'))
 
-class Number(Value):
+class Number(Leaf, Value):
+    # The token is kept as written, so saving does not reformat numbers.
     template = '{value}'
-    subparts = [('value', int)]
+    subparts = [('value', str)]
+    token_rule = r'-?(0|[1-9][0-9]*)(\.[0-9]+)?([eE][-+]?[0-9]+)?$'
 
     @staticmethod
-    def default(): return Number([0])
-
-    def render(self, wrapper=empty_wrapper):
-        return wrapper(self).format(value=self.contents[0])
+    def default(): return Number(['0'])
 
 class True_(Value):
     template = 'true'
@@ -31,7 +45,7 @@ class True_(Value):
     @staticmethod
     def default(): return True_()
 
-    def render(self, wrapper=empty_wrapper):
+    def _render(self, wrapper):
         return wrapper(self)
 
 class False_(Value):
@@ -40,7 +54,7 @@ class False_(Value):
     @staticmethod
     def default(): return False_()
 
-    def render(self, wrapper=empty_wrapper):
+    def _render(self, wrapper):
         return wrapper(self)
 
 class Null(Value):
@@ -49,10 +63,10 @@ class Null(Value):
     @staticmethod
     def default(): return Null()
 
-    def render(self, wrapper=empty_wrapper):
+    def _render(self, wrapper):
         return wrapper(self)
 
-class Array(Block, Value):
+class Array(LazyNode, Block, Value):
     delimiter = ',\n'
     template = '[{children}\n]'
     child_type = Value
@@ -64,28 +78,192 @@ class Assignment(StaticNode):
     @staticmethod
     def default(): return Assignment([String.default(), String.default()])
 
-class Object(Block, Value):
+class Object(LazyNode, Block, Value):
     child_type = Assignment
     delimiter = ',\n'
     template = '{{{children}\n}}'
 
-def convert(root):
-    if isinstance(root, str):
-        return String([root])
-    elif isinstance(root, bool):
-        return True_() if root else False_()
-    elif isinstance(root, int):
-        return Number([root])
-    elif root is None:
-        return Null()
-    elif isinstance(root, list):
-        return Array(map(convert, root))
-    elif isinstance(root, dict):
-        return Object([Assignment([String([key]), convert(value)])
-                       for key, value in root.items()])
+# Containers larger than this, in bytes, have their children built lazily.
+lazy_size = 64 * 1024
+
+space_pattern = re.compile(rb'[ \t\n\r]*')
+string_pattern = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+number_pattern = re.compile(rb'-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?')
+# Everything up to the next bracket, skipping over strings.
+skip_pattern = re.compile(rb'[^"\[\]{}]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"\[\]{}]*)*',
+                          re.DOTALL)
+
+def nested_pattern(depth):
+    """
+    Returns a pattern matching an array or object whose brackets are
+    balanced and nested at most 'depth' levels, skipping over strings.
+    """
+    atom = rb'[^"\[\]{}]++|"[^"\\]*+(?:\\.[^"\\]*+)*+"'
+    level = rb'(?:' + atom + rb')*+'
+    for i in range(depth - 1):
+        level = rb'(?:' + atom + rb'|\[' + level + rb'\]|\{' + level + rb'\})*+'
+    return re.compile(rb'\[' + level + rb'\]|\{' + level + rb'\}', re.DOTALL)
+
+# Containers such as records are skipped in a single match, deeper ones
+# bracket by bracket.
+shallow_pattern = nested_pattern(4)
+constants = {ord('t'): (b'true', True_),
+             ord('f'): (b'false', False_),
+             ord('n'): (b'null', Null)}
+closing = {ord('['): ord(']'), ord('{'): ord('}')}
+
+class Reader(object):
+    """
+    Builds nodes from the JSON text in 'buffer', a bytes-like object encoded
+    in UTF-8. Lazy containers keep a reference to the reader, and through it
+    to the buffer.
+    """
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    def error(self, message, position):
+        raise ValueError('{} at byte {}'.format(message, position))
+
+    def document(self):
+        """ Returns the root node of the document. """
+        node, position = self.value(0)
+        position = space_pattern.match(self.buffer, position).end()
+        if position != len(self.buffer):
+            self.error('Extra data', position)
+        return node
+
+    def value(self, position, lazy=False):
+        """
+        Reads the value starting at 'position', ignoring leading whitespace.
+        Returns the new node and the position after its text. Arrays and
+        objects are built lazily if 'lazy' is true or they are large.
+        """
+        buffer = self.buffer
+        position = space_pattern.match(buffer, position).end()
+        char = buffer[position] if position < len(buffer) else None
+        if char == ord('"'):
+            value, position = self.string(position)
+            return String([value]), position
+        elif char in closing:
+            return self.container(position, lazy)
+        elif char in constants:
+            word, cls = constants[char]
+            if buffer[position:position + len(word)] != word:
+                self.error('Expecting value', position)
+            return cls(), position + len(word)
+
+        match = number_pattern.match(buffer, position)
+        if not match:
+            self.error('Expecting value', position)
+        return Number([match.group().decode('ascii')]), match.end()
+
+    def string(self, position):
+        """
+        Reads the string literal starting at 'position'. Returns its decoded
+        value and the position after the closing quote.
+        """
+        match = string_pattern.match(self.buffer, position)
+        if not match:
+            self.error('Unterminated string', position)
+        text = match.group()
+        if b'\\' in text:
+            return json.loads(text.decode('utf-8')), match.end()
+        return text[1:-1].decode('utf-8'), match.end()
+
+    def skip(self, position):
+        """
+        Returns the position after the end of the array or object starting
+        at 'position', checking only that brackets are balanced.
+        """
+        buffer = self.buffer
+        match = shallow_pattern.match(buffer, position)
+        if match:
+            return match.end()
+        expected = []
+        while True:
+            char = buffer[position] if position < len(buffer) else None
+            if char in closing:
+                expected.append(closing[char])
+            elif expected and char == expected[-1]:
+                expected.pop()
+                if not expected:
+                    return position + 1
+            else:
+                self.error('Unbalanced brackets', position)
+            position = skip_pattern.match(buffer, position + 1).end()
+
+    def container(self, position, lazy=False):
+        """
+        Reads the array or object starting at 'position'. Returns the new
+        node and the position after its closing bracket. The node is lazy if
+        'lazy' is true or it spans more than 'lazy_size' bytes, and then the
+        arrays and objects among its children are lazy if it is large.
+        """
+        cls = Object if self.buffer[position] == ord('{') else Array
+        if not lazy and len(self.buffer) - position <= lazy_size:
+            return self.children(cls, position)
+
+        end = self.skip(position)
+        large = end - position > lazy_size
+        if not lazy and not large:
+            return self.children(cls, position)
+        return cls.lazy(partial(self.contents, cls, position, large)), end
+
+    def contents(self, cls, position, lazy):
+        """ Returns the children of the lazy node starting at 'position'. """
+        return self.children(cls, position, lazy)[0].contents
+
+    def children(self, cls, position, lazy=False):
+        """
+        Builds the array or object of class 'cls' starting at 'position', with
+        all its direct children, which are built lazily if 'lazy' is true.
+        Returns the node and the position after it.
+        """
+        buffer = self.buffer
+        end = closing[buffer[position]]
+        items = []
+        position = space_pattern.match(buffer, position + 1).end()
+        if position < len(buffer) and buffer[position] == end:
+            return cls(items), position + 1
+
+        while True:
+            if cls is Object:
+                position = space_pattern.match(buffer, position).end()
+                if buffer[position:position + 1] != b'"':
+                    self.error('Expecting property name', position)
+                key, position = self.string(position)
+                position = space_pattern.match(buffer, position).end()
+                if buffer[position:position + 1] != b':':
+                    self.error("Expecting ':' delimiter", position)
+                value, position = self.value(position + 1, lazy)
+                items.append(Assignment([String([key]), value]))
+            else:
+                value, position = self.value(position, lazy)
+                items.append(value)
+
+            position = space_pattern.match(buffer, position).end()
+            char = buffer[position] if position < len(buffer) else None
+            if char == ord(','):
+                position += 1
+            elif char == end:
+                return cls(items), position + 1
+            else:
+                self.error("Expecting ',' delimiter", position)
 
 def parse_string(string):
-    return convert(json.loads(string))
+    return Reader(string.encode('utf-8')).document()
+
+def parse_file(file):
+    """
+    Parses the JSON document in the binary 'file', which is memory-mapped
+    when possible so that lazily built containers read from the file.
+    """
+    try:
+        buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError, AttributeError):
+        # Empty files and file-like objects without a descriptor.
+        buffer = file.read()
+    return Reader(buffer).document()
 
 def new_empty():
     return Object()
@@ -1,8 +1,16 @@
-from pyparsing import *
-from .structures import DynamicNode, Node, empty_wrapper, StaticNode
+"""
+Reader for Lisp programs made of s-expressions.
+
+The text is split into tokens by a single regular expression, and the nodes
+are built in the same pass, keeping the lists still open in an explicit stack
+instead of recursing. This way arbitrarily deep nesting can be read.
+"""
+import re
+from pyparsing import ParseException
+from .structures import DynamicNode, Node, empty_wrapper, StaticNode, Leaf
 
 class Value(StaticNode):
-    def render(self, wrapper=empty_wrapper):
+    def _render(self, wrapper):
         return wrapper(self).format(value=self.contents[0])
 
 class SExpression(DynamicNode, Value):
@@ -17,7 +25,7 @@ class Program(DynamicNode):
     child_type = SExpression
     delimiter = '\n'
 
-class Identifier(Value):
+class Identifier(Leaf, Value):
     subparts = [('value', str)]
     template = '{value}'
     token_rule = '[^ ()]+'
@@ -25,46 +33,79 @@ class Identifier(Value):
     @staticmethod
     def default(): return String(['name'])
 
-class Number(Value):
-    subparts = [('value', int)]
+class Number(Leaf, Value):
+    # The token is kept as written, so saving does not reformat numbers.
+    subparts = [('value', str)]
     template = '{value}'
-    token_rule = '[+-]?\d+\.?\d*'
-
-    def __init__(self, toks):
-        super(Number, self).__init__(self, [int(''.join(toks))])
+    token_rule = '[+-]?\d+(\.\d*)?([eE][+-]?\d+)?'
 
     @staticmethod
-    def default(): return Number([0])
+    def default(): return Number(['0'])
 
-class String(Value):
+class String(Leaf, Value):
     subparts = [('value', str)]
     template = '"{value}"'
 
     @staticmethod
     def default(): return String(['value'])
 
-number = Combine(Word('+-' + nums, nums) + 
-                 Optional('.' + Optional(Word(nums))) +
-                 Optional(CaselessLiteral('e') + Word('+-' + nums, nums)))
-
-value = number | Word(alphanums + '-/*!@#$%&_') | quotedString
-sexp = nestedExpr('(', ')', value)
-root = OneOrMore(sexp)
-
-def convert(root):
-    if isinstance(root, int):
-        return Number([root])
-    elif isinstance(root, str) and not root.startswith('"'):
-        return Identifier([root])
-    elif isinstance(root, str):
-        return String([root])
+token_pattern = re.compile(r'''
+    (?P<space>\s+)
+  | (?P<open>\()
+  | (?P<close>\))
+  | (?P<string>"(?:[^"\\]|\\.)*")
+  | (?P<atom>[^\s()"]+)
+  | (?P<error>.)
+''', re.VERBOSE | re.DOTALL)
+
+number_pattern = re.compile(Number.token_rule)
+
+def atom(text):
+    """ Returns the Number or Identifier node for an unquoted token. """
+    if number_pattern.fullmatch(text):
+        return Number([text])
     else:
-        return SExpression(map(convert, root))
+        return Identifier([text])
 
 def parse_string(text):
-    return Program(map(convert, root.parseString(text, parseAll=True)))
+    """
+    Parses a program from a string. Strings keep their escape sequences as
+    written.
+    """
+    # Children of the expressions still open, innermost last, and where
+    # each one started. The first list holds the top level expressions.
+    stack = [[]]
+    starts = []
+    for match in token_pattern.finditer(text):
+        kind = match.lastgroup
+        if kind == 'space':
+            continue
+        elif kind == 'open':
+            stack.append([])
+            starts.append(match.start())
+        elif kind == 'close':
+            if not starts:
+                raise ParseException(text, match.start(), "Unexpected ')'")
+            children = stack.pop()
+            starts.pop()
+            stack[-1].append(SExpression(children))
+        elif not starts:
+            raise ParseException(text, match.start(), "Expected '('")
+        elif kind == 'string':
+            stack[-1].append(String([match.group()[1:-1]]))
+        elif kind == 'atom':
+            stack[-1].append(atom(match.group()))
+        else:
+            # Only a quote without its closing pair gets here.
+            raise ParseException(text, match.start(), 'Unterminated string')
+
+    if starts:
+        raise ParseException(text, starts[-1], "Expected ')'")
+    if not stack[0]:
+        raise ParseException(text, len(text), "Expected '('")
+    return Program(stack[0])
 
 def new_empty():
     return SExpression([])
 
-structures = [Identifier, Number, String, SExpression]
\ No newline at end of file
+structures = [Identifier, Number, String, SExpression]
@@ -0,0 +1,485 @@
+"""
+Hand-written parser for Lua programs, an alternative to the pyparsing grammar
+in lua_parser.py that builds the same structures from lua_structures.py.
+
+The text is split into tokens by a single regular expression in one pass,
+which also recognizes comments and long strings. Statements are then parsed by
+recursive descent and expressions by precedence climbing, so parsing time
+grows linearly with the size of the program.
+
+Comments are kept as statements of the innermost block being parsed when they
+are reached, so they survive a round trip through the editor.
+"""
+import re
+import inspect
+from pyparsing import ParseException
+from . import lua_structures
+from .lua_structures import *
+
+keywords = set(['if', 'elseif', 'else', 'for', 'while', 'end', 'do', 'then',
+                'and', 'not', 'or', 'break', 'goto', 'repeat', 'until',
+                'function', 'local', 'return', 'nil', 'false', 'true', 'in'])
+
+token_pattern = re.compile(r"""
+    (?P<space>\s+)
+  | --(?:\[(?P<comment_level>=*)\[(?P<long_comment>.*?)\](?P=comment_level)\]
+       |(?P<comment>[^\n]*))
+  | (?P<name>[A-Za-z_]\w*)
+  | (?P<number>0[xX][0-9a-fA-F]+|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | \[(?P<string_level>=*)\[(?P<long_string>.*?)\](?P=string_level)\]
+  | (?P<string>"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*')
+  | (?P<symbol>\.\.\.|\.\.|==|~=|<=|>=|[-+*/%^#<>=(){}\[\];:,.])
+  | (?P<error>.)
+""", re.VERBOSE | re.DOTALL)
+
+comment_classes = {'comment': Comment, 'long_comment': LongComment}
+string_classes = {'string': String, 'long_string': LongString}
+
+def tokenize(string):
+    """
+    Splits 'string' into tokens, returning the lists of their kinds, values
+    and positions, and a list of comments. Names, numbers and strings have the
+    kinds 'name', 'number', 'string' and 'long_string', while keywords and
+    symbols are their own kind. The last token is always '<eof>'.
+
+    Comments are returned as (index, node) pairs, where 'index' is the index
+    of the token that follows the comment.
+    """
+    kinds = []
+    values = []
+    positions = []
+    comments = []
+    for match in token_pattern.finditer(string):
+        kind = match.lastgroup
+        if kind == 'space':
+            continue
+        elif kind in comment_classes:
+            node = comment_classes[kind]([match.group(kind)])
+            comments.append((len(kinds), node))
+            continue
+
+        value = match.group()
+        if kind == 'name':
+            if value in keywords:
+                kind = value
+        elif kind == 'string':
+            value = value[1:-1]
+        elif kind == 'long_string':
+            value = match.group(kind)
+        elif kind == 'symbol':
+            kind = value
+        elif kind == 'error':
+            raise ParseException(string, match.start(), 'Unexpected character')
+
+        kinds.append(kind)
+        values.append(value)
+        positions.append(match.start())
+
+    kinds.append('<eof>')
+    values.append('')
+    positions.append(len(string))
+    return kinds, values, positions, comments
+
+# Left and right priorities of the binary operators, as in the reference
+# implementation. Right associative operators have a lower right priority.
+binary_priorities = {'or': (1, 1), 'and': (2, 2),
+                     '<': (3, 3), '>': (3, 3), '<=': (3, 3), '>=': (3, 3),
+                     '~=': (3, 3), '==': (3, 3),
+                     '..': (9, 8),
+                     '+': (10, 10), '-': (10, 10),
+                     '*': (11, 11), '/': (11, 11), '%': (11, 11),
+                     '^': (14, 13)}
+unary_operators = set(['not', '-', '#'])
+unary_priority = 12
+
+# Tokens that close a block.
+block_ends = set(['end', 'else', 'elseif', 'until', '<eof>'])
+
+class Parser(object):
+    """
+    Single use parser over the tokens of a Lua program.
+    """
+    def __init__(self, string):
+        self.string = string
+        self.kinds, self.values, self.positions, self.comments = tokenize(string)
+        self.i = 0
+        # Index of the first comment not yet added to a block.
+        self.comment_index = 0
+
+        self.statements = {'if': self.if_statement,
+                           'while': self.while_statement,
+                           'do': self.do_statement,
+                           'for': self.for_statement,
+                           'repeat': self.repeat_statement,
+                           'function': self.function_statement,
+                           'local': self.local_statement,
+                           'break': self.break_statement}
+
+    def error(self, expected):
+        raise ParseException(self.string, self.positions[self.i],
+                             'Expected ' + expected)
+
+    def accept(self, kind):
+        if self.kinds[self.i] == kind:
+            self.i += 1
+            return True
+        return False
+
+    def expect(self, kind):
+        if self.kinds[self.i] != kind:
+            self.error(repr(kind))
+        self.i += 1
+        return self.values[self.i - 1]
+
+    def program(self):
+        block = self.block()
+        if self.kinds[self.i] != '<eof>':
+            self.error('statement')
+        return block
+
+    def take_comments(self, statements):
+        """
+        Adds the comments that appear before the current token, and that
+        were not added to an inner block, to 'statements'.
+        """
+        comments = self.comments
+        while (self.comment_index < len(comments) and
+               comments[self.comment_index][0] <= self.i):
+            statements.append(comments[self.comment_index][1])
+            self.comment_index += 1
+
+    def block(self):
+        statements = []
+        kinds = self.kinds
+        while True:
+            if self.comments:
+                self.take_comments(statements)
+            kind = kinds[self.i]
+            if kind in block_ends:
+                break
+            elif kind == ';':
+                self.i += 1
+            elif kind == 'return':
+                statements.append(self.return_statement())
+                self.accept(';')
+                if self.comments:
+                    self.take_comments(statements)
+                # Return must be the last statement of its block.
+                if kinds[self.i] not in block_ends:
+                    self.error('end of block after return')
+                break
+            elif kind in self.statements:
+                statements.append(self.statements[kind]())
+            else:
+                statements.append(self.expression_statement())
+        return Block(statements)
+
+    def return_statement(self):
+        self.i += 1
+        if self.kinds[self.i] in block_ends or self.kinds[self.i] == ';':
+            return Return([])
+        return Return(self.expression_list())
+
+    def break_statement(self):
+        self.i += 1
+        return Break()
+
+    def do_statement(self):
+        self.i += 1
+        body = self.block()
+        self.expect('end')
+        return DoBlock([body])
+
+    def while_statement(self):
+        self.i += 1
+        condition = self.expression()
+        self.expect('do')
+        body = self.block()
+        self.expect('end')
+        return While([condition, body])
+
+    def repeat_statement(self):
+        self.i += 1
+        body = self.block()
+        self.expect('until')
+        return RepeatUntil([body, self.expression()])
+
+    def if_statement(self):
+        self.i += 1
+        conditionals = []
+        while True:
+            condition = self.expression()
+            self.expect('then')
+            conditionals.append(If([condition, self.block()]))
+            if not self.accept('elseif'):
+                break
+
+        parts = [IfChain(conditionals)]
+        if self.accept('else'):
+            parts.append(Else([self.block()]))
+        self.expect('end')
+        return FullIf(parts)
+
+    def for_statement(self):
+        self.i += 1
+        name = Identifier([self.expect('name')])
+        if self.accept('='):
+            limits = self.expression_list()
+            if not 2 <= len(limits) <= 3:
+                self.error('start, limit and optional step')
+            parts = [name, ExpressionList(limits)]
+            class_ = For
+        else:
+            names = [name]
+            while self.accept(','):
+                names.append(Identifier([self.expect('name')]))
+            self.expect('in')
+            parts = [NameList(names), ExpressionList(self.expression_list())]
+            class_ = ForIn
+
+        self.expect('do')
+        parts.append(self.block())
+        self.expect('end')
+        return class_(parts)
+
+    def function_statement(self):
+        self.i += 1
+        names = [Identifier([self.expect('name')])]
+        while self.accept('.'):
+            names.append(Identifier([self.expect('name')]))
+        if self.accept(':'):
+            names.append(Method([self.expect('name')]))
+        return NamedFunction([FunctionName(names)] + self.function_body())
+
+    def local_statement(self):
+        self.i += 1
+        if self.accept('function'):
+            name = Identifier([self.expect('name')])
+            return LocalFunction([name] + self.function_body())
+
+        names = [Identifier([self.expect('name')])]
+        while self.accept(','):
+            names.append(Identifier([self.expect('name')]))
+        if self.accept('='):
+            return LocalVar([NameList(names),
+                             ExpressionList(self.expression_list())])
+        return LocalVar([NameList(names)])
+
+    def expression_statement(self):
+        """
+        Parses an assignment or a function call, the only expressions that
+        can be used as statements.
+        """
+        start = self.i
+        target = self.suffixed_expression()
+        if self.kinds[self.i] in ('=', ','):
+            targets = [target]
+            while self.accept(','):
+                targets.append(self.suffixed_expression())
+            for target in targets:
+                if not (isinstance(target, (Identifier, DotAccess)) or
+                        isinstance(target, SuffixExp) and
+                        isinstance(target[1], ListAccess)):
+                    self.i = start
+                    self.error('variable')
+            self.expect('=')
+            return Assignment([ExpressionList(targets),
+                               ExpressionList(self.expression_list())])
+
+        if isinstance(target, SuffixExp) and isinstance(target[1],
+                                                        FunctionCallArgs):
+            return target
+
+        self.i = start
+        self.error('statement')
+
+    def function_body(self):
+        """
+        Parses the parameters and body of a function declaration, returning
+        them as a list.
+        """
+        self.expect('(')
+        parameters = []
+        if self.kinds[self.i] != ')':
+            while True:
+                if self.accept('...'):
+                    parameters.append(Identifier(['...']))
+                    break
+                parameters.append(Identifier([self.expect('name')]))
+                if not self.accept(','):
+                    break
+        self.expect(')')
+        body = self.block()
+        self.expect('end')
+        return [ParameterList(parameters), body]
+
+    def expression_list(self):
+        expressions = [self.expression()]
+        while self.accept(','):
+            expressions.append(self.expression())
+        return expressions
+
+    def expression(self, limit=0):
+        """
+        Parses an expression whose binary operators have a priority higher
+        than 'limit'.
+        """
+        kind = self.kinds[self.i]
+        if kind in unary_operators:
+            self.i += 1
+            operand = self.expression(unary_priority)
+            left = UnoOp([[Operator([kind]), operand]])
+        else:
+            left = self.simple_expression()
+
+        while True:
+            kind = self.kinds[self.i]
+            priorities = binary_priorities.get(kind)
+            if priorities is None or priorities[0] <= limit:
+                return left
+            self.i += 1
+            right = self.expression(priorities[1])
+            left = BinOp([[left, Operator([kind]), right]])
+
+    def simple_expression(self):
+        kind = self.kinds[self.i]
+        if kind == 'number':
+            self.i += 1
+            return Constant([self.values[self.i - 1]])
+        elif kind in string_classes:
+            self.i += 1
+            return string_classes[kind]([self.values[self.i - 1]])
+        elif kind in ('nil', 'true', 'false'):
+            self.i += 1
+            return Constant([kind])
+        elif kind == '...':
+            self.i += 1
+            return Identifier(['...'])
+        elif kind == 'function':
+            self.i += 1
+            return AnonFunction(self.function_body())
+        elif kind == '{':
+            return self.table()
+        else:
+            return self.suffixed_expression()
+
+    def suffixed_expression(self):
+        """
+        Parses a name or parenthesized expression followed by any number of
+        field accesses, indexes and calls.
+        """
+        kind = self.kinds[self.i]
+        if kind == 'name':
+            self.i += 1
+            node = Identifier([self.values[self.i - 1]])
+        elif kind == '(':
+            self.i += 1
+            node = self.expression()
+            self.expect(')')
+        else:
+            self.error('expression')
+
+        # Consecutive field accesses are kept in a single DotAccess.
+        names = None
+        while True:
+            kind = self.kinds[self.i]
+            if kind == '.':
+                self.i += 1
+                if names is None:
+                    names = [node]
+                names.append(Identifier([self.expect('name')]))
+                continue
+            elif kind == ':':
+                self.i += 1
+                if names is None:
+                    names = [node]
+                names.append(Method([self.expect('name')]))
+                node = DotAccess([names])
+                names = None
+                suffix = self.call_arguments()
+                if suffix is None:
+                    self.error('method arguments')
+            elif kind == '[':
+                self.i += 1
+                suffix = ListAccess([self.expression()])
+                self.expect(']')
+            else:
+                suffix = self.call_arguments()
+                if suffix is None:
+                    break
+
+            if names is not None:
+                node = DotAccess([names])
+                names = None
+            node = SuffixExp([[node, suffix]])
+
+        if names is not None:
+            node = DotAccess([names])
+        return node
+
+    def call_arguments(self):
+        """
+        Parses the arguments of a function call, or returns None if the next
+        token doesn't start them.
+        """
+        kind = self.kinds[self.i]
+        if kind == '(':
+            self.i += 1
+            arguments = []
+            if self.kinds[self.i] != ')':
+                arguments = self.expression_list()
+            self.expect(')')
+            return FunctionCallArgs(arguments)
+        elif kind == '{':
+            return FunctionCallArgs([self.table()])
+        elif kind in string_classes:
+            self.i += 1
+            string = string_classes[kind]([self.values[self.i - 1]])
+            return FunctionCallArgs([string])
+        return None
+
+    def table(self):
+        self.expect('{')
+        fields = []
+        kinds = self.kinds
+        while kinds[self.i] != '}':
+            if kinds[self.i] == '[':
+                self.i += 1
+                key = self.expression()
+                self.expect(']')
+                self.expect('=')
+                field = BracketFieldAssignment([ExpressionList([key]),
+                                                ExpressionList([self.expression()])])
+            elif kinds[self.i] == 'name' and kinds[self.i + 1] == '=':
+                key = Identifier([self.values[self.i]])
+                self.i += 2
+                field = FieldAssignment([ExpressionList([key]),
+                                         ExpressionList([self.expression()])])
+            else:
+                field = self.expression()
+            fields.append(field)
+
+            if not (self.accept(',') or self.accept(';')):
+                break
+        self.expect('}')
+        return Table(fields)
+
+
+def parse_string(string):
+    """
+    Parses a Lua program from a string.
+    """
+    return Parser(string).program()
+
+def parse_statements(string, indentation=''):
+    """
+    Parses a sequence of Lua statements, for replacing part of a block (see
+    languages.incremental). Indentation is not significant in Lua.
+    """
+    return list(Parser(string).program())
+
+def new_empty():
+    return Block([])
+
+all_classes = inspect.getmembers(lua_structures, inspect.isclass)
+structures = [cls for name, cls in all_classes]
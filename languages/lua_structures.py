@@ -20,6 +20,34 @@ class Expression(TableItem):
         else:
             return cls()
 
+def long_brackets(text):
+    """
+    Returns the opening and closing long brackets ("[[" and "]]", or with
+    as many '=' as needed between them) that can enclose 'text'.
+    """
+    level = ''
+    while ']' + level + ']' in text + ']':
+        level += '='
+    return '[' + level + '[', ']' + level + ']'
+
+class Comment(Leaf, Statement):
+    """ Line comment, kept as a statement of the surrounding block. """
+    subparts = [('value', str)]
+    template = '--{value}'
+    token_rule = '[^\n]*'
+
+class LongComment(Comment):
+    """ Comment in long brackets ("--[[ text ]]"), possibly multi-line. """
+    token_rule = '(.|\n)*'
+
+    @property
+    def template(self):
+        opening, closing = long_brackets(self.value)
+        return '--' + opening + '{value}' + closing
+
+    def _render(self, wrapper):
+        return fill(wrapper(self), {'value': Verbatim(self.value)})
+
 class Break(Statement):
     template = 'break'
 
@@ -27,19 +55,16 @@ class DoBlock(Statement):
     template = 'do{block}\nend'
     subparts = [('block', Block)]
 
-class Constant(Expression):
+class Constant(Leaf, Expression):
     """ Literal string, number, nil, true or false. """
     subparts = [('value', str)]
     template = '{value}'
     token_rule = '\d+'
 
-    def render(self, wrapper=empty_wrapper):
-        return wrapper(self).format(value=self.contents[0])
-
     @staticmethod
     def default():
         new = Constant(['0'])
-        Node.defaulted.append(new)
+        new.placeholder = True
         return new
 
 class Identifier(Constant):
@@ -48,23 +73,45 @@ class Identifier(Constant):
     @staticmethod
     def default():
         new = Identifier(['value'])
-        Node.defaulted.append(new)
+        new.placeholder = True
         return new
 
+class Method(Identifier):
+    """ Name of a method, called or declared with a colon ("obj:method"). """
+    template = ':{value}'
+
 class String(Constant):
     """ Literal string. """
     template = '"{value}"'
     token_rule = '.+'
 
-    def render(self, wrapper=empty_wrapper):
-        return wrapper(self).format(value=self.contents[0].replace('"', r'\"'))
+    def _render(self, wrapper):
+        return wrapper(self).format(value=self.value.replace('"', r'\"'))
 
     @staticmethod
     def default():
         new = String(['value'])
-        Node.defaulted.append(new)
+        new.placeholder = True
+        return new
+
+class LongString(String):
+    """ Literal string in long brackets ("[[text]]"), kept as written. """
+    token_rule = '(.|\n)*'
+
+    @staticmethod
+    def default():
+        new = LongString(['value'])
+        new.placeholder = True
         return new
 
+    @property
+    def template(self):
+        opening, closing = long_brackets(self.value)
+        return opening + '{value}' + closing
+
+    def _render(self, wrapper):
+        return fill(wrapper(self), {'value': Verbatim(self.value)})
+
 class ExpressionList(DynamicNode):
     """ Comma separated list of expressions ("foo, bar + 2, baz[1]"). """
     child_type = Expression
@@ -84,19 +131,28 @@ class Assignment(Statement):
 class LocalVar(Assignment):
     """ Variable declaration with "local" modifier. """
     subparts = [('names', NameList), ('values', ExpressionList)]
-    template = 'local {names} = {values}'
 
-    def render(self, wrapper=empty_wrapper):
+    @property
+    def template(self):
         if len(self) == 1:
-            self.template = LocalVar.template.replace('= {values}', '')
-        else:
-            self.template = LocalVar.template
-        return super(LocalVar, self).render(wrapper)
+            return 'local {names} '
+        return 'local {names} = {values}'
 
 class FieldAssignment(TableItem):
     template = '{left_side} = {right_side}'
     subparts = [('left_side', ExpressionList), ('right_side', ExpressionList)]
 
+class BracketFieldAssignment(FieldAssignment):
+    """ Table field with a computed key ("[key] = value"). """
+
+    @property
+    def template(self):
+        # "[[" would open a long string instead of the key.
+        keys = self[0]
+        if len(keys) and isinstance(keys[0], LongString):
+            return '[ {left_side} ] = {right_side}'
+        return '[{left_side}] = {right_side}'
+
 class Table(DynamicNode, Expression):
     """
     Table declaration. When printing, line breaks are inserted as necessary.
@@ -105,11 +161,28 @@ class Table(DynamicNode, Expression):
     child_type = TableItem
     template = '{{{children}}}'
 
-class FunctionName(DynamicNode):
+class NameChain(DynamicNode):
     """
-    Dot separated names, used in function declarations.
+    Dot separated names. Methods bring their own colon instead of a dot.
     """
     delimiter = '.'
+
+    def _render(self, wrapper):
+        pieces = []
+        for item in self.contents:
+            if pieces and not isinstance(item, Method):
+                pieces.append(self.delimiter)
+            pieces.append(item.layout(wrapper))
+        try:
+            children = ''.join(pieces)
+        except TypeError:
+            children = Layout(pieces)
+        return fill(wrapper(self), {'children': children})
+
+class FunctionName(NameChain):
+    """
+    Dot separated names, used in function declarations.
+    """
     child_type = Identifier
     @staticmethod
     def default(): return FunctionName([Identifier.default()])
@@ -162,14 +235,14 @@ class Else(StaticNode):
 class If(StaticNode):
     """ The condition/body pair of an 'if'/'elseif' control structure. """
     subparts = [('condition', Expression), ('body', Block)]
-    template = 'if {condition} then{body}'
+    # Depends on the position in the chain.
+    cacheable = False
 
-    def render(self, wrapper=empty_wrapper):
-        if self.parent.index(self) != 0:
-            self.template = 'else' + If.template
-        else:
-            self.template = If.template
-        return super(If, self).render(wrapper)
+    @property
+    def template(self):
+        if self.parent.index_of(self) != 0:
+            return 'elseif {condition} then{body}'
+        return 'if {condition} then{body}'
 
 class IfChain(DynamicNode):
     """
@@ -184,19 +257,17 @@ class IfChain(DynamicNode):
 
 class FullIf(Statement):
     """ If control structure, including related elseifs and elses. """
-    template = '{if_chain}{else}\nend'
     subparts = [('if_chain', IfChain), ('else', Else)]
 
     @staticmethod
     def default():
         return FullIf([IfChain.default(), Else.default()])
 
-    def render(self, wrapper=empty_wrapper):
+    @property
+    def template(self):
         if len(self) == 1:
-            self.template = FullIf.template.replace('{else}', '')
-        else:
-            self.template = FullIf.template
-        return super(FullIf, self).render(wrapper)
+            return '{if_chain}\nend'
+        return '{if_chain}{else}\nend'
 
 class Return(DynamicNode, Statement):
     """ A return statement, with zero or more expression returned. """
@@ -208,15 +279,12 @@ class Return(DynamicNode, Statement):
         return Return()
 
 
-class Operator(StaticNode):
+class Operator(Leaf):
     """ Class for binary and unary operators such as +, and, ^ and not.  """
     subparts = [('value', object)]
     template = '{value}'
     token_rule = '[#^*/%+-.<>=~]'
 
-    def render(self, wrapper=empty_wrapper):
-        return wrapper(self).format(value=self.contents[0])
-
     @staticmethod
     def default():
         return Operator(['+'])
@@ -229,7 +297,6 @@ class BinOp(Expression):
     subparts = [('left_side', Expression),
                 ('operator', Operator),
                 ('right_side', Expression)]
-    template = '{left_side} {operator} {right_side}'
 
     def __init__(self, toks=[None]):
         super(BinOp, self).__init__(toks[0])
@@ -240,12 +307,11 @@ class BinOp(Expression):
                        Operator.default(),
                        Identifier.default()]])
 
-    def render(self, wrapper=empty_wrapper):
+    @property
+    def template(self):
         if isinstance(self.parent, Expression):
-            self.template = '(' + BinOp.template + ')'
-        else:
-            self.template = BinOp.template
-        return super(BinOp, self).render(wrapper)
+            return '({left_side} {operator} {right_side})'
+        return '{left_side} {operator} {right_side}'
 
 class UnoOp(Expression):
     """
@@ -254,14 +320,21 @@ class UnoOp(Expression):
     """
     subparts = [('operator', Operator),
                 ('right_side', Expression)]
-    template = '{operator}{right_side}'
 
     def __init__(self, toks=[None]):
         super(UnoOp, self).__init__(toks[0])
 
-class DotAccess(DynamicNode, Expression):
+    @property
+    def template(self):
+        # Keeps "not" apart from its operand, and "- -x" from becoming a
+        # comment.
+        if self[0].value == 'not' or (isinstance(self[1], UnoOp) and
+                                      self[1][0].value == '-'):
+            return '{operator} {right_side}'
+        return '{operator}{right_side}'
+
+class DotAccess(NameChain, Expression):
     child_type = Expression
-    delimiter = '.'
     template = '{children}'
 
     def __init__(self, toks=[None]):
@@ -278,7 +351,13 @@ class FunctionCallArgs(DynamicNode, SuffixOperator):
 class ListAccess(StaticNode, SuffixOperator):
     """ Simple list access using the bracket notation ("[exp]"). """
     subparts = [('index', Expression)]
-    template = '[{index}]'
+
+    @property
+    def template(self):
+        # "[[" would open a long string instead of the index.
+        if isinstance(self[0], LongString):
+            return '[ {index} ]'
+        return '[{index}]'
 
 class SuffixExp(UnoOp, Statement):
     subparts = [('right_side', Expression),
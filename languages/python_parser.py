@@ -3,7 +3,11 @@ import ast
 import difflib
 import re
 import html
+import itertools
 import textwrap
+import threading
+from time import perf_counter
+import types
 
 class SliceType(StaticNode):
     pass
@@ -21,49 +25,53 @@ class Empty(StaticNode):
     template = ' '
     subparts = []
 
-class NameConstant(Expr):
+class NameConstant(Leaf, Expr):
     template = '{value}'
     subparts = [('value', str)]
+    # Depends on the type of the parent and grandparent.
+    cacheable = False
 
-    def render(self, wrapper=empty_wrapper):
-        if self.contents[0] == 'None' and (isinstance(self.parent.parent, Subscript)
-                                           or isinstance(self.parent, ExceptHandler)
-                                           or isinstance(self.parent, Return)):
+    def _render(self, wrapper):
+        if self.value == 'None' and (isinstance(self.parent.parent, Subscript)
+                                     or isinstance(self.parent, ExceptHandler)
+                                     or isinstance(self.parent, Return)):
             return wrapper(self).format(value=' ')
-        return Expr.render(self, wrapper)
+        return Leaf._render(self, wrapper)
 
-class Comment(Statement):
+class Comment(Leaf, Statement):
     token_rule = '.+'
     template = '# {value}'
     subparts = [('value', str)]
 
-    def render(self, wrapper=empty_wrapper):
-        value = self.contents[0].replace('\n', '\\n')
+    def _render(self, wrapper):
+        value = self.value.replace('\n', '\\n')
         return wrapper(self).format(value=value)
 
-class Str(Expr):
+class Str(Leaf, Expr):
     token_rule = '.+'
-    template = '\'{value}\''
     subparts = [('value', str)]
 
-    def render(self, wrapper=empty_wrapper):
+    @property
+    def template(self):
+        # Use triple quotes for multi-line strings.
+        if self.value.count('\n') > 1:
+            return '"""{value}"""'
+        return '\'{value}\''
+
+    def _render(self, wrapper):
         # Escape backslashes properly.
-        value = self.contents[0].replace('\\', '\\\\')
+        value = self.value.replace('\\', '\\\\')
 
-        if self.contents[0].count('\n') == 1:
+        if self.value.count('\n') == 1:
             # If we have a single line break, replace with \n instead of
             # using a multi-line string.
-            self.template = '\'{value}\''
             value = value.replace('\'', '\\\'').replace('\n', '\\n')
 
-        elif self.contents[0].count('\n') > 1:
-            # Use triple quotes for multi-line strings.
-            self.template = '"""{value}"""'
+        elif self.value.count('\n') > 1:
             value = textwrap.dedent(value.replace('"""', '\"""'))
 
         else:
             # Otherwise, just remember to escape single quotes.
-            self.template = '\'{value}\''
             value = value.replace('\'', '\\\'')
         
         format = wrapper(self)
@@ -75,7 +83,7 @@ class Str(Expr):
 
         return format.format(value=value)
 
-class Num(Expr):
+class Num(Leaf, Expr):
     token_rule = '\d+'
     template = '{value}'
     subparts = [('value', str)]
@@ -83,7 +91,7 @@ class Num(Expr):
     @staticmethod
     def default(): return Num(['0'])
 
-class Bytes(Expr):
+class Bytes(Leaf, Expr):
     token_rule = '.+'
     template = 'b\'{value}\''
     subparts = [('value', str)]
@@ -91,7 +99,7 @@ class Bytes(Expr):
     @staticmethod
     def default(): return Bytes([''])
 
-class Op(StaticNode):
+class Op(Leaf):
     token_rule = 'or|and'
     template = '{op}'
     subparts = [('op', str)]
@@ -99,7 +107,7 @@ class Op(StaticNode):
     @staticmethod
     def default(): return Op(['or'])
 
-class UOp(StaticNode):
+class UOp(Leaf):
     token_rule = 'not|+|-'
     template = '{op}'
     subparts = [('op', str)]
@@ -112,29 +120,37 @@ class UnaryOp(Expr):
     subparts = [('op', UOp), ('operand', Expr)]
 
 class BinOp(Expr):
-    template = '{left} {op} {right}'
     subparts = [('left', Expr), ('op', Op), ('right', Expr)]
 
-    def render(self, wrapper=empty_wrapper):
+    @property
+    def template(self):
         if isinstance(self.parent, BinOp):
-            self.template = '({left} {op} {right})'
-        else:
-            self.template = '{left} {op} {right}'
-
-        return super(BinOp, self).render(wrapper)
+            return '({left} {op} {right})'
+        return '{left} {op} {right}'
 
 class BoolOp(Expr):
-    template = '{children}'
     subparts = [('op', Op), ('children', ExprList)]
-
-    def render(self, wrapper=empty_wrapper):
-        op = ' ' + self[0].render(wrapper) + ' '
-        self[1].delimiter = op
+    # Depends on the type of the grandparent.
+    cacheable = False
+
+    def _render(self, wrapper):
+        # The operands are joined by the operator, so they are rendered here
+        # instead of changing the delimiter of the (memoized) operand list.
+        op = self[0].render(wrapper)
+        operands = self[1]
+        pieces = []
+        for item in operands:
+            if pieces:
+                pieces.append(' ' + op + ' ')
+            pieces.append(item.layout(wrapper))
+        children = fill(wrapper(operands), {'children': Layout(pieces)})
+        return fill(wrapper(self), {'op': op, 'children': children})
+
+    @property
+    def template(self):
         if isinstance(self.parent.parent, BoolOp):
-            self.template = '({children})'
-        else:
-            self.template = '{children}'
-        return super(Expr, self).render(wrapper)
+            return '({children})'
+        return '{children}'
 
 class AugAssign(Statement):
     template = '{left} {op}= {right}'
@@ -145,11 +161,11 @@ class Body(Block):
     template = '{children}'
     child_type = Statement
 
-    def render(self, wrapper=empty_wrapper):
+    def _render(self, wrapper):
         if len(self) == 0:
             return wrapper(self).format(children='\n    pass')
         else:
-            return Block.render(self, wrapper)
+            return Block._render(self, wrapper)
 
 class Module(Block):
     pass
@@ -159,7 +175,7 @@ class Arg(StaticNode):
     # Name will be filled in a moment because of a circular dependency.
     subparts = [[('name', Empty), ('default', Expr)]]
 
-class Name(Expr, Arg):
+class Name(Leaf, Expr, Arg):
     template = '{value}'
     subparts = [('value', str)]
     token_rule = '[a-zA-Z_]\w*'
@@ -220,39 +236,37 @@ class Call(Expr):
     template = '{func}({all_args})'
     subparts = [('func', Expr), ('args', ExprList), ('keywords', Keywords)]
 
-    def render(self, wrapper=empty_wrapper):
-        args = self.contents[1].render(wrapper)
-        keywords = self.contents[2].render(wrapper)
+    def _render(self, wrapper):
+        args = self.contents[1].layout(wrapper)
+        keywords = self.contents[2].layout(wrapper)
         if self.contents[1] and self.contents[2]:
-            all_args = args + ', ' + keywords
+            all_args = Layout([args, ', ', keywords])
         elif self.contents[1] or self.contents[2]:
             all_args = args if self.contents[1] else keywords
         else:
             all_args = ' '
-        return wrapper(self).format(func=self.contents[0].render(wrapper),
-                                    all_args=all_args)
+        return fill(wrapper(self), {'func': self.contents[0].layout(wrapper),
+                                    'all_args': all_args})
 
 class Attribute(Expr):
     template = '{value}.{attr}'
     subparts = [('value', Expr), ('attr', Name)]
 
 class Slice(SliceType):
-    template = '{lower}:{upper}'
     subparts = [('lower', Expr), ('upper', Expr), ('step', Expr)]
 
-    def render(self, wrapper=empty_wrapper):
+    @property
+    def template(self):
         has_upper = self[0][0] == 'None'
         has_lower = self[1][0] == 'None'
         if not has_upper and not has_lower:
-            self.template = ':'
+            return ':'
         elif not has_lower:
-            self.template = ':{upper}' 
+            return ':{upper}'
         elif not has_upper:
-            self.template = '{lower}:' 
+            return '{lower}:'
         else:
-            self.template = '{lower}:{upper}'
-
-        return super(Slice, self).render(wrapper)
+            return '{lower}:{upper}'
 
 class SliceWithStep(SliceType):
     template = '{lower}:{upper}:{step}'
@@ -283,15 +297,15 @@ class Else(StaticNode):
 
 class If(StaticNode):
     """ The condition/body pair of an 'if'/'elif' control structure. """
-    template = 'if {test}:{body}'
     subparts = [('test', Expr), ('body', Body)]
+    # Depends on the position in the chain.
+    cacheable = False
 
-    def render(self, wrapper=empty_wrapper):
-        if self.parent.index(self) != 0:
-            self.template = 'el' + If.template
-        else:
-            self.template = If.template
-        return super(If, self).render(wrapper)
+    @property
+    def template(self):
+        if self.parent.index_of(self) != 0:
+            return 'elif {test}:{body}'
+        return 'if {test}:{body}'
 
 class IfChain(DynamicNode):
     """
@@ -306,19 +320,17 @@ class IfChain(DynamicNode):
 
 class FullIf(Statement):
     """ If control structure, including related elseifs and elses. """
-    template = '{if_chain}{else}'
     subparts = [('if_chain', IfChain), ('else', Else)]
 
     @staticmethod
     def default():
         return FullIf([IfChain.default(), Else.default()])
 
-    def render(self, wrapper=empty_wrapper):
+    @property
+    def template(self):
         if len(self) == 1:
-            self.template = FullIf.template.replace('{else}', '')
-        else:
-            self.template = FullIf.template
-        return super(FullIf, self).render(wrapper)
+            return '{if_chain}'
+        return '{if_chain}{else}'
 
 class IfExp(Expr):
     template = '{body} if {test} else {orelse}'
@@ -337,16 +349,13 @@ class Dict(DynamicNode, Expr):
 class ExceptHandler(StaticNode):
     #template = 'except {type} as {name}:{body}'
     #subparts = [('type', Name), ('name', Name), ('body', Body)]
-    template = 'except {type}:{body}'
     subparts = [('type', Expr), ('body', Body)]
 
-    def render(self, wrapper=empty_wrapper):
+    @property
+    def template(self):
         if self[0][0] == 'None':
-            self.template = 'except:{body}'
-        else:
-            self.template = 'except {type}:{body}'
-
-        return super(ExceptHandler, self).render(wrapper)
+            return 'except:{body}'
+        return 'except {type}:{body}'
 
 class ExceptHandlers(DynamicNode):
     delimiter = '\n'
@@ -364,16 +373,14 @@ class Decorator(StaticNode):
     subparts = [('value', Expr)]
 
 class DecoratorList(DynamicNode):
-    template = '{children}'
     child_type = Decorator
     delimiter = '\n'
 
-    def render(self, wrapper=empty_wrapper):
+    @property
+    def template(self):
         if len(self) == 0:
-            self.template = ''
-        else:
-            self.template = '{children}\n'
-        return DynamicNode.render(self, wrapper)
+            return ''
+        return '{children}\n'
 
 class FunctionDef(Statement):
     template = '{decorators}def {name}({args}):{body}'
@@ -413,16 +420,13 @@ class Raise(Statement):
     subparts = [('value', Expr)]
 
 class ListComp(Expr):
-    template = '[{elt} for {target} in {iter} if {cond}]'
     subparts = [('elt', Expr), ('target', Expr), ('iter', Expr), ('cond', Expr)]
 
-    def render(self, wrapper=empty_wrapper):
+    @property
+    def template(self):
         if self[-1][0] != 'True':
-            self.template = '[{elt} for {target} in {iter} if {cond}]'
-        else:
-            self.template = '[{elt} for {target} in {iter}]'
-
-        return super(Expr, self).render(wrapper)
+            return '[{elt} for {target} in {iter} if {cond}]'
+        return '[{elt} for {target} in {iter}]'
 
 class DictComp(Expr):
     template = '{{{key}: {value} for {target} in {iter}}}'
@@ -472,16 +476,86 @@ uop_char_by_class = {
 # TODO: use something more robust
 COMMENT_PREFIX = 'COMMENT' * 3 + str(id(id))
 
+# Conversion functions by the type of the AST node they handle. Each one
+# either returns the converted node directly, returns another AST node to be
+# converted in its place, or is a generator that yields the AST nodes it
+# needs converted, receives their conversions back, and returns the result.
+# 'convert' drives the generators with its own stack, so deeply nested code
+# does not exhaust Python's recursion limit.
+converters = {}
+
+def converts(*node_types):
+    """ Decorator registering a conversion function for 'node_types'. """
+    def register(function):
+        for node_type in node_types:
+            converters[node_type] = function
+        return function
+    return register
+
+def convert_all(nodes):
+    """ Sub-generator converting a list of AST nodes, in order. """
+    converted = []
+    for node in nodes:
+        converted.append((yield node))
+    return converted
+
+def converter_for(node_type):
+    """
+    Returns the conversion function for 'node_type', falling back to the
+    ones registered for its base classes.
+    """
+    for base in node_type.__mro__:
+        if base in converters:
+            converters[node_type] = converters[base]
+            return converters[base]
+    return None
+
 def convert(node):
-    if type(node) in binop_char_by_class:
-        return Op([binop_char_by_class[type(node)]])
-    elif type(node) in uop_char_by_class:
-        return UOp([uop_char_by_class[type(node)]])
-    elif type(node) in compop_char_by_class:
-        return Op([compop_char_by_class[type(node)]])
-    elif isinstance(node, ast.Expr):
-        return convert(node.value)
-    elif isinstance(node, ast.Str) and node.s.startswith(COMMENT_PREFIX):
+    """
+    Converts the AST node 'node', as returned by 'ast.parse', to the tree of
+    structures declared in this module.
+    """
+    stack = []
+    value = None
+    while True:
+        # Start the conversion of 'node'.
+        function = converters.get(type(node)) or converter_for(type(node))
+        if function is None:
+            raise TypeError('Unknown node type', node)
+        result = function(node)
+        if isinstance(result, ast.AST):
+            node = result
+            continue
+
+        # Resume the waiting conversions until one asks for another node.
+        while True:
+            if type(result) is types.GeneratorType:
+                stack.append(result)
+                value = None
+            elif not stack:
+                return result
+            else:
+                value = result
+
+            try:
+                node = stack[-1].send(value)
+                break
+            except StopIteration as stop:
+                stack.pop()
+                result = stop.value
+
+for node_type, char in binop_char_by_class.items():
+    converters[node_type] = lambda node, char=char: Op([char])
+for node_type, char in uop_char_by_class.items():
+    converters[node_type] = lambda node, char=char: UOp([char])
+for node_type, char in compop_char_by_class.items():
+    converters[node_type] = lambda node, char=char: Op([char])
+
+# Since Python 3.8 the literal node types are all ast.Constant, and the old
+# names only remain for isinstance checks.
+@converts(*{ast.Constant, ast.Str, ast.Bytes, ast.Num, ast.NameConstant})
+def convert_constant(node):
+    if isinstance(node, ast.Str) and node.s.startswith(COMMENT_PREFIX):
         return Comment([node.s[len(COMMENT_PREFIX):]])
     elif isinstance(node, ast.Str):
         return Str([node.s])
@@ -489,159 +563,312 @@ def convert(node):
         return Bytes([node.s.decode()])
     elif isinstance(node, ast.Num):
         return Num([str(node.n)])
-    elif isinstance(node, ast.Module):
-        return Module(map(convert, node.body))
-    elif isinstance(node, ast.keyword):
-        return Keyword([Name([node.arg]), convert(node.value)])
-    elif isinstance(node, ast.Call):
-        args = ExprList(map(convert, node.args))
-        keywords = Keywords(map(convert, node.keywords))
-        return Call([convert(node.func), args, keywords])
-    elif isinstance(node, ast.Import):
-        return Import(Name([alias.name]) for alias in node.names)
-    elif isinstance(node, ast.ImportFrom):
-        import_level = ImportLevelList(ImportLevel() for i in range(node.level))
-        return ImportFrom([import_level, Name([node.module or '']), NameList(Name([alias.name]) for alias in node.names)])
-    elif isinstance(node, ast.Assign):
-        return Assign([ExprList(map(convert, node.targets)), convert(node.value)])
-    elif isinstance(node, ast.For):
-        return For([convert(node.target), convert(node.iter), Body(map(convert, node.body))])
-    elif isinstance(node, ast.With):
-        alias = node.items[0].optional_vars
-        if alias:
-            return With([convert(node.items[0].context_expr), convert(alias), Body(map(convert, node.body))])
-        else:
-            return With([convert(node.items[0].context_expr), Body(map(convert, node.body))])
-    elif isinstance(node, ast.Name):
-        return Name([node.id])
     elif isinstance(node, ast.NameConstant):
         return Name([str(node.value)])
-    elif isinstance(node, ast.Attribute):
-        return Attribute([convert(node.value), Name([node.attr])])
-    elif isinstance(node, ast.BoolOp):
-        operator = convert(node.op)
-        operands = ExprList(map(convert, node.values))
-        return BoolOp([operator, operands])
-    elif isinstance(node, ast.BinOp):
-        return BinOp([convert(node.left), convert(node.op), convert(node.right)])
-    elif isinstance(node, ast.UnaryOp):
-        return UnaryOp([convert(node.op), convert(node.operand)])
-    elif isinstance(node, ast.Compare):
-        # TODO: support chained comparisons
-        return BinOp([convert(node.left), convert(node.ops[0]), convert(node.comparators[0])])
-    elif isinstance(node, ast.Subscript):
-        return Subscript([convert(node.value), convert(node.slice)])
-    elif isinstance(node, ast.Index):
-        return convert(node.value)
-    elif isinstance(node, ast.Slice):
-        lower = node.lower or ast.NameConstant(value='None')
-        upper = node.upper or ast.NameConstant(value='None')
-        if node.step:
-            return SliceWithStep([convert(lower), convert(upper), convert(node.step)])
-        else:
-            return Slice([convert(lower), convert(upper)])
-    elif isinstance(node, ast.List):
-        return List(map(convert, node.elts))
-    elif isinstance(node, ast.Tuple):
-        return Tuple(map(convert, node.elts))
-    elif isinstance(node, ast.While):
-        return While([convert(node.test), Body(map(convert, node.body))])
-    elif isinstance(node, ast.If):
-        if_list = []
-        while True:
-            body = Body(map(convert, node.body))
-            test = convert(node.test)
-            if_list.append(If([test, body]))
-            if len(node.orelse) == 1 and isinstance(node.orelse[0], ast.If):
-                node = node.orelse[0]
-            else:
-                break
+    raise TypeError('Unknown node type', node)
 
-        if len(node.orelse) == 0:
-            return FullIf([IfChain(if_list)])
+@converts(ast.Expr, ast.Index)
+def convert_expr(node):
+    return node.value
+
+@converts(ast.Module)
+def convert_module(node):
+    return Module((yield from convert_all(node.body)))
+
+@converts(ast.keyword)
+def convert_keyword(node):
+    return Keyword([Name([node.arg]), (yield node.value)])
+
+@converts(ast.Call)
+def convert_call(node):
+    function = yield node.func
+    args = ExprList((yield from convert_all(node.args)))
+    keywords = Keywords((yield from convert_all(node.keywords)))
+    return Call([function, args, keywords])
+
+@converts(ast.Import)
+def convert_import(node):
+    return Import(Name([alias.name]) for alias in node.names)
+
+@converts(ast.ImportFrom)
+def convert_import_from(node):
+    import_level = ImportLevelList(ImportLevel() for i in range(node.level))
+    return ImportFrom([import_level, Name([node.module or '']), NameList(Name([alias.name]) for alias in node.names)])
+
+@converts(ast.Assign)
+def convert_assign(node):
+    targets = ExprList((yield from convert_all(node.targets)))
+    return Assign([targets, (yield node.value)])
+
+@converts(ast.For)
+def convert_for(node):
+    target = yield node.target
+    iterator = yield node.iter
+    return For([target, iterator, Body((yield from convert_all(node.body)))])
+
+@converts(ast.With)
+def convert_with(node):
+    context = yield node.items[0].context_expr
+    alias = node.items[0].optional_vars
+    if alias:
+        alias = yield alias
+        return With([context, alias, Body((yield from convert_all(node.body)))])
+    else:
+        return With([context, Body((yield from convert_all(node.body)))])
+
+@converts(ast.Name)
+def convert_name(node):
+    return Name([node.id])
+
+@converts(ast.Attribute)
+def convert_attribute(node):
+    return Attribute([(yield node.value), Name([node.attr])])
+
+@converts(ast.BoolOp)
+def convert_bool_op(node):
+    operator = yield node.op
+    operands = ExprList((yield from convert_all(node.values)))
+    return BoolOp([operator, operands])
+
+@converts(ast.BinOp)
+def convert_bin_op(node):
+    return BinOp([(yield node.left), (yield node.op), (yield node.right)])
+
+@converts(ast.UnaryOp)
+def convert_unary_op(node):
+    return UnaryOp([(yield node.op), (yield node.operand)])
+
+@converts(ast.Compare)
+def convert_compare(node):
+    # TODO: support chained comparisons
+    return BinOp([(yield node.left), (yield node.ops[0]), (yield node.comparators[0])])
+
+@converts(ast.Subscript)
+def convert_subscript(node):
+    return Subscript([(yield node.value), (yield node.slice)])
+
+@converts(ast.Slice)
+def convert_slice(node):
+    lower = yield node.lower or ast.NameConstant(value='None')
+    upper = yield node.upper or ast.NameConstant(value='None')
+    if node.step:
+        return SliceWithStep([lower, upper, (yield node.step)])
+    else:
+        return Slice([lower, upper])
+
+@converts(ast.List)
+def convert_list(node):
+    return List((yield from convert_all(node.elts)))
+
+@converts(ast.Tuple)
+def convert_tuple(node):
+    return Tuple((yield from convert_all(node.elts)))
+
+@converts(ast.While)
+def convert_while(node):
+    test = yield node.test
+    return While([test, Body((yield from convert_all(node.body)))])
+
+@converts(ast.If)
+def convert_if(node):
+    if_list = []
+    while True:
+        body = Body((yield from convert_all(node.body)))
+        test = yield node.test
+        if_list.append(If([test, body]))
+        if len(node.orelse) == 1 and isinstance(node.orelse[0], ast.If):
+            node = node.orelse[0]
         else:
-            else_body = Body(map(convert, node.orelse))
-            return FullIf([IfChain(if_list), Else([else_body])])
-    elif isinstance(node, ast.IfExp):
-        return IfExp([convert(node.body), convert(node.test), convert(node.orelse)])
-    elif isinstance(node, ast.Dict):
-        items = [DictItem([convert(key), convert(value)]) for key, value in zip(node.keys, node.values)]
-        return Dict(items)
-    elif isinstance(node, ast.Try):
-        handlers_list = []
-        for handler in node.handlers:
-            #e = ExceptHandler([convert(handler.type), convert(handler.name), Body(map(convert, handler.body))])
-            e = ExceptHandler([convert(handler.type or ast.NameConstant('None')), Body(map(convert, handler.body))])
-            handlers_list.append(e)
-        return Try([Body(map(convert, node.body)), ExceptHandlers(handlers_list)])
-    elif isinstance(node, ast.FunctionDef):
-        decorators = DecoratorList(Decorator([convert(value)]) for value in node.decorator_list)
-        args = []
-        defaults = [None] * (len(node.args.args) - len(node.args.defaults)) + node.args.defaults
-        for arg_node, default in zip(node.args.args, defaults):
-            if default:
-                args.append(Arg([Name([arg_node.arg]), convert(default)]))
-            else:
-                args.append(Name([arg_node.arg]))
-        return FunctionDef([decorators, Name([node.name]), ArgList(args), Body(map(convert, node.body))])
-    elif isinstance(node, ast.Lambda):
-        args = []
-        defaults = [None] * (len(node.args.args) - len(node.args.defaults)) + node.args.defaults
-        for arg_node, default in zip(node.args.args, defaults):
-            if default:
-                args.append(Arg([Name([arg_node.arg]), convert(default)]))
-            else:
-                args.append(Name([arg_node.arg]))
-        return Lambda([ArgList(args), convert(node.body)])
-    elif isinstance(node, ast.ClassDef):
-        return ClassDef([Name([node.name]), ExprList(map(convert, node.bases)), Body(map(convert, node.body))])
-    elif isinstance(node, ast.Return):
-        return Return([convert(node.value or ast.NameConstant('None'))])
-    elif isinstance(node, ast.Pass):
-        return Pass()
-    elif isinstance(node, ast.Continue):
-        return Continue()
-    elif isinstance(node, ast.Break):
-        return Break()
-    elif isinstance(node, ast.ListComp):
-        gen = node.generators[0]
-        cond = gen.ifs[0] if gen.ifs else ast.NameConstant('True')
-        return ListComp([convert(node.elt),
-            convert(gen.target),
-            convert(gen.iter),
-            convert(cond)])
-    elif isinstance(node, ast.DictComp):
-        return DictComp([convert(node.key), convert(node.value), convert(node.generators[0].target), convert(node.generators[0].iter)])
-    elif isinstance(node, ast.GeneratorExp):
-        return GeneratorExp([convert(node.elt), convert(node.generators[0].target), convert(node.generators[0].iter)])
-    elif isinstance(node, ast.Assert):
-        return Assert([convert(node.test)])
-    elif isinstance(node, ast.Raise):
-        return Raise([convert(node.exc)])
-    elif isinstance(node, ast.AugAssign):
-        return AugAssign([convert(node.target), convert(node.op), convert(node.value)])
-
-    raise TypeError('Unknown node type', node)
+            break
+
+    if len(node.orelse) == 0:
+        return FullIf([IfChain(if_list)])
+    else:
+        else_body = Body((yield from convert_all(node.orelse)))
+        return FullIf([IfChain(if_list), Else([else_body])])
+
+@converts(ast.IfExp)
+def convert_if_exp(node):
+    return IfExp([(yield node.body), (yield node.test), (yield node.orelse)])
+
+@converts(ast.Dict)
+def convert_dict(node):
+    items = []
+    for key, value in zip(node.keys, node.values):
+        items.append(DictItem([(yield key), (yield value)]))
+    return Dict(items)
+
+@converts(ast.Try)
+def convert_try(node):
+    body = Body((yield from convert_all(node.body)))
+    handlers_list = []
+    for handler in node.handlers:
+        #e = ExceptHandler([convert(handler.type), convert(handler.name), Body(map(convert, handler.body))])
+        exception = yield handler.type or ast.NameConstant('None')
+        e = ExceptHandler([exception, Body((yield from convert_all(handler.body)))])
+        handlers_list.append(e)
+    return Try([body, ExceptHandlers(handlers_list)])
+
+def convert_arguments(arguments):
+    """ Sub-generator converting the arguments of a function or lambda. """
+    args = []
+    defaults = [None] * (len(arguments.args) - len(arguments.defaults)) + arguments.defaults
+    for arg_node, default in zip(arguments.args, defaults):
+        if default:
+            args.append(Arg([Name([arg_node.arg]), (yield default)]))
+        else:
+            args.append(Name([arg_node.arg]))
+    return ArgList(args)
+
+@converts(ast.FunctionDef)
+def convert_function_def(node):
+    decorators = []
+    for value in node.decorator_list:
+        decorators.append(Decorator([(yield value)]))
+    args = yield from convert_arguments(node.args)
+    body = Body((yield from convert_all(node.body)))
+    return FunctionDef([DecoratorList(decorators), Name([node.name]), args, body])
+
+@converts(ast.Lambda)
+def convert_lambda(node):
+    args = yield from convert_arguments(node.args)
+    return Lambda([args, (yield node.body)])
+
+@converts(ast.ClassDef)
+def convert_class_def(node):
+    bases = ExprList((yield from convert_all(node.bases)))
+    body = Body((yield from convert_all(node.body)))
+    return ClassDef([Name([node.name]), bases, body])
+
+@converts(ast.Return)
+def convert_return(node):
+    return Return([(yield node.value or ast.NameConstant('None'))])
+
+@converts(ast.Pass)
+def convert_pass(node):
+    return Pass()
+
+@converts(ast.Continue)
+def convert_continue(node):
+    return Continue()
+
+@converts(ast.Break)
+def convert_break(node):
+    return Break()
+
+@converts(ast.ListComp)
+def convert_list_comp(node):
+    gen = node.generators[0]
+    cond = gen.ifs[0] if gen.ifs else ast.NameConstant('True')
+    return ListComp([(yield node.elt),
+        (yield gen.target),
+        (yield gen.iter),
+        (yield cond)])
+
+@converts(ast.DictComp)
+def convert_dict_comp(node):
+    gen = node.generators[0]
+    return DictComp([(yield node.key), (yield node.value), (yield gen.target), (yield gen.iter)])
+
+@converts(ast.GeneratorExp)
+def convert_generator_exp(node):
+    gen = node.generators[0]
+    return GeneratorExp([(yield node.elt), (yield gen.target), (yield gen.iter)])
+
+@converts(ast.Assert)
+def convert_assert(node):
+    return Assert([(yield node.test)])
+
+@converts(ast.Raise)
+def convert_raise(node):
+    return Raise([(yield node.exc)])
+
+@converts(ast.AugAssign)
+def convert_aug_assign(node):
+    return AugAssign([(yield node.target), (yield node.op), (yield node.value)])
 
 def parse_and_print(string):
     return ast.dump(ast.parse(string)).replace('=', '=\n').splitlines(keepends=True)
 
+# How 'parse_string' checks that the converted tree renders back to the same
+# program: 'always', 'sampled' (one in every 'verification_interval' parses),
+# 'background' (the comparison runs in a separate thread) or 'off'. Even in
+# the background, the rendering costs nearly as much as the conversion.
+verification_modes = ('always', 'sampled', 'background', 'off')
+verification = 'sampled'
+verification_interval = 10
+
+def report_drift(diff):
+    """
+    Called with the diff between the original and rendered programs' ASTs
+    when they differ. May be called from the verification thread.
+    """
+    print('Parse drift:\n', diff)
+
+# Seconds spent converting and verifying, and how many verifications were
+# run, skipped or moved out of the parsing thread.
+timings = {'conversion': 0.0, 'verification': 0.0,
+           'verified': 0, 'skipped': 0, 'background': 0}
+
+def verify(original_string, rendered_string):
+    """
+    Compares the ASTs of the original and rendered programs, reporting any
+    difference with 'report_drift'. Returns the diff text.
+    """
+    start = perf_counter()
+    original_text = parse_and_print(original_string)
+    new_text = parse_and_print(rendered_string)
+    diff = ''.join(difflib.unified_diff(original_text, new_text, n=10))
+    if diff:
+        report_drift(diff)
+    timings['verification'] += perf_counter() - start
+    timings['verified'] += 1
+    return diff
+
+parse_count = itertools.count()
+
 # TODO: ignore 'comments' inside strings.
 comment_regex = r'^(\s*)#\s?(.+)$'
 comment_replacement = r'\1"""{}\2"""'.format(COMMENT_PREFIX)
 def parse_string(string):
+    if verification not in verification_modes:
+        raise ValueError('Unknown verification mode {!r}, expected one of '
+                         '{}'.format(verification, ', '.join(verification_modes)))
+    start = perf_counter()
     original_string = string
     string = re.sub(comment_regex, comment_replacement, string, flags=re.MULTILINE)
     converted_parse = convert(ast.parse(string))
-
-    original_text = parse_and_print(original_string)
-    new_text = parse_and_print(converted_parse.render())
-    diff = ''.join(difflib.unified_diff(original_text, new_text, n=10))
-    if diff:
-        print('Parse drift:\n', diff)
+    timings['conversion'] += perf_counter() - start
+
+    if verification == 'off' or (verification == 'sampled' and
+                                 next(parse_count) % verification_interval):
+        timings['skipped'] += 1
+    elif verification == 'background':
+        # Rendering stays in this thread, as the tree is not safe to share.
+        timings['background'] += 1
+        thread = threading.Thread(target=verify, daemon=True,
+                                  args=(original_string, converted_parse.render()))
+        thread.start()
+    else:
+        verify(original_string, converted_parse.render())
 
     return converted_parse
 
+def parse_statements(string, indentation=''):
+    """
+    Parses a sequence of statements whose lines after the first are indented
+    by 'indentation', for replacing part of a block (see
+    languages.incremental). Raises SyntaxError if a line is indented less.
+    """
+    if not indentation:
+        return list(parse_string(string))
+
+    # Parsed as the body of a loop, so the text is kept unchanged.
+    loop = parse_string('while 1:\n' + indentation + string)
+    if len(loop) != 1:
+        raise SyntaxError('Statements outside of the indented block')
+    return list(loop[0][1])
+
 def new_empty():
     return parse_string('')
 
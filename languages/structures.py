@@ -4,6 +4,13 @@ tree.
 """
 from pyparsing import ParseResults
 from copy import deepcopy
+from string import Formatter
+from importlib import import_module
+from array import array
+import itertools
+import marshal
+import struct
+import mmap
 
 empty_wrapper = lambda node: node.template
 def default(type_):
@@ -12,31 +19,275 @@ def default(type_):
     else:
         return type_.default()
 
+def uncached(wrapper):
+    """
+    Marks a wrapper whose output depends on more than the node it is given
+    (e.g. the current selection), so renderings made with it are never
+    memoized.
+    """
+    wrapper.cacheable = False
+    return wrapper
+
+INDENT = '    '
+
+class Verbatim(str):
+    """
+    Text whose line breaks are not indented when included in a layout, such
+    as the contents of multi-line strings.
+    """
+    __slots__ = ()
+
+class Layout(object):
+    """
+    Rendered text kept as a tree of pieces (strings and other layouts), so a
+    parent can include its children's renderings without copying them.
+
+    Indentation is not applied when the layout is built. Instead, indented
+    layouts add one level to every line break inside them, and the levels
+    are only expanded when the text is flattened. This way each line is
+    written once, no matter how deep it is nested.
+    """
+    __slots__ = ('pieces', 'indented', '_multiline')
+
+    def __init__(self, pieces, indented=False):
+        self.pieces = pieces
+        self.indented = indented
+        self._multiline = None
+
+    @property
+    def multiline(self):
+        """ True if there's a line break in any of the pieces. """
+        if self._multiline is None:
+            self._multiline = any(map(is_multiline, self.pieces))
+        return self._multiline
+
+    def __bool__(self):
+        return bool(self.pieces)
+
+    def chunks(self, depth=0):
+        """
+        Yields the flattened text in order, piece by piece, with the line
+        breaks already indented, plus 'depth' levels.
+        """
+        stack = [(iter(self.pieces), INDENT * (depth + self.indented))]
+        while stack:
+            pieces, indent = stack[-1]
+            for piece in pieces:
+                if isinstance(piece, str):
+                    if indent and '\n' in piece and type(piece) is not Verbatim:
+                        piece = piece.replace('\n', '\n' + indent)
+                    yield piece
+                else:
+                    if piece.indented:
+                        stack.append((iter(piece.pieces), indent + INDENT))
+                    else:
+                        stack.append((iter(piece.pieces), indent))
+                    break
+            else:
+                stack.pop()
+
+    def lstrip(self):
+        """
+        Returns a copy without leading whitespace, like str.lstrip, or the
+        layout itself if there is none.
+        """
+        for i, piece in enumerate(self.pieces):
+            stripped = piece.lstrip()
+            if stripped:
+                if i == 0 and stripped is piece:
+                    return self
+                return Layout([stripped] + self.pieces[i + 1:], self.indented)
+        return Layout([], self.indented)
+
+    def rstrip(self):
+        """
+        Returns a copy without trailing whitespace, like str.rstrip, or the
+        layout itself if there is none.
+        """
+        last = len(self.pieces) - 1
+        for i in range(last, -1, -1):
+            piece = self.pieces[i]
+            stripped = piece.rstrip()
+            if stripped:
+                if i == last and stripped is piece:
+                    return self
+                return Layout(self.pieces[:i] + [stripped], self.indented)
+        return Layout([], self.indented)
+
+    def strip(self):
+        return self.lstrip().rstrip()
+
+    def __str__(self):
+        return ''.join(self.chunks())
+
+def is_multiline(text):
+    """ Returns True if the string or layout contains a line break. """
+    if isinstance(text, str):
+        return '\n' in text
+    else:
+        return text.multiline
+
+def flatten(text, depth=0):
+    """
+    Converts a string or layout into a string, with its line breaks indented
+    by 'depth' levels, as when it's nested in that many blocks.
+    """
+    for i in range(depth):
+        text = Layout([text], indented=True)
+    if isinstance(text, str):
+        return text
+    else:
+        return ''.join(text.chunks())
+
+def iter_chunks(text, depth=0):
+    """ Returns an iterable over the text of 'flatten(text, depth)' in chunks. """
+    if isinstance(text, str):
+        if depth and '\n' in text and type(text) is not Verbatim:
+            text = text.replace('\n', '\n' + INDENT * depth)
+        return (text,)
+    else:
+        return text.chunks(depth)
+
+formatter = Formatter()
+parsed_templates = {}
+def parse_template(template):
+    """
+    Splits a template into a list of literal strings and field names, or
+    returns None if it uses formatting features other than named fields.
+    """
+    parts = []
+    for literal, name, spec, conversion in formatter.parse(template):
+        if literal:
+            parts.append(literal)
+        if name is not None:
+            if spec or conversion or not name.isidentifier():
+                return None
+            parts.append((name,))
+    return parts
+
+def template_parts(template):
+    """ Memoized version of parse_template. """
+    try:
+        return parsed_templates[template]
+    except KeyError:
+        # Wrapped templates may be unique per node, so keep the memo small.
+        if len(parsed_templates) > 10000:
+            parsed_templates.clear()
+        parts = parsed_templates[template] = parse_template(template)
+        return parts
+
+def fill(template, fields):
+    """
+    Equivalent to template.format(**fields), but the field values may be
+    layouts, in which case the result is a layout referencing them instead of
+    a new string.
+    """
+    for value in fields.values():
+        if type(value) is not str:
+            break
+    else:
+        # Plain strings are cheaper to format directly.
+        return template.format(**fields)
+
+    parts = template_parts(template)
+    if parts is None:
+        return template.format(**{name: flatten(value)
+                                  for name, value in fields.items()})
+
+    return Layout([part if isinstance(part, str) else fields[part[0]]
+                   for part in parts])
+
+# Counters for the memoized renderings. They are kept out of the Node class
+# because assigning class attributes on every render would invalidate the
+# interpreter's attribute caches for all node types.
+cache_stats = {'hits': 0, 'misses': 0}
+
+# Source of unique node ids, kept out of the Node class for the same reason.
+node_ids = itertools.count()
+
+# Number of layouts being built by the renderings in progress. Past
+# max_layout_depth, the descendants are rendered bottom-up without recursion,
+# so trees deeper than the interpreter's recursion limit can be rendered.
+layout_depth = 0
+max_layout_depth = 100
+
+# Subtrees of at most this many nodes, besides leaves, are rendered whole when
+# streaming, as passing each of their chunks through the streams of the
+# parents costs more.
+max_stream_whole = 32
+
 class CastError(Exception): pass
 
-class Node(object):
-    count = 0
-    defaulted = []
+class NodeType(type):
+    """
+    Metaclass of the nodes. Classes that don't declare their own __slots__
+    get an empty one, so instances of every structure stay without a
+    __dict__.
+    """
+    def __new__(mcs, name, bases, namespace):
+        namespace.setdefault('__slots__', ())
+        return type.__new__(mcs, name, bases, namespace)
+
+class Node(object, metaclass=NodeType):
+    __slots__ = ('node_id', 'contents', 'parent', 'cached_wrapper',
+                 'cached_text', 'other_wrapper', 'other_text', 'placeholder')
+
+    # Nodes whose rendering depends on something outside their own subtree
+    # (position in the parent, type of the grandparent) must not be memoized.
+    cacheable = True
 
     @classmethod
     def default(cls): return cls()
 
     def __init__(self, contents, parent=None):
-        self.node_id = Node.count
-        Node.count += 1
+        self.node_id = next(node_ids)
 
         self.contents = contents
         self.parent = parent
+        # The last two layouts and the wrappers they were rendered with, so
+        # saving or copying doesn't evict the layouts of the display.
+        self.cached_wrapper = None
+        self.cached_text = None
+        self.other_wrapper = None
+        self.other_text = None
+        # Set on the default values created for new structures, until the
+        # user fills them.
+        self.placeholder = False
 
         for item in contents:
-            try:
+            if isinstance(item, Node):
                 item.parent = self
-            except AttributeError:
-                pass
-                #print "Can't set parent on " + item
+
+    @classmethod
+    def rebuild(cls, contents, placeholder=False):
+        """
+        Creates a node of this class with the given contents, which are
+        already of the right types. Used for copies and unpickling, without
+        calling __init__, whose signature varies between structures.
+        """
+        new = object.__new__(cls)
+        Node.__init__(new, contents)
+        new.placeholder = placeholder
+        return new
 
     def __deepcopy__(self, memo):
-        return type(self)([deepcopy(item, memo) for item in self.contents])
+        # The descendants are copied bottom-up without recursion, so trees
+        # deeper than the interpreter's recursion limit can be copied.
+        nodes = [self]
+        for node in nodes:
+            nodes.extend(item for item in node.contents
+                         if isinstance(item, Node) and id(item) not in memo)
+        for node in reversed(nodes):
+            contents = [memo[id(item)] if isinstance(item, Node)
+                        else deepcopy(item, memo) for item in node.contents]
+            memo[id(node)] = node.rebuild(contents, node.placeholder)
+        return memo[id(self)]
+
+    def __reduce__(self):
+        # Only the contents are kept, not the parent or cached renderings.
+        # They are read first, as they may change the class of mapped nodes.
+        contents = list(self.contents)
+        return self.rebuild, (contents, self.placeholder)
 
     def __getitem__(self, i):
         return self.contents[i]
@@ -44,13 +295,22 @@ class Node(object):
     def __setitem__(self, index, item):
         assert self.can_insert(index, item)
         self.contents[index] = item
-        if type(item) != str:
+        if isinstance(item, Node):
             item.parent = self
+            item.forget_layouts()
+        self.mark_dirty()
 
     def __len__(self):
         return len(self.contents)
 
     def index(self, item):
+        return self.index_of(item)
+
+    def index_of(self, item):
+        """
+        Returns the position of 'item' among this node's contents, or -1 if
+        it's not a child.
+        """
         try:
             return self.contents.index(item)
         except ValueError:
@@ -69,7 +329,182 @@ class Node(object):
     def can_insert(self, index, item):
         return isinstance(item, self.get_expected_class(index))
 
+    def mark_dirty(self):
+        """
+        Discards the memoized renderings of this node and all its ancestors,
+        whose text include this node's.
+        """
+        node = self
+        while node is not None:
+            node.cached_wrapper = node.other_wrapper = None
+            node = node.parent
+
+    def forget_layouts(self):
+        """ Discards the memoized renderings of this node only. """
+        self.cached_wrapper = self.other_wrapper = None
+
+    def has_layout(self, wrapper):
+        """ Returns whether the rendering with 'wrapper' is memoized. """
+        return self.cached_wrapper == wrapper or self.other_wrapper == wrapper
+
     def render(self, wrapper=empty_wrapper):
+        """
+        Returns the text of this node, calling 'wrapper' on each node to get
+        its template.
+        """
+        return flatten(self.layout(wrapper))
+
+    def iter_render(self, wrapper=empty_wrapper):
+        """
+        Returns an iterator over the text of this node in chunks, so large
+        documents can be written without building the whole string. The
+        nodes are rendered as the chunks are consumed, and their layouts are
+        not memoized, so saving doesn't keep a copy of the document.
+        """
+        transient = uncached(lambda node: wrapper(node))
+        return self._stream(wrapper, transient, 0, 0)
+
+    def _stream(self, wrapper, transient, depth, level):
+        """
+        Yields the text of this node in chunks, indented by 'depth' levels.
+        Nodes whose text is built from their children's stream them one at
+        a time, and the others, or small subtrees, are rendered whole with
+        'transient', a copy of 'wrapper' that is not memoized. Past
+        max_layout_depth nested streams, 'wrapper' is used instead, which
+        renders deep trees without recursion.
+        """
+        if level > max_layout_depth:
+            return (flatten(self.layout(wrapper), depth),)
+        else:
+            return (flatten(self.layout(transient), depth),)
+
+    def _is_small(self):
+        """
+        Returns whether the subtree has at most max_stream_whole nodes, not
+        counting the leaves.
+        """
+        nodes = [self]
+        for node in nodes:
+            if len(nodes) > max_stream_whole:
+                return False
+            for item in node.contents:
+                if isinstance(item, Node) and not isinstance(item, Leaf):
+                    nodes.append(item)
+        return True
+
+    def layout(self, wrapper=empty_wrapper):
+        """
+        Returns the text of this node as a string or Layout. The result is
+        memoized together with the wrapper used until the node or one of its
+        descendants is modified, or the node is rendered with two other
+        wrappers.
+        """
+        # Comparing with None first skips the slower == on new nodes.
+        cached_wrapper = self.cached_wrapper
+        if cached_wrapper is not None and cached_wrapper == wrapper:
+            cache_stats['hits'] += 1
+            return self.cached_text
+        other_wrapper = self.other_wrapper
+        if other_wrapper is not None and other_wrapper == wrapper:
+            cache_stats['hits'] += 1
+            text = self.other_text
+            # The most recently used layout is kept first.
+            self.other_wrapper, self.other_text = (self.cached_wrapper,
+                                                   self.cached_text)
+            self.cached_wrapper, self.cached_text = wrapper, text
+            return text
+
+        global layout_depth
+        cacheable = getattr(wrapper, 'cacheable', True)
+        if layout_depth > max_layout_depth:
+            text = self._render_deep(wrapper, cacheable)
+        else:
+            layout_depth += 1
+            try:
+                text = self._render(wrapper)
+            finally:
+                layout_depth -= 1
+        if cacheable and self.cacheable:
+            cache_stats['misses'] += 1
+            # Same as set_layout, without the call on every miss.
+            self.other_wrapper, self.other_text = (self.cached_wrapper,
+                                                   self.cached_text)
+            self.cached_wrapper, self.cached_text = wrapper, text
+        return text
+
+    def set_layout(self, wrapper, text):
+        """
+        Memoizes 'text' as the rendering of this node with 'wrapper', keeping
+        the most recent of the other one.
+        """
+        self.other_wrapper, self.other_text = (self.cached_wrapper,
+                                               self.cached_text)
+        self.cached_wrapper, self.cached_text = wrapper, text
+
+    def _render_deep(self, wrapper, cacheable):
+        """
+        Renders this node past max_layout_depth, after the layouts of its
+        descendants, so the rendering does not recurse further.
+        """
+        global layout_depth
+        if cacheable:
+            self._render_descendants(wrapper)
+            lent = ()
+        else:
+            lent = self._lend_descendants(wrapper)
+        layout_depth += 1
+        try:
+            return self._render(wrapper)
+        finally:
+            layout_depth -= 1
+            for node, cached_wrapper, cached_text in lent:
+                node.cached_wrapper, node.cached_text = (cached_wrapper,
+                                                         cached_text)
+
+    def _render_descendants(self, wrapper):
+        """
+        Memoizes the layouts of the descendants that are not rendered with
+        'wrapper' yet, deepest first, so the children's layouts are found in
+        the cache and rendering this node does not recurse further.
+        """
+        nodes = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            for item in node.contents:
+                if isinstance(item, Node) and not item.has_layout(wrapper):
+                    nodes.append(item)
+                    stack.append(item)
+        for node in reversed(nodes):
+            node.layout(wrapper)
+
+    def _lend_descendants(self, wrapper):
+        """
+        Version of _render_descendants for wrappers that are not memoized.
+        The descendants' layouts are only held in their first slot while
+        this node is rendered, and the previous contents of the slot are
+        returned as (node, wrapper, text) tuples to be restored.
+        """
+        nodes = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            for item in node.contents:
+                if isinstance(item, Node) and not item.has_layout(wrapper):
+                    nodes.append(item)
+                    stack.append(item)
+        lent = []
+        for node in reversed(nodes):
+            text = node.layout(wrapper)
+            lent.append((node, node.cached_wrapper, node.cached_text))
+            node.cached_wrapper, node.cached_text = wrapper, text
+        return lent
+
+    def _render(self, wrapper):
+        """
+        Returns the text of this node as a string or Layout, built from the
+        children's layouts.
+        """
         raise NotImplementedError()
 
     def __str__(self):
@@ -97,7 +532,7 @@ class StaticNode(Node):
     def get_expected_class(self, index):
         return self.subparts[index][1]
 
-    def render(self, wrapper=empty_wrapper):
+    def _render(self, wrapper):
         """
         Recursively renders itself and all children, calling 'wrapper' on
         each step, if available.
@@ -106,19 +541,74 @@ class StaticNode(Node):
         for content, subpart in zip(self.contents, self.subparts):
             name, type_ = subpart
             try:
-                dictionary[name] = content.render(wrapper)
+                dictionary[name] = content.layout(wrapper)
             except AttributeError:
                 dictionary[name] = str(content)
 
-        return wrapper(self).format(**dictionary)
+        return fill(wrapper(self), dictionary)
+
+    def _stream(self, wrapper, transient, depth, level):
+        parts = template_parts(transient(self))
+        if (type(self)._render is not StaticNode._render or parts is None
+                or level > max_layout_depth or self._is_small()):
+            yield from Node._stream(self, wrapper, transient, depth, level)
+            return
+
+        fields = {name: content for content, (name, type_)
+                  in zip(self.contents, self.subparts)}
+        for part in parts:
+            if isinstance(part, str):
+                yield from iter_chunks(part, depth)
+                continue
+            content = fields[part[0]]
+            if isinstance(content, Node):
+                yield from content._stream(wrapper, transient, depth, level + 1)
+            else:
+                yield from iter_chunks(str(content), depth)
 
     def add(self, index, item):
         assert self.can_insert(index, item)
         item.parent = self
+        item.forget_layouts()
         self.contents[index] = item
+        self.mark_dirty()
 
     def add_before(self, index, item): self.add(index, item)
 
+class Leaf(StaticNode):
+    """
+    Static node with a single scalar part, such as a name or a number. The
+    value is stored directly instead of in a list of contents.
+    """
+    __slots__ = ('value',)
+    subparts = [('value', str)]
+    template = '{value}'
+
+    @property
+    def contents(self):
+        return (self.value,)
+
+    @contents.setter
+    def contents(self, contents):
+        self.value, = contents
+
+    def __getitem__(self, i):
+        return (self.value,)[i]
+
+    def __setitem__(self, index, item):
+        assert index in (0, -1) and self.can_insert(index, item)
+        self.value = item
+        self.mark_dirty()
+
+    def __len__(self):
+        return 1
+
+    def add(self, index, item):
+        self[index] = item
+
+    def _render(self, wrapper):
+        return wrapper(self).format(**{self.subparts[0][0]: self.value})
+
 class DynamicNode(Node):
     """
     Structure with variable number of parts derived from the same type.
@@ -127,6 +617,7 @@ class DynamicNode(Node):
 
     Automatically sets the parent attribute in itself and its children.
     """
+    __slots__ = ('positions',)
     delimiter = ', '
     child_type = str
     template = '{children}'
@@ -145,13 +636,48 @@ class DynamicNode(Node):
 
         contents = [self.cast_subpart(c, self.child_type) for c in contents]
         Node.__init__(self, contents)
+        # Maps id(child) to its last known position. Built on the first
+        # lookup and kept up to date by the methods that change the contents.
+        self.positions = None
+
+    @classmethod
+    def rebuild(cls, contents, placeholder=False):
+        new = super(DynamicNode, cls).rebuild(contents, placeholder)
+        new.positions = None
+        return new
+
+    def index_of(self, item):
+        """
+        Returns the position of 'item' among the children, or -1. Positions
+        are remembered between calls, so looking up the same child again
+        takes constant time. Entries shifted by an insertion or removal are
+        detected on use and trigger a rebuild.
+        """
+        if self.positions is not None:
+            position = self.positions.get(id(item))
+            if (position is not None and position < len(self.contents)
+                    and self.contents[position] is item):
+                return position
+
+        self.positions = {id(child): i for i, child in enumerate(self.contents)}
+        return self.positions.get(id(item), -1)
+
+    def __setitem__(self, index, item):
+        Node.__setitem__(self, index, item)
+        if self.positions is not None and index >= 0:
+            self.positions[id(item)] = index
 
     def get_expected_class(self, index):
         return self.child_type
 
     def remove(self, item):
+        index = self.index_of(item)
+        if index == -1:
+            raise ValueError('{} is not a child of {}'.format(item, self))
         item.parent = None
-        self.contents.remove(item)
+        del self.contents[index]
+        del self.positions[id(item)]
+        self.mark_dirty()
 
     def add(self, index, item):
         return self.insert(index + 1, item)
@@ -162,13 +688,72 @@ class DynamicNode(Node):
     def insert(self, index, item):
         assert self.can_insert(index, item)
         item.parent = self
-        return self.contents.insert(index, item)
+        item.forget_layouts()
+        self.contents.insert(index, item)
+        if self.positions is not None and 0 <= index < len(self.contents):
+            self.positions[id(item)] = index
+        self.mark_dirty()
+
+    def _render(self, wrapper):
+        rendered = [item.layout(wrapper) for item in self.contents]
+        try:
+            children = self.delimiter.join(rendered)
+        except TypeError:
+            # Some of the children are layouts.
+            children = Layout(rendered[:1])
+            for text in rendered[1:]:
+                children.pieces.append(self.delimiter)
+                children.pieces.append(text)
+        return fill(wrapper(self), {'children': children})
 
-    def render(self, wrapper=empty_wrapper):
-        rendered_contents = [item.render(wrapper) for item in self.contents]
-        joined_contents = self.delimiter.join(rendered_contents)
-        return wrapper(self).format(children=joined_contents)
 
+# The slot holding the children of every node, for subclasses that wrap it
+# in a property.
+node_contents = Node.__dict__['contents']
+
+class LazyNode(DynamicNode):
+    """
+    Dynamic node whose children are only built when first accessed, by
+    calling 'loader'. Used for the containers of large documents, so parts
+    that are never looked at don't take memory or time.
+    """
+    __slots__ = ('loader',)
+
+    @classmethod
+    def lazy(cls, loader):
+        """
+        Returns a node of this class whose children are the list returned by
+        'loader()'.
+        """
+        new = object.__new__(cls)
+        DynamicNode.__init__(new, [])
+        new.loader = loader
+        return new
+
+    @property
+    def contents(self):
+        if self.loader is not None:
+            self.load()
+        return node_contents.__get__(self)
+
+    @contents.setter
+    def contents(self, contents):
+        self.loader = None
+        node_contents.__set__(self, contents)
+
+    @property
+    def loaded(self):
+        return self.loader is None
+
+    def load(self):
+        """ Builds the children, if they were not built yet. """
+        if self.loader is None:
+            return
+        contents = self.loader()
+        self.loader = None
+        for item in contents:
+            item.parent = self
+        node_contents.__set__(self, contents)
 
 class Statement(StaticNode):
     template = 'ABSTRACT STATEMENT'
@@ -183,20 +768,389 @@ class Block(DynamicNode):
     template = '{children}'
     delimiter = '\n'
 
-    def render(self, wrapper=empty_wrapper):
+    @property
+    def indented(self):
+        """ True if the children are indented one level, as in nested blocks. """
+        return self.parent is not None or self.template != '{children}'
+
+    def _render(self, wrapper):
         rendered = []
-        for i, node in enumerate(self.contents):
-            text = node.render(wrapper)
+        # True while the children are plain strings on a single line.
+        flat = True
+        contents = self.contents
+        last = len(contents) - 1
+        for i, node in enumerate(contents):
+            text = node.layout(wrapper)
             rendered.append(text)
-            if i < len(self) - 1:
+            multiline = is_multiline(text)
+            if multiline or type(text) is not str:
+                flat = False
+            if i < last:
                 rendered.append(self.delimiter)
-                if '\n' in text:
+                if multiline:
                     rendered.append('\n')
 
-        rendered_text = '\n' + ''.join(rendered).strip()
-        if self.parent or self.template != '{children}':
-            rendered_text = rendered_text.replace('\n', '\n    ')
+        if flat:
+            # Only the line breaks between the children need indenting, which
+            # is cheaper to do right away than through a layout, and leaves
+            # the children's text intact.
+            children = ''.join(rendered).strip()
+            if self.indented:
+                children = ('\n' + children).replace('\n', '\n' + INDENT)
+            return fill(wrapper(self), {'children': children})
+
+        children = Layout(rendered).strip()
+        if self.indented:
+            # Nested blocks start on a new line, one level deeper. The
+            # indentation is only applied when the text is flattened.
+            children = Layout(['\n', children], indented=True)
+
+        return fill(wrapper(self), {'children': children})
+
+    def _stream(self, wrapper, transient, depth, level):
+        parts = template_parts(transient(self))
+        if (type(self)._render is not Block._render or parts is None
+                or level > max_layout_depth or self._is_small()
+                or any(part != ('children',) for part in parts
+                       if not isinstance(part, str))):
+            yield from Node._stream(self, wrapper, transient, depth, level)
+            return
+
+        for part in parts:
+            if isinstance(part, str):
+                yield from iter_chunks(part, depth)
+            elif self.indented:
+                yield from iter_chunks('\n', depth + 1)
+                yield from self._stream_children(wrapper, transient,
+                                                 depth + 1, level + 1)
+            else:
+                yield from self._stream_children(wrapper, transient,
+                                                 depth, level + 1)
+
+    def _stream_children(self, wrapper, transient, depth, level):
+        """
+        Yields the text of the children and delimiters, as in _render,
+        without leading and trailing whitespace.
+        """
+        def delimiter():
+            # Only runs after the child's chunks, when 'multiline' is known.
+            if multiline:
+                yield from iter_chunks(self.delimiter + '\n', depth)
+            else:
+                yield from iter_chunks(self.delimiter, depth)
+
+        contents = self.contents
+        last = len(contents) - 1
+        started = False
+        # Whitespace held back until more text shows it isn't trailing.
+        trailing = ''
+        for i, node in enumerate(contents):
+            multiline = False
+            chunks = node._stream(wrapper, transient, depth, level)
+            if i < last:
+                chunks = itertools.chain(chunks, delimiter())
+            for chunk in chunks:
+                if not multiline and '\n' in chunk:
+                    multiline = True
+                if not started:
+                    chunk = chunk.lstrip()
+                    if not chunk:
+                        continue
+                    started = True
+                stripped = chunk.rstrip()
+                if stripped:
+                    yield trailing + stripped
+                    trailing = chunk[len(stripped):]
+                else:
+                    trailing += chunk
+
+
+def value_key(value):
+    """
+    Returns the key under which equal values are stored once. Floats are
+    keyed by their bytes, as 0.0 == -0.0 but they are written differently.
+    """
+    if type(value) is float:
+        return float, struct.pack('<d', value)
+    return type(value), value
+
+# Binary tree format, written by 'dump' and read by 'load' and 'map_tree'.
+# The file starts with 'tree_magic' and a version byte, followed by sections
+# that are each prefixed with their length in bytes:
+#
+# - The class table, marshalled, with the 'module:name' of each node class
+#   in the tree.
+# - The codes, as a typecode byte followed by an integer array of the
+#   smallest type that fits. They are a postorder walk of the tree. A node
+#   is written after its children as 'class index * 2 + placeholder', its
+#   number of items and the number of codes in its subtree, and a value as
+#   '-1 - value index'. Postorder lets 'load' build every node from the end
+#   of a single stack, and the subtree sizes let 'map_tree' find the
+#   children of a node without reading the rest of the tree.
+# - The offsets of the values in the next section, as a 'q' array.
+# - The value table, with each distinct string or number marshalled once.
+tree_magic = b'STRUCTREE'
+tree_version = 2
+section_header = struct.Struct('<Q')
+
+class SubtreeEnd(object):
+    """
+    Marker pushed by 'dump' after the children of a node, to fill in the
+    size of its subtree once they are written.
+    """
+    __slots__ = ('position',)
+
+    def __init__(self, position):
+        self.position = position
+
+def dump(root, file):
+    """
+    Writes the tree of 'root' to the binary 'file'. Children of lazy nodes
+    are built first. Raises ValueError if the tree has values other than
+    strings, numbers, bytes, booleans or None.
+    """
+    classes = {}
+    # Index of each distinct value by its key, and the values in order.
+    values = {}
+    distinct = []
+    codes = []
+    # Visits the children from last to first and writes each node before
+    # them, so the reversed codes are in postorder.
+    stack = [root]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, Node):
+            # Contents first, as they may change the class of mapped nodes.
+            contents = item.contents
+            cls = type(item)
+            index = classes.get(cls)
+            if index is None:
+                index = classes[cls] = len(classes)
+            stack.append(SubtreeEnd(len(codes)))
+            codes.append(0)
+            codes.append(len(contents))
+            codes.append(index * 2 + bool(item.placeholder))
+            stack.extend(contents)
+        elif type(item) is SubtreeEnd:
+            codes[item.position] = len(codes) - item.position
         else:
-            rendered_text = rendered_text.replace('\n', '', 1)
+            key = value_key(item)
+            index = values.get(key)
+            if index is None:
+                index = values[key] = len(distinct)
+                distinct.append(item)
+            codes.append(-1 - index)
+    codes.reverse()
+
+    for typecode in 'bhiq':
+        try:
+            packed = array(typecode, codes)
+            break
+        except OverflowError:
+            continue
+
+    offsets = array('q', [0])
+    blobs = []
+    for value in distinct:
+        blobs.append(marshal.dumps(value))
+        offsets.append(offsets[-1] + len(blobs[-1]))
+
+    class_names = ['{}:{}'.format(cls.__module__, cls.__qualname__)
+                   for cls in classes]
+    sections = [marshal.dumps(class_names),
+                typecode.encode('ascii') + packed.tobytes(),
+                offsets.tobytes(),
+                b''.join(blobs)]
+    file.write(tree_magic + bytes([tree_version]))
+    for section in sections:
+        file.write(section_header.pack(len(section)))
+        file.write(section)
+
+def load_class(name):
+    """ Returns the node class for a 'module:name' entry of the class table. """
+    module_name, class_name = name.split(':')
+    cls = import_module(module_name)
+    for part in class_name.split('.'):
+        cls = getattr(cls, part)
+    if not (isinstance(cls, type) and issubclass(cls, Node)):
+        raise ValueError('{} is not a node class'.format(name))
+    return cls
+
+def read_sections(read):
+    """
+    Checks the header of a tree file and returns its class table and the
+    remaining sections, using 'read(size)' to get the bytes.
+    """
+    header = read(len(tree_magic) + 1)
+    if header[:-1] != tree_magic:
+        raise ValueError('Not a tree file')
+    if header[-1] != tree_version:
+        raise ValueError('Unsupported tree version {}'.format(header[-1]))
+
+    sections = []
+    for i in range(4):
+        size, = section_header.unpack(read(section_header.size))
+        sections.append(read(size))
+        if len(sections[-1]) != size:
+            raise ValueError('Truncated tree')
+    classes, codes, offsets, values = sections
+    classes = [load_class(name) for name in marshal.loads(classes)]
+    typecode = chr(codes[0])
+    codes = memoryview(codes)[1:].cast('B').cast(typecode)
+    offsets = memoryview(offsets).cast('B').cast('q')
+    return classes, codes, offsets, values
+
+def load(file):
+    """
+    Reads a tree written by 'dump' from the binary 'file' and returns its
+    root node.
+    """
+    classes, codes, offsets, values = read_sections(file.read)
+    rebuilders = [cls.rebuild for cls in classes]
+    values = [marshal.loads(values[offsets[i]:offsets[i + 1]])
+              for i in range(len(offsets) - 1)]
+
+    # Items whose parent was not read yet.
+    stack = []
+    codes = iter(codes)
+    try:
+        for code in codes:
+            if code < 0:
+                stack.append(values[-1 - code])
+                continue
+            count = next(codes)
+            next(codes)
+            if count:
+                contents = stack[-count:]
+                del stack[-count:]
+            else:
+                contents = []
+            stack.append(rebuilders[code >> 1](contents, bool(code & 1)))
+    except (StopIteration, IndexError):
+        raise ValueError('Corrupted tree')
 
-        return wrapper(self).format(children=rendered_text)
+    if len(stack) != 1 or not isinstance(stack[0], Node):
+        raise ValueError('Corrupted tree')
+    return stack[0]
+
+class Pending(object):
+    """
+    Contents of a mapped node that were not read yet: the reader of its tree
+    and the position of the node's last code.
+    """
+    __slots__ = ('reader', 'end')
+
+    def __init__(self, reader, end):
+        self.reader = reader
+        self.end = end
+
+mapped_classes = {}
+def mapped_class(cls):
+    """
+    Returns a subclass of 'cls' for nodes whose contents are still Pending.
+    It reads the contents on first access and then changes the node's class
+    back to 'cls', so loaded nodes don't pay for the indirection. It has the
+    same name as 'cls', and no slots of its own so the change is allowed.
+    """
+    try:
+        return mapped_classes[cls]
+    except KeyError:
+        pass
+
+    def get_contents(self):
+        pending = node_contents.__get__(self)
+        contents = pending.reader.children(pending.end)
+        for item in contents:
+            if isinstance(item, Node):
+                item.parent = self
+        node_contents.__set__(self, contents)
+        self.__class__ = cls
+        return contents
+
+    def set_contents(self, contents):
+        node_contents.__set__(self, contents)
+        self.__class__ = cls
+
+    def layout(self, wrapper=empty_wrapper):
+        # Wrappers may look at the class of the node.
+        get_contents(self)
+        return self.layout(wrapper)
+
+    namespace = {'contents': property(get_contents, set_contents),
+                 'layout': layout,
+                 '__module__': cls.__module__,
+                 '__qualname__': cls.__qualname__}
+    mapped = mapped_classes[cls] = type(cls)(cls.__name__, (cls,), namespace)
+    return mapped
+
+class TreeReader(object):
+    """
+    Builds the nodes of a tree in the format written by 'dump' on demand,
+    from a buffer that is usually a memory-mapped file. Nodes are created
+    with Pending contents when their parent's contents are read, except for
+    leaves, whose value is read at once.
+    """
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer)
+        position = 0
+        def read(size):
+            nonlocal position
+            position += size
+            return self.buffer[position - size:position]
+        self.classes, self.codes, self.offsets, self.blobs = read_sections(read)
+        self.leaves = [issubclass(cls, Leaf) for cls in self.classes]
+        self.values = {}
+
+    def value(self, index):
+        try:
+            return self.values[index]
+        except KeyError:
+            value = self.values[index] = marshal.loads(
+                self.blobs[self.offsets[index]:self.offsets[index + 1]])
+            return value
+
+    def node(self, end):
+        """ Returns the node whose last code is at 'end'. """
+        codes = self.codes
+        code = codes[end - 2]
+        cls = self.classes[code >> 1]
+        placeholder = bool(code & 1)
+        if self.leaves[code >> 1]:
+            return cls.rebuild(self.children(end), placeholder)
+
+        node = cls.rebuild([], placeholder)
+        node_contents.__set__(node, Pending(self, end))
+        node.__class__ = mapped_class(cls)
+        return node
+
+    def children(self, end):
+        """ Returns the contents of the node whose last code is at 'end'. """
+        codes = self.codes
+        start = end - codes[end] + 1
+        items = []
+        position = end - 3
+        while position >= start:
+            code = codes[position]
+            if code < 0:
+                items.append(self.value(-1 - code))
+                position -= 1
+            else:
+                items.append(self.node(position))
+                position -= code
+        items.reverse()
+        return items
+
+    def root(self):
+        if not self.codes:
+            raise ValueError('Corrupted tree')
+        return self.node(len(self.codes) - 1)
+
+def map_tree(path):
+    """
+    Returns the root of the tree stored by 'dump' in the file at 'path'. The
+    file is memory-mapped and the nodes are only built when their parent's
+    contents are accessed.
+    """
+    with open(path, 'rb') as tree_file:
+        buffer = mmap.mmap(tree_file.fileno(), 0, access=mmap.ACCESS_READ)
+    return TreeReader(buffer).root()
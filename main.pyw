@@ -1,16 +1,35 @@
-from PyQt5 import QtGui, QtWidgets
+from time import perf_counter
+start = perf_counter()
+
 import sys
 
-from gui.window import MainEditorWindow
-from gui.html_editor import HtmlEditor
+# Worker processes (see core.background) import this module again on
+# platforms without fork, so the editor only starts when it's run directly.
+if __name__ == '__main__':
+    from PyQt5 import QtCore, QtGui, QtWidgets
+
+    from gui.window import MainEditorWindow
+    from gui.html_editor import HtmlEditor
+
+    # With this flag, prints the seconds from startup until the window is shown
+    # with the given files open, and exits. Used by 'benchmark.py startup'.
+    report_startup = '--startup-time' in sys.argv
+    if report_startup:
+        sys.argv.remove('--startup-time')
 
-app = QtWidgets.QApplication(sys.argv)
-mainWin = MainEditorWindow()
+    app = QtWidgets.QApplication(sys.argv)
+    mainWin = MainEditorWindow()
 
-files = sys.argv[1:] or [__file__]
-for path in files:
-    mainWin.tabbedEditor.add(HtmlEditor.from_file(path))
+    files = sys.argv[1:] or [__file__]
+    for path in files:
+        mainWin.tabbedEditor.add(HtmlEditor.from_file(path))
 
-#mainWin.setWindowIcon(QtGui.QIcon('editor.ico'))
-mainWin.show()
-sys.exit(app.exec_())
+    #mainWin.setWindowIcon(QtGui.QIcon('editor.ico'))
+    mainWin.show()
+    if report_startup:
+        def report():
+            print(perf_counter() - start)
+            app.quit()
+        # Runs once the event loop has painted the window.
+        QtCore.QTimer.singleShot(0, report)
+    sys.exit(app.exec_())